@@ -0,0 +1,115 @@
+"""
+Compare the parse time and memory of the CEQAnet export readers.
+
+    python benchmarks/bench_reader.py [--rows 200000] [--csv EXPORT.csv] [--repeat 3] [--json results.json]
+
+The sample export is repeated up to the requested number of rows. Each reader runs in a fresh
+process, so its peak RSS is not inflated by the readers run before it:
+    legacy   pd.read_csv of every column as inferred dtypes, then .loc[:, KEEPS] (the previous reader)
+    c        reader.read_export with the C engine: KEEPS only, declared dtypes and categoricals
+    pyarrow  reader.read_export with the pyarrow engine (skipped when pyarrow is not installed)
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scrape'))
+
+SAMPLE_CSV = os.path.join(ROOT, 'notebooks', 'CEQA Documents.csv')
+READERS = ['legacy', 'c', 'pyarrow']
+
+def build_export(sample_path, rows, target):
+    """Write the sample export with its rows repeated until there are at least `rows` of them."""
+    import pandas as pd
+    with open(sample_path, 'rb') as file:
+        data = file.read()
+    header, body = data.split(b'\n', 1)
+    if not body.endswith(b'\n'):
+        body += b'\n'
+    sample_rows = len(pd.read_csv(sample_path, encoding='ISO-8859-1', usecols=[0]))
+    copies = max(-(-rows // sample_rows), 1)
+    with open(target, 'wb') as file:
+        file.write(header + b'\n')
+        for _ in range(copies):
+            file.write(body)
+    return sample_rows * copies
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def run_reader(name, path):
+    """Parse the export once with one reader, in the current process, and return its measurements."""
+    import pandas as pd
+    from const import KEEPS
+    from reader import read_export
+
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    if name == 'legacy':
+        df = pd.read_csv(path, encoding='ISO-8859-1').loc[:, KEEPS]
+    else:
+        df = read_export(path, engine=name)
+    seconds = time.perf_counter() - start
+    return {
+        'reader': name,
+        'rows': len(df),
+        'seconds': round(seconds, 4),
+        'frame_mb': round(df.memory_usage(deep=True).sum() / (1024 * 1024), 2),
+        'peak_rss_mb': round(peak_rss_mb(), 2),
+        'parse_rss_mb': round(peak_rss_mb() - baseline, 2),
+    }
+
+def measure(name, path, repeat):
+    """Run a reader `repeat` times, each in a new process, and keep the fastest run and the lowest peak."""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name, path],
+                                check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    best = min(runs, key=lambda run: run['seconds'])
+    best['peak_rss_mb'] = min(run['peak_rss_mb'] for run in runs)
+    best['parse_rss_mb'] = min(run['parse_rss_mb'] for run in runs)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000, help="Rows of the generated export.")
+    parser.add_argument('--csv', default=SAMPLE_CSV, help="Export whose rows are repeated.")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per reader.")
+    parser.add_argument('--json', help="Also write the results to this file.")
+    parser.add_argument('--child', nargs=2, metavar=('READER', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_reader(*args.child)))
+        return
+
+    from reader import pyarrow
+    readers = [name for name in READERS if name != 'pyarrow' or pyarrow is not None]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'export.csv')
+        rows = build_export(args.csv, args.rows, path)
+        size_mb = os.path.getsize(path) / (1024 * 1024)
+        print(f"Export of {rows} rows, {size_mb:.1f} MB")
+        results = [measure(name, path, args.repeat) for name in readers]
+
+    legacy = results[0]
+    print(f"{'reader':<10}{'seconds':>10}{'speedup':>10}{'frame MB':>12}{'parse RSS MB':>15}{'peak RSS MB':>14}")
+    for result in results:
+        print(f"{result['reader']:<10}{result['seconds']:>10.3f}{legacy['seconds'] / result['seconds']:>9.2f}x"
+              f"{result['frame_mb']:>12.1f}{result['parse_rss_mb']:>15.1f}{result['peak_rss_mb']:>14.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'rows': rows, 'size_mb': round(size_mb, 2), 'results': results}, file, indent=2)
+
+if __name__ == "__main__":
+    main()
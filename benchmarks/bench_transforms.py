@@ -0,0 +1,222 @@
+"""
+Time each transform of CEQADataProcessor.process_csv on synthetic exports, from 1k to 1M rows.
+
+    python benchmarks/bench_transforms.py [--sizes 1000 10000 100000 1000000] [--repeat 3] [--seed 0]
+                                          [--output results/SHA.json] [--compare OLD.json] [--threshold 1.2]
+
+The export of each size comes from synthetic.py and starts as reader.read_export returns it. The
+stages then run in the order of _transform_frame, each on the output of the one before:
+    fill_missing                          missing values replaced by 'Unknown' (untyped loads)
+    parse_received_date                   'Received' parsed to datetimes
+    drop_unkeyed_filings                  filings without a numeric SCH number left out
+    generate_entry_id_and_date_gathered   the BIGINT key and the gathering date
+    run_parcel_expansion                  parcel strings expanded and joined, with a cold memo
+    run_parcel_expansion_warm             the same with the memo filled, as for later agencies of a run
+    map_document_type                     'Document Type Details' from DOCUMENT_TYPE
+    reorder_filtered_columns              columns in insert order, duplicate filings dropped
+    validate_widths                       text checked against the declared widths of its columns
+    to_db_types                           values converted to their database types (typed loads)
+    hash_rows                             content hashes (delta loads)
+    build_tuples                          the rows as the tuples sent to the database
+The previous, row-wise parcel path is timed on its own, up to --legacy-max-rows:
+    expand_parcel_numbers                 process_parcel_data, one Parcel_N column per parcel
+    combine_parcels                       the Parcel_N columns joined back into one
+
+Each stage keeps its fastest run. Results are written as JSON named after the current commit, so
+runs of two commits can be compared with --compare, which exits with status 1 on a regression.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+from datetime import datetime
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, os.path.join(ROOT, 'scrape'))
+sys.path.insert(0, BENCHMARKS)
+
+import numpy as np
+import pandas as pd
+from const import DOCUMENT_TYPE
+from reader import fill_missing
+from utils import (parse_received_date, drop_unkeyed_filings, generate_entry_id_and_date_gathered,
+                   run_parcel_expansion, process_parcel_data, combine_parcels, reorder_filtered_columns)
+from parcels import default_expander
+from schema import to_db_types
+from delta import hash_rows
+from validation import validate_widths
+from synthetic import generate_export, as_read
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+RESULTS_DIR = os.path.join(BENCHMARKS, 'results')
+
+def git_commit():
+    """Return the current commit and whether the tree has uncommitted changes, or (None, None) outside git."""
+    try:
+        sha = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, check=True,
+                             capture_output=True, text=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, check=True,
+                                capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return sha, bool(status)
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _timed(timings, stage, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    timings[stage] = time.perf_counter() - start
+    return result
+
+def run_stages(df, typed=False, legacy=True):
+    """
+    Run every stage once on a fresh copy of an export and return the seconds each took.
+
+    Args:
+        df (pd.DataFrame): The export as reader.read_export returns it.
+        typed (bool): Time to_db_types and leave fill_missing out, as a typed load does.
+        legacy (bool): Also time the row-wise parcel path.
+
+    Returns:
+        dict: Stage name to seconds.
+    """
+    timings = {}
+    data = df.copy()
+    if not typed:
+        data = _timed(timings, 'fill_missing', fill_missing, data, 'Unknown')
+    data = _timed(timings, 'parse_received_date', parse_received_date, data, 'Received')
+    data, _ = _timed(timings, 'drop_unkeyed_filings', drop_unkeyed_filings, data)
+    data = _timed(timings, 'generate_entry_id_and_date_gathered', generate_entry_id_and_date_gathered, data)
+
+    if legacy:
+        default_expander.cache_clear()
+        # process_parcel_data concatenates on the index, which is a RangeIndex here as in the old pipeline
+        wide = _timed(timings, 'expand_parcel_numbers', process_parcel_data, data.copy())
+        _timed(timings, 'combine_parcels', combine_parcels, wide)
+
+    default_expander.cache_clear()
+    expanded = _timed(timings, 'run_parcel_expansion', run_parcel_expansion, data.copy())
+    expanded = _timed(timings, 'run_parcel_expansion_warm', run_parcel_expansion, data)
+
+    start = time.perf_counter()
+    expanded['Document Type Details'] = expanded['Document Type'].map(DOCUMENT_TYPE)
+    timings['map_document_type'] = time.perf_counter() - start
+
+    expanded = _timed(timings, 'reorder_filtered_columns', reorder_filtered_columns, expanded)
+    expanded, _ = _timed(timings, 'validate_widths', validate_widths, expanded)
+    if typed:
+        expanded = _timed(timings, 'to_db_types', to_db_types, expanded)
+    _timed(timings, 'hash_rows', hash_rows, expanded)
+    _timed(timings, 'build_tuples', lambda frame: list(frame.itertuples(index=False, name=None)), expanded)
+    return timings
+
+def bench_size(rows, seed, repeat, typed, legacy):
+    """Time the stages on an export of `rows` rows and return one result per stage."""
+    df = as_read(generate_export(rows, seed))
+    runs = [run_stages(df, typed, legacy) for _ in range(repeat)]
+    results = []
+    for stage in runs[0]:
+        seconds = [run[stage] for run in runs]
+        best = min(seconds)
+        results.append({
+            'rows': rows,
+            'stage': stage,
+            'seconds': round(best, 6),
+            'mean_seconds': round(sum(seconds) / len(seconds), 6),
+            'rows_per_second': round(rows / best) if best else None,
+        })
+    return results, peak_rss_mb()
+
+def compare(results, baseline, threshold):
+    """
+    Print the ratio of every stage against a previous run and return the stages slower by more than threshold.
+
+    Args:
+        results (list): Results of this run.
+        baseline (dict): A JSON document written by a previous run.
+        threshold (float): Ratio of this run to the baseline above which a stage counts as a regression.
+
+    Returns:
+        list: (rows, stage, ratio) of the regressions.
+    """
+    previous = {(result['rows'], result['stage']): result['seconds'] for result in baseline['results']}
+    regressions = []
+    print(f"\nAgainst {(baseline.get('commit') or 'unknown')[:12]}:")
+    print(f"{'rows':>9}  {'stage':<38}{'before':>10}{'after':>10}{'ratio':>8}")
+    for result in results:
+        before = previous.get((result['rows'], result['stage']))
+        if not before:
+            continue
+        ratio = result['seconds'] / before
+        flag = '  slower' if ratio > threshold else ''
+        print(f"{result['rows']:>9}  {result['stage']:<38}{before:>10.4f}{result['seconds']:>10.4f}{ratio:>7.2f}x{flag}")
+        if ratio > threshold:
+            regressions.append((result['rows'], result['stage'], ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="Rows of the exports.")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per size.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic exports.")
+    parser.add_argument('--typed', action='store_true', help="Time a typed load: to_db_types, no fill_missing.")
+    parser.add_argument('--legacy-max-rows', type=int, default=10000,
+                        help="Largest export the row-wise parcel path is timed on (default is 10000).")
+    parser.add_argument('--output', help="JSON file of the results (default is results/<commit>.json).")
+    parser.add_argument('--compare', help="JSON file of a previous run to compare against.")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="Slowdown ratio reported as a regression by --compare (default is 1.2).")
+    args = parser.parse_args()
+
+    sha, dirty = git_commit()
+    results = []
+    peaks = {}
+    for rows in sorted(args.sizes):
+        size_results, peaks[rows] = bench_size(rows, args.seed, args.repeat, args.typed,
+                                               rows <= args.legacy_max_rows)
+        results.extend(size_results)
+        print(f"\n{rows} rows (peak RSS so far {peaks[rows]:.0f} MB)")
+        for result in size_results:
+            print(f"  {result['stage']:<38}{result['seconds']:>10.4f} s{result['rows_per_second'] or 0:>14,} rows/s")
+
+    report = {
+        'commit': sha,
+        'dirty': dirty,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'typed': args.typed,
+        'peak_rss_mb': {str(rows): round(peak, 1) for rows, peak in peaks.items()},
+        'results': results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{(sha or 'unknown')[:12]}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"\nWrote {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline.get('typed') != args.typed:
+            print("The baseline was run with a different --typed setting, the stages differ")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} stages slower than {args.threshold:.2f}x")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""
+Run CEQADataProcessor.run_for_cities end to end against local stand-ins, and measure it.
+
+    python benchmarks/load_test.py [--agencies 20] [--rows 2000] [--latency 0.2] [--pipelined] [--in-memory]
+                                   [--transform-workers 2] [--load-workers 1] [--runs 2] [--json report.json]
+
+Nothing leaves the machine:
+    CEQAnet   a stub HTTP server, in its own process, serving a synthetic export per agency (see
+              synthetic.py) at the BASE_URL query shape, after a configurable latency. It answers
+              If-None-Match with 304, so --fetcher runs skip unchanged exports as in production.
+    blobs     a LocalBlobStore in a temporary directory
+    Postgres  a throwaway cluster made with initdb and pg_ctl in a temporary directory, removed at
+              the end (--pg-bin or PATH must hold them, and initdb refuses to run as root), or the
+              database of the DB_* variables with --external-db, whose tables are written to
+
+Rows are loaded typed into a freshly migrated schema, as in production. The report gives
+agencies/min, rows/s, p50/p99 latency of each stage and the peak RSS of the pipeline process.
+With --chunk-rows the transforms run inside the load stage. A second --runs loads the same
+exports again, which measures unchanged exports in --delta mode.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, os.path.join(ROOT, 'scrape'))
+sys.path.insert(0, BENCHMARKS)
+
+# Stages of run_for_cities, as recorded in the metrics of the processor
+STAGES = ['download', 'upload', 'transform', 'load']
+COUNTIES = ['Los Angeles', 'San Diego', 'Orange', 'Riverside', 'San Bernardino', 'Kern', 'Fresno', 'Sacramento']
+
+def agency_plan(count, rows, sigma, seed):
+    """
+    Pick the agencies of a load test and the size of their exports: a lognormal spread around
+    `rows`, so a few large agencies come with many small ones, as on CEQAnet.
+
+    Returns:
+        list: (agency name, rows, seed, county) tuples.
+    """
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    sizes = rng.lognormal(0.0, sigma, count) if sigma else np.ones(count)
+    sizes = np.maximum((sizes / sizes.mean() * rows).round().astype(int), 1)
+    return [(f"Agency {index:04d}, City of", int(size), seed + index, COUNTIES[index % len(COUNTIES)])
+            for index, size in enumerate(sizes)]
+
+class _ExportHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        agency = query.get('LeadAgency', [None])[0]
+        export = self.server.exports.get(agency)
+        if url.path != '/Search' or query.get('OutputFormat') != ['CSV'] or export is None:
+            self.send_error(404)
+            return
+
+        delay = self.server.latency + self.server.jitter * (2 * self.server.random() - 1)
+        time.sleep(max(delay, 0.0))
+        body, etag = export
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_exports(plan, latency, jitter, ready):
+    """
+    Generate the export of every agency of the plan and serve them until the process is stopped.
+    Runs in its own process, so neither the generation nor the serving counts in the RSS or CPU
+    of the pipeline. The port is sent back through `ready` once the server listens.
+    """
+    import io
+    import random
+    import hashlib
+    from synthetic import write_export
+
+    exports = {}
+    for agency, rows, seed, county in plan:
+        buffer = io.BytesIO()
+        write_export(buffer, rows, seed, agency, county)
+        body = buffer.getvalue()
+        exports[agency] = (body, f'"{hashlib.sha256(body).hexdigest()}"')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ExportHandler)
+    server.daemon_threads = True
+    server.exports = exports
+    server.latency = latency
+    server.jitter = jitter
+    server.random = random.Random(0).random
+    ready.send((server.server_port, sum(len(body) for body, _ in exports.values())))
+    server.serve_forever()
+
+class ThrowawayPostgres:
+    """
+    A Postgres cluster in a temporary directory, for the duration of a with block.
+    """
+
+    def __init__(self, bin_dir=None, settings=None):
+        """
+        Args:
+            bin_dir (str): Directory of initdb and pg_ctl; defaults to the PG_BIN variable, then PATH.
+            settings (list): Extra 'name=value' server settings, e.g. 'shared_buffers=256MB'.
+        """
+        bin_dir = bin_dir or os.getenv('PG_BIN')
+        self.initdb = os.path.join(bin_dir, 'initdb') if bin_dir else shutil.which('initdb')
+        self.pg_ctl = os.path.join(bin_dir, 'pg_ctl') if bin_dir else shutil.which('pg_ctl')
+        if not (self.initdb and os.path.exists(self.initdb) and self.pg_ctl and os.path.exists(self.pg_ctl)):
+            raise RuntimeError("initdb and pg_ctl were not found; pass --pg-bin or use --external-db.")
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            raise RuntimeError("initdb cannot run as root; run the load test as another user or use --external-db.")
+        self.settings = settings or []
+        self.directory = None
+        self.port = None
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix='ceqa-pg-')
+        data = os.path.join(self.directory, 'data')
+        subprocess.run([self.initdb, '-D', data, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8', '--no-sync'],
+                       check=True, capture_output=True)
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+        options = f"-p {self.port} -k {self.directory} -c listen_addresses=127.0.0.1"
+        options += ''.join(f" -c {setting}" for setting in self.settings)
+        subprocess.run([self.pg_ctl, '-D', data, '-o', options, '-l', os.path.join(self.directory, 'log'),
+                        '-w', 'start'], check=True, capture_output=True)
+        return self
+
+    def __exit__(self, *exc):
+        subprocess.run([self.pg_ctl, '-D', os.path.join(self.directory, 'data'), '-m', 'fast', '-w', 'stop'],
+                       capture_output=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def connection_params(self):
+        return {'host': '127.0.0.1', 'port': self.port, 'user': 'postgres', 'dbname': 'postgres'}
+
+def summarize(cities, done, processor, seconds):
+    """Build the report of one run from its outcome and the stage metrics of the processor."""
+    import numpy as np
+    from metrics import peak_rss_mb
+    records = processor.metrics.stages()
+    rows = sum(counts.get('rows', 0) for counts in processor.run_report.values())
+    stages = {}
+    for stage in STAGES:
+        values = np.array([record['seconds'] for record in records if record['stage'] == stage])
+        if len(values) == 0:
+            continue
+        stages[stage] = {
+            'calls': len(values),
+            'p50': round(float(np.percentile(values, 50)), 4),
+            'p99': round(float(np.percentile(values, 99)), 4),
+            'max': round(float(values.max()), 4),
+            'total': round(float(values.sum()), 3),
+        }
+    steps = {}
+    for record in processor.metrics.records:
+        if record['step'] is not None:
+            steps[record['step']] = steps.get(record['step'], 0.0) + record['seconds']
+    totals = {}
+    for counts in processor.run_report.values():
+        for key, value in counts.items():
+            totals[key] = totals.get(key, 0) + value
+    errors = [(record['agency'], record['stage'], record['error']) for record in records if record['status'] == 'error']
+    failed = {agency for agency, _, _ in errors if agency is not None} - set(done)
+    return {
+        'seconds': round(seconds, 3),
+        'agencies': len(cities),
+        'succeeded': len(done),
+        'failed': len(failed),
+        # Agencies whose export had not changed, with --fetcher
+        'unchanged': len(cities) - len(done) - len(failed),
+        'rows': rows,
+        'agencies_per_minute': round(len(done) / seconds * 60, 2) if seconds else None,
+        'rows_per_second': round(rows / seconds, 1) if seconds else None,
+        'counts': totals,
+        'stages': stages,
+        'steps': {step: round(total, 3) for step, total in sorted(steps.items(), key=lambda item: -item[1])},
+        'errors': errors,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+def print_report(number, report):
+    print(f"\nRun {number}: {report['succeeded']}/{report['agencies']} agencies loaded, {report['failed']} failed, "
+          f"{report['unchanged']} unchanged, {report['rows']} rows in {report['seconds']:.2f} s")
+    print(f"  {report['agencies_per_minute']} agencies/min, {report['rows_per_second']} rows/s, "
+          f"peak RSS {report['peak_rss_mb']:.0f} MB, {report['counts']}")
+    print(f"  {'stage':<12}{'calls':>7}{'p50 s':>10}{'p99 s':>10}{'max s':>10}{'total s':>10}")
+    for stage in STAGES:
+        if stage in report['stages']:
+            values = report['stages'][stage]
+            print(f"  {stage:<12}{values['calls']:>7}{values['p50']:>10.4f}{values['p99']:>10.4f}"
+                  f"{values['max']:>10.4f}{values['total']:>10.3f}")
+    if report['steps']:
+        print("  steps, total s: " + ', '.join(f"{step} {total:.3f}" for step, total in report['steps'].items()))
+    for agency, stage, error in report['errors']:
+        print(f"  {agency} failed during {stage}: {error}")
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    load = parser.add_argument_group("load")
+    load.add_argument('--agencies', type=int, default=20, help="Number of agencies (default is 20).")
+    load.add_argument('--rows', type=int, default=2000, help="Mean rows per agency export (default is 2000).")
+    load.add_argument('--rows-sigma', type=float, default=1.0,
+                      help="Spread of the export sizes, 0 for equal sizes (default is 1.0).")
+    load.add_argument('--seed', type=int, default=0, help="Seed of the synthetic exports.")
+    load.add_argument('--latency', type=float, default=0.2, help="Seconds before each export is served.")
+    load.add_argument('--jitter', type=float, default=0.0, help="Random +/- seconds added to the latency.")
+    load.add_argument('--runs', type=int, default=1, help="Runs over the same exports (default is 1).")
+
+    pipeline = parser.add_argument_group("pipeline, see CEQADataProcessor and run_for_cities")
+    pipeline.add_argument('--pipelined', action='store_true')
+    pipeline.add_argument('--async-download', action='store_true')
+    pipeline.add_argument('--in-memory', action='store_true')
+    pipeline.add_argument('--fetcher', action='store_true', help="Use a CEQAFetcher for conditional downloads.")
+    pipeline.add_argument('--download-workers', type=int, default=4)
+    pipeline.add_argument('--upload-workers', type=int, default=2)
+    pipeline.add_argument('--transform-workers', type=int, default=2)
+    pipeline.add_argument('--load-workers', type=int, default=1)
+    pipeline.add_argument('--queue-size', type=int, default=4)
+    pipeline.add_argument('--pool-size', type=int, default=4, help="Connections of the database pool.")
+    pipeline.add_argument('--loader', choices=['copy', 'insert'], default='copy')
+    pipeline.add_argument('--delta', action='store_true')
+    pipeline.add_argument('--partitioned', action='store_true')
+    pipeline.add_argument('--no-parcels', action='store_true', help="Do not fill the parcel table.")
+    pipeline.add_argument('--group-rows', type=int, default=0)
+    pipeline.add_argument('--chunk-rows', type=int)
+    pipeline.add_argument('--csv-engine', choices=['auto', 'pyarrow', 'c'], default='auto')
+
+    database = parser.add_argument_group("database")
+    database.add_argument('--pg-bin', help="Directory of initdb and pg_ctl for the throwaway cluster.")
+    database.add_argument('--pg-setting', action='append', default=[],
+                          help="Setting of the throwaway cluster, e.g. 'fsync=off'; may be repeated.")
+    database.add_argument('--external-db', action='store_true',
+                          help="Load into the database of the DB_* variables instead of a throwaway cluster.")
+
+    metrics = parser.add_argument_group("metrics, see metrics.py")
+    metrics.add_argument('--profile', choices=['cprofile', 'tracemalloc'],
+                         help="Profile every stage and keep the profiles of the slowest agencies.")
+    metrics.add_argument('--profile-dir', default='profiles',
+                         help="Where profiles are written (default is ./profiles).")
+    metrics.add_argument('--metrics-textfile', help="Also write the Prometheus textfile of each run.")
+    metrics.add_argument('--metrics-table', action='store_true', help="Also fill the ingestion_runs table.")
+
+    parser.add_argument('--json', help="Also write the report to this file.")
+    parser.add_argument('--log-level', default='WARNING', help="Log level of the pipeline (default is WARNING).")
+    args = parser.parse_args(args)
+    # The pipeline runs in a temporary working directory
+    for name in ('metrics_textfile', 'profile_dir'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    return args
+
+def run(args, connection_params, base_url, workdir):
+    """Migrate the database, run the pipeline args.runs times and return the report of each run."""
+    from blob_store import LocalBlobStore
+    from data_processor import CEQADataProcessor
+    from db_pool import DBPool
+    from fetcher import CEQAFetcher
+    from schema import migrate, MIGRATIONS
+    from partitions import PARTITION_MIGRATIONS
+    from metrics import RunMetrics, Profiler
+
+    pool = DBPool(size=args.pool_size, **connection_params)
+    with pool.connection() as connection:
+        migrate(connection, MIGRATIONS + PARTITION_MIGRATIONS if args.partitioned else MIGRATIONS)
+
+    fetcher = CEQAFetcher(base_url=base_url, state_path=os.path.join(workdir, 'fetch_state.json')) \
+        if args.fetcher else None
+    processor = CEQADataProcessor(
+        table_name="ceqa_data", fetcher=fetcher, blob_store=LocalBlobStore(os.path.join(workdir, 'blobs')),
+        in_memory=args.in_memory, upload_workers=args.upload_workers, index_parcels=not args.no_parcels,
+        watchlist_report=os.path.join(workdir, 'watchlist_matches.csv'), loader=args.loader, delta=args.delta,
+        db_pool=pool, group_rows=args.group_rows, typed=True, partitioned=args.partitioned,
+        chunk_rows=args.chunk_rows, csv_engine=args.csv_engine, base_url=base_url,
+        metrics=RunMetrics(textfile=args.metrics_textfile, table=args.metrics_table,
+                           profiler=Profiler(args.profile, args.profile_dir) if args.profile else None),
+    )
+    cities = [agency for agency, _, _, _ in agency_plan(args.agencies, args.rows, args.rows_sigma, args.seed)]
+
+    reports = []
+    try:
+        for number in range(1, args.runs + 1):
+            start = time.perf_counter()
+            done = processor.run_for_cities(
+                cities, pipelined=args.pipelined, download_workers=args.download_workers,
+                upload_workers=args.upload_workers, transform_workers=args.transform_workers,
+                load_workers=args.load_workers, queue_size=args.queue_size, async_download=args.async_download,
+            )
+            report = summarize(cities, done, processor, time.perf_counter() - start)
+            print_report(number, report)
+            reports.append(report)
+
+        with pool.connection() as connection, connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM public.ceqa_data")
+            print(f"\nceqa_data holds {cursor.fetchone()[0]} filings")
+    finally:
+        pool.closeall()
+    return reports
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    plan = agency_plan(args.agencies, args.rows, args.rows_sigma, args.seed)
+
+    # The server process is started before this process opens any thread or connection
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.get_context('spawn').Process(
+        target=serve_exports, args=(plan, args.latency, args.jitter, sender), daemon=True)
+    server.start()
+    port, size = receiver.recv()
+    base_url = f"http://127.0.0.1:{port}/Search?LeadAgency="
+    print(f"Serving {len(plan)} exports, {sum(rows for _, rows, _, _ in plan)} rows and "
+          f"{size / (1024 * 1024):.1f} MB, at {base_url}")
+
+    from metrics import configure_logging
+    configure_logging(args.log_level)
+
+    workdir = tempfile.mkdtemp(prefix='ceqa-load-')
+    cwd = os.getcwd()
+    # Downloads that are not kept in memory are written to the working directory
+    os.chdir(workdir)
+    try:
+        if args.external_db:
+            from utils import db_connection_params
+            reports = run(args, db_connection_params(), base_url, workdir)
+        else:
+            with ThrowawayPostgres(args.pg_bin, args.pg_setting) as postgres:
+                reports = run(args, postgres.connection_params(), base_url, workdir)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        server.terminate()
+
+    if args.json:
+        from bench_transforms import git_commit
+        sha, dirty = git_commit()
+        with open(args.json, 'w') as file:
+            json.dump({
+                'commit': sha,
+                'dirty': dirty,
+                'python': platform.python_version(),
+                'config': vars(args),
+                'agencies': [{'agency': agency, 'rows': rows} for agency, rows, _, _ in plan],
+                'runs': reports,
+            }, file, indent=2)
+
+if __name__ == "__main__":
+    main()
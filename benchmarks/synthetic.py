@@ -0,0 +1,298 @@
+"""
+Seeded generator of synthetic CEQAnet exports, shaped like the real ones.
+
+    python benchmarks/synthetic.py --rows 100000 [--seed 0] [--agency "Lancaster, City of"] EXPORT.csv
+
+Every column of the export is present, with the null rates of the sample export: NOD columns are
+only filled for NODs, NOE columns for NOEs. A project (SCH number) has one to a few filings on
+different dates, which share their parcel string, as in the real exports. About a third of the
+filings have no parcel; the others use the formats the expansion has to handle, e.g.
+'3204008045/047', '3203-018-064 thru -071', '3123-014-900 to 916', '3219-018-01, 02, 03',
+'multiple' or stray spaces. The same seed always gives the same export.
+"""
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scrape'))
+
+from const import KEEPS, CSV_ENCODING
+from reader import export_dtypes
+
+# Columns of a CEQAnet export, in order
+EXPORT_COLUMNS = [
+    'SCH Number', 'Lead Agency Name', 'Lead Agency Title', 'Lead Agency Acronym', 'Document Title',
+    'Document Type', 'Received', 'Posted', 'Document Description', 'Document Portal URL', 'Project Title',
+    'Contact Full Name', 'Contact Authority', 'Contact Job Title', 'Contact Email Address',
+    'Contact Address  1', 'Contact Address  2', 'Contact City', 'Contact State', 'Contact Zip Code',
+    'Contact Phone Number', 'Location Coordinates', 'Cities', 'Counties', 'County Clerks',
+    'Location Cross Streets', 'Location Zip Code', 'Location Total Acres', 'Location Parcel Number',
+    'Location State Highways', 'Location Waterways', 'Location Airports', 'NOC Has Non Late Comment',
+    'NOC State Review Start Date', 'NOC State Review End Date', 'NOC Development Type', 'NOC Local Action',
+    'NOC Project Issues', 'NOC Public Review Start Date', 'NOC Public Review End Date', 'NOE Exempt Status',
+    'NOE Exempt Citation', 'NOE Reasons for Exemption', 'NOD Agency', 'NOD Approved By Lead Agency',
+    'NOD Approved Date', 'NOD Significant Environmental Impact', 'NOD Environmental Impact Report Prepared',
+    'NOD Negative Declaration Prepared', 'NOD Other Document Type', 'NOD Mitigation Measures',
+    'NOD Mitigation Reporting Or Monitoring Plan', 'NOD Statement Of Overriding Considerations Adopted',
+    'NOD Findings Made Pursuant', 'NOD Final EIR Available Location',
+]
+
+# Document types and how often they are filed
+DOCUMENT_TYPES = ['NOE', 'NOD', 'NOP', 'MND', 'NEG', 'EIR', 'ADM', 'SIR', 'FIN', 'CON', 'OTH', 'NOC']
+DOCUMENT_TYPE_WEIGHTS = [0.30, 0.22, 0.08, 0.12, 0.08, 0.06, 0.04, 0.02, 0.02, 0.02, 0.02, 0.02]
+
+# Parcel string formats and how often they appear among the filings that have a parcel
+PARCEL_FORMATS = ['dashed', 'plain', 'slash', 'thru', 'to', 'extension', 'and', 'semicolon',
+                  'multiple', 'padded', 'short']
+PARCEL_FORMAT_WEIGHTS = [0.40, 0.12, 0.08, 0.07, 0.04, 0.07, 0.06, 0.04, 0.05, 0.04, 0.03]
+
+PROJECT_KINDS = ['Conditional Use Permit', 'Tentative Tract Map', 'Site Plan Review', 'General Plan Amendment',
+                 'Zone Change', 'Specific Plan', 'Parcel Map', 'Architectural Design Review', 'Variance']
+PROJECT_ISSUES = ['Aesthetics', 'Agriculture and Forestry Resources', 'Air Quality', 'Biological Resources',
+                  'Cultural Resources', 'Cumulative Effects', 'Energy', 'Geology/Soils',
+                  'Greenhouse Gas Emissions', 'Hazards & Hazardous Materials', 'Hydrology/Water Quality',
+                  'Land Use/Planning', 'Noise', 'Population/Housing', 'Public Services', 'Recreation',
+                  'Transportation', 'Tribal Cultural Resources', 'Utilities/Service Systems', 'Wildfire']
+EXEMPT_STATUSES = ['Categorical Exemption', 'Statutory Exemptions', 'Ministerial [Sec. 21080(b)(1); 15268]']
+DEVELOPMENT_TYPES = ['Residential', 'Commercial', 'Industrial', 'Office', 'Recreational', 'Transportation']
+STREETS = ['Avenue J', 'Avenue K', 'Avenue L', 'Sierra Highway', '10th Street West', '20th Street East',
+           '37th Street West', 'Division Street', 'Lancaster Boulevard', 'Avenue J-8', '60th Street West']
+SENTENCES = [
+    "The proposed project consists of a {n}-lot single-family residential subdivision on approximately {a} acres.",
+    "The applicant requests approval to construct a {n},{m:03d} square-foot industrial building.",
+    "Access to the site would be provided from {s}.",
+    "The project site is currently vacant and surrounded by urban uses.",
+    "All work would occur within the existing developed and disturbed areas of the right-of-way.",
+    "The project would not expand the capacity of any roadway.",
+    "See the attached initial study for additional details.",
+    "Located at {n} {s} (APN: {p}) in the Light Industrial (LI) zone.",
+]
+FIRST_NAMES = ['Jocelyn', 'Kendall', 'Shannon', 'Maria', 'David', 'Alicia', 'Robert', 'Linh', 'Omar', 'Grace']
+LAST_NAMES = ['Swain', 'Brekke', 'Edwin', 'Garcia', 'Nguyen', 'Patel', 'Johnson', 'Kim', 'Lopez', 'Reyes']
+
+def _random_parcel(rng):
+    return f"{rng.integers(1000, 9999)}-{rng.integers(0, 999):03d}-{rng.integers(0, 999):03d}"
+
+def messy_parcel(rng, kind):
+    """
+    Write one 'Location Parcel Number' value in the given format of PARCEL_FORMATS.
+
+    Args:
+        rng (np.random.Generator): Source of randomness.
+        kind (str): The format, e.g. 'slash' for '3204008045/047' or 'thru' for '3203-018-064 thru -071'.
+
+    Returns:
+        str: The raw value, as typed into CEQAnet.
+    """
+    book, page, lot = rng.integers(1000, 9999), rng.integers(0, 999), rng.integers(0, 900)
+    span = int(rng.integers(1, 40))
+    if kind == 'dashed':
+        return f"{book}-{page:03d}-{lot:03d}"
+    if kind == 'plain':
+        return f"{book}{page:03d}{lot:03d}"
+    if kind == 'slash':
+        return f"{book}{page:03d}{lot:03d}/" + '/'.join(f"{lot + step:03d}" for step in range(1, span % 4 + 2))
+    if kind == 'thru':
+        return f"{book}-{page:03d}-{lot:03d} thru -{lot + span:03d}"
+    if kind == 'to':
+        return f"{book}-{page:03d}-{lot:03d} to {lot + span:03d}"
+    if kind == 'extension':
+        return f"{book}-{page:03d}-{lot:02d}, " + ', '.join(f"{(lot + step) % 100:02d}" for step in range(1, span % 5 + 2))
+    if kind == 'and':
+        return f"{book}-{page:03d}-{lot:03d} and {_random_parcel(rng)}"
+    if kind == 'semicolon':
+        return '; '.join(_random_parcel(rng) for _ in range(span % 6 + 2)) + ';'
+    if kind == 'multiple':
+        return str(rng.choice(['multiple', 'Multiple', 'Various', 'See attached', 'Public right-of-way']))
+    if kind == 'padded':
+        return f" {book}-{page:03d}-{lot:03d} "
+    if kind == 'short':
+        return f"{book}-{page:03d}"
+    raise ValueError(f"Unknown parcel format '{kind}'.")
+
+def _format_dates(dates):
+    # CEQAnet writes dates as M/D/YYYY, without leading zeros; each distinct day is formatted once
+    days, inverse = np.unique(dates, return_inverse=True)
+    formatted = np.array([f"{day.month}/{day.day}/{day.year}" for day in pd.DatetimeIndex(days)], dtype=object)
+    return formatted[inverse]
+
+def _pick(rng, values, size, null_rate=0.0):
+    picked = np.asarray(values, dtype=object)[rng.integers(0, len(values), size)]
+    if null_rate:
+        picked[rng.random(size) < null_rate] = None
+    return picked
+
+def _only(values, mask):
+    values = values.copy()
+    values[~mask] = None
+    return values
+
+def generate_export(rows, seed=0, agency='Lancaster, City of', county='Los Angeles'):
+    """
+    Generate a synthetic CEQAnet export of one lead agency.
+
+    Args:
+        rows (int): Number of filings.
+        seed (int): Seed of the generator; the same seed gives the same export.
+        agency (str): 'Lead Agency Name' of the filings, e.g. 'Lancaster, City of'.
+        county (str): County of the filings.
+
+    Returns:
+        pd.DataFrame: Every column of EXPORT_COLUMNS as text, None for empty cells.
+    """
+    rng = np.random.default_rng(seed)
+    city = agency.split(',')[0]
+    title = f"City of {city}" if agency.endswith('City of') else agency
+
+    # Projects have 1.35 filings on average, each filed on its own date
+    n_projects = max(int(rows / 1.35), 1)
+    project_ids = rng.choice(25 * 12 * 10000, size=n_projects, replace=n_projects > 25 * 12 * 10000)
+    years, rest = 2000 + project_ids // 120000, project_ids % 120000
+    months, sequences = rest // 10000 + 1, rest % 10000
+    sch_numbers = years * 1000000 + months * 10000 + sequences
+    project = rng.integers(0, n_projects, rows)
+
+    starts = (years - 1970) * 12 + months - 1
+    starts = starts.astype('datetime64[M]').astype('datetime64[D]') + rng.integers(0, 28, n_projects)
+    received = starts[project] + rng.integers(0, 400, rows).astype('timedelta64[D]')
+    posted = received + rng.integers(0, 10, rows).astype('timedelta64[D]')
+    review_end = received + 30
+
+    document_type = np.asarray(DOCUMENT_TYPES, dtype=object)[
+        rng.choice(len(DOCUMENT_TYPES), rows, p=DOCUMENT_TYPE_WEIGHTS)]
+    is_nod = document_type == 'NOD'
+    is_noe = document_type == 'NOE'
+    is_noc = ~(is_nod | is_noe)
+
+    # One parcel string per project, shared by its filings; 38% of the projects have none
+    formats = np.asarray(PARCEL_FORMATS)[rng.choice(len(PARCEL_FORMATS), n_projects, p=PARCEL_FORMAT_WEIGHTS)]
+    has_parcel = rng.random(n_projects) >= 0.38
+    project_parcels = np.array([messy_parcel(rng, kind) if keep else None
+                                for kind, keep in zip(formats, has_parcel)], dtype=object)
+
+    # Free text comes from pools, so the export has realistic lengths without a string per cell
+    titles = np.array([f"{kind} No. {rng.integers(10, 25)}-{rng.integers(1, 999):03d}"
+                       for kind in _pick(rng, PROJECT_KINDS, 4000)], dtype=object)
+    descriptions = np.array([
+        ' '.join(sentence.format(n=rng.integers(2, 99), m=rng.integers(0, 999), a=round(rng.uniform(0.2, 80), 2),
+                                 s=rng.choice(STREETS), p=_random_parcel(rng))
+                 for sentence in rng.choice(SENTENCES, rng.integers(2, 6), replace=False))
+        for _ in range(2000)], dtype=object)
+    # A few descriptions hold line breaks, as quoted multi-line values in the CSV
+    descriptions[::50] = [description.replace('. ', '.\n\n', 1) for description in descriptions[::50]]
+    issues = np.array([', '.join(sorted(rng.choice(PROJECT_ISSUES, rng.integers(3, 18), replace=False)))
+                       for _ in range(1000)], dtype=object)
+    cross_streets = np.array([f"{a} and {b}" for a, b in zip(_pick(rng, STREETS, 500), _pick(rng, STREETS, 500))],
+                             dtype=object)
+    contacts = np.array([f"{first} {last}" for first, last in zip(_pick(rng, FIRST_NAMES, 100),
+                                                                   _pick(rng, LAST_NAMES, 100))], dtype=object)
+
+    acres = rng.lognormal(1.0, 1.5, rows).round(2)
+    sch_text = sch_numbers[project].astype(str).astype(object)
+    yes_no = ['Yes', 'No']
+
+    columns = {
+        'SCH Number': sch_text,
+        'Lead Agency Name': np.full(rows, agency, dtype=object),
+        'Lead Agency Title': np.full(rows, title, dtype=object),
+        'Lead Agency Acronym': np.full(rows, None, dtype=object),
+        'Document Title': titles[project % len(titles)],
+        'Document Type': document_type,
+        'Received': _format_dates(received),
+        'Posted': _only(_format_dates(posted), rng.random(rows) < 0.21),
+        'Document Description': descriptions[rng.integers(0, len(descriptions), rows)],
+        'Document Portal URL': 'https://ceqanet.opr.ca.gov/' + sch_text,
+        'Project Title': titles[project % len(titles)],
+        'Contact Full Name': _pick(rng, contacts, rows),
+        'Contact Authority': _pick(rng, [title, f"{title}, CA"], rows, 0.03),
+        'Contact Job Title': _pick(rng, ['Planner', 'Senior Planner', 'Associate Planner'], rows, 0.8),
+        'Contact Email Address': _pick(rng, [f"planning@{city.lower().replace(' ', '')}.gov"], rows, 0.75),
+        'Contact Address  1': _pick(rng, ['44933 Fern Avenue', '44933 Fern Ave '], rows, 0.19),
+        'Contact Address  2': _pick(rng, ['Suite 870'], rows, 0.99),
+        'Contact City': _pick(rng, [city, f"{city} "], rows, 0.19),
+        'Contact State': _pick(rng, ['CA'], rows, 0.19),
+        'Contact Zip Code': _pick(rng, ['93534', '93535', '93536'], rows, 0.19),
+        'Contact Phone Number': _pick(rng, ['6617236100', '6617236105'], rows, 0.01),
+        'Location Coordinates': _pick(rng, ['34°41\'18"N 118°11\'22"W'], rows, 0.98),
+        'Cities': _pick(rng, [city], rows, 0.01),
+        'Counties': _pick(rng, [county], rows, 0.02),
+        'County Clerks': _pick(rng, [county], rows, 0.91),
+        'Location Cross Streets': _pick(rng, cross_streets, rows, 0.19),
+        'Location Zip Code': _pick(rng, ['93534', '93535', '93536'], rows, 0.37),
+        'Location Total Acres': _only(acres.astype(str).astype(object), rng.random(rows) >= 0.32),
+        'Location Parcel Number': project_parcels[project],
+        'Location State Highways': _pick(rng, ['14', '138'], rows, 0.59),
+        'Location Waterways': _pick(rng, ['Amargosa Creek'], rows, 0.81),
+        'Location Airports': _pick(rng, ['General William J. Fox Airfield', 'Air Force Plant 42'], rows, 0.84),
+        'NOC Has Non Late Comment': _only(_pick(rng, yes_no, rows), is_noc),
+        'NOC State Review Start Date': _only(_format_dates(received), is_noc),
+        'NOC State Review End Date': _only(_format_dates(review_end), is_noc),
+        'NOC Development Type': _only(_pick(rng, DEVELOPMENT_TYPES, rows), is_noc),
+        'NOC Local Action': _only(_pick(rng, PROJECT_KINDS, rows), is_noc),
+        'NOC Project Issues': _only(issues[rng.integers(0, len(issues), rows)], is_noc),
+        'NOC Public Review Start Date': _only(_format_dates(received), is_noc & (rng.random(rows) < 0.15)),
+        'NOC Public Review End Date': _only(_format_dates(review_end), is_noc & (rng.random(rows) < 0.15)),
+        'NOE Exempt Status': _only(_pick(rng, EXEMPT_STATUSES, rows), is_noe),
+        'NOE Exempt Citation': _only(_pick(rng, ['Class 1 Section 15301 Existing Facilities',
+                                                 'Class 32, Section 15332, Infill Development Project'], rows), is_noe),
+        'NOE Reasons for Exemption': _only(descriptions[rng.integers(0, len(descriptions), rows)], is_noe),
+        'NOD Agency': _only(_pick(rng, [title, 'CDFW'], rows), is_nod),
+        'NOD Approved By Lead Agency': _only(_pick(rng, yes_no, rows), is_nod),
+        'NOD Approved Date': _only(_format_dates(posted), is_nod),
+        'NOD Significant Environmental Impact': _only(_pick(rng, yes_no, rows), is_nod),
+        'NOD Environmental Impact Report Prepared': _only(_pick(rng, yes_no, rows), is_nod),
+        'NOD Negative Declaration Prepared': _only(_pick(rng, yes_no, rows), is_nod),
+        'NOD Other Document Type': np.full(rows, None, dtype=object),
+        'NOD Mitigation Measures': _only(_pick(rng, yes_no, rows), is_nod),
+        'NOD Mitigation Reporting Or Monitoring Plan': _only(_pick(rng, yes_no, rows), is_nod),
+        'NOD Statement Of Overriding Considerations Adopted': _only(_pick(rng, yes_no, rows), is_nod),
+        'NOD Findings Made Pursuant': _only(_pick(rng, yes_no, rows), is_nod),
+        'NOD Final EIR Available Location': _only(_pick(rng, ['https://example.org/environmental-review',
+                                                               'The office location listed above.'], rows), is_nod),
+    }
+    return pd.DataFrame(columns, columns=EXPORT_COLUMNS, dtype=object)
+
+def as_read(df):
+    """
+    Give a generated export the columns and dtypes reader.read_export returns, as if it had been
+    written to CSV and read back.
+
+    Args:
+        df (pd.DataFrame): A frame from generate_export.
+
+    Returns:
+        pd.DataFrame: The KEEPS columns, categoricals and strings.
+    """
+    return df.loc[:, KEEPS].astype(export_dtypes(KEEPS))
+
+def write_export(path_or_buffer, rows, seed=0, agency='Lancaster, City of', county='Los Angeles'):
+    """
+    Write a synthetic export as CEQAnet serves it, see generate_export.
+
+    Args:
+        path_or_buffer (str or file-like): Where the CSV is written; a binary buffer for bytes.
+        rows (int), seed (int), agency (str), county (str): See generate_export.
+
+    Returns:
+        int: Number of rows written.
+    """
+    df = generate_export(rows, seed, agency, county)
+    df.to_csv(path_or_buffer, index=False, encoding=CSV_ENCODING)
+    return len(df)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help="CSV file to write.")
+    parser.add_argument('--rows', type=int, default=100000, help="Number of filings.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the generator.")
+    parser.add_argument('--agency', default='Lancaster, City of', help="Lead agency of the filings.")
+    parser.add_argument('--county', default='Los Angeles', help="County of the filings.")
+    args = parser.parse_args()
+    rows = write_export(args.path, args.rows, args.seed, args.agency, args.county)
+    print(f"Wrote {rows} rows to {args.path}")
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,9 @@ from dotenv import load_dotenv
 from utils import (fetch_unique_doc_types, 
                    get_db_connection, 
                    fetch_unique_cities,
-                   fetch_filtered_data)
+                   fetch_filtered_data,
+                   fetch_filings_by_parcel,
+                   match_watchlist)
 from instructions import instructions_tab
 
 # CEQA App for Land Acquisition Teams to track CEQA documents specifically for Early Identification of projects. 
@@ -59,6 +61,29 @@ def render_explore_data_tab(conn):
             st.write(f"Filtered by: City - {city_name}, Doc Type - {doc_type}, Date Range - {date_range}")
             st.dataframe(filtered_data)
 
+    with st.form("parcel_form"):
+        # Look up every filing touching one or more APNs
+        parcel_input = st.text_input("Parcel Numbers (APN), comma separated")
+        parcel_button = st.form_submit_button("Search Parcels")
+
+        if parcel_button and parcel_input.strip():
+            parcel_numbers = [parcel.strip() for parcel in parcel_input.split(",") if parcel.strip()]
+            parcel_data = fetch_filings_by_parcel(conn, parcel_numbers)
+            st.write(f"Found {len(parcel_data)} filings for {len(parcel_numbers)} parcels")
+            st.dataframe(parcel_data)
+
+    with st.form("watchlist_form"):
+        # Match a whole APN watchlist (one APN per line, or a CSV whose first column is the APN)
+        watchlist_file = st.file_uploader("APN Watchlist", type=["csv", "txt"])
+        watchlist_button = st.form_submit_button("Match Watchlist")
+
+        if watchlist_button and watchlist_file is not None:
+            lines = watchlist_file.getvalue().decode("utf-8", errors="ignore").splitlines()
+            watchlist_apns = [line.split(",")[0].strip() for line in lines if line.strip()]
+            matches = match_watchlist(conn, watchlist_apns)
+            st.write(f"{matches['apn'].nunique()} of {len(watchlist_apns)} APNs matched {len(matches)} filings")
+            st.dataframe(matches)
+
 def render_process_files_tab():
     """Render the Process Files tab."""
     st.header("Process Files")
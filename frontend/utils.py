@@ -1,3 +1,4 @@
+import re
 import sys
 import base64
 from datetime import datetime
@@ -142,4 +143,34 @@ def fetch_project_details(conn, sch_number):
         project_details = pd.DataFrame([result], columns=columns)
         return project_details
     else:
-        return None
\ No newline at end of file
+        return None
+
+def normalize_apns(parcel_numbers):
+    """Reduce APNs to the digits stored in ceqa_parcels, keeping the valid 9-10 digit ones, as the ingest watchlist does."""
+    # e.g. '3204-008-045' is stored as '3204008045'
+    parcels = [re.sub(r'\D', '', str(parcel)) for parcel in parcel_numbers]
+    return list(dict.fromkeys(parcel for parcel in parcels if 9 <= len(parcel) <= 10))
+
+def fetch_filings_by_parcel(conn, parcel_numbers):
+    """Fetch the filings that touch any of the given APNs, using the indexed ceqa_parcels table."""
+    query = """
+    SELECT p.parcel, d.*
+    FROM ceqa_parcels p
+    JOIN ceqa_data d ON d.entry_id = p.entry_id
+    WHERE p.parcel = ANY(%s)
+    ORDER BY p.parcel, d.received
+    """
+
+    with conn.cursor() as cur:
+        cur.execute(query, (normalize_apns(parcel_numbers),))
+        result = cur.fetchall()
+        column_names = [column[0] for column in cur.description]
+
+    return pd.DataFrame(result, columns=column_names)
+
+def match_watchlist(conn, watchlist_apns):
+    """Match a watchlist of APNs against every indexed parcel and return one row per (APN, filing)."""
+    # ceqa_parcels holds every parcel the ingest watchlist matcher would match, ranges included
+    filings = fetch_filings_by_parcel(conn, watchlist_apns).rename(columns={'parcel': 'apn'})
+    return filings[['apn', 'entry_id', 'sch_number', 'document_type', 'document_type_details',
+                    'lead_agency_title', 'received']]
@@ -1,12 +1,27 @@
 from data_processor import CEQADataProcessor
+from fetcher import CEQAFetcher
+from db_pool import get_db_pool
+from schema import migrate
+from metrics import configure_logging, metrics_from_env
+from ledger import get_job_ledger
 
 if __name__ == "__main__":
-    
+    configure_logging()
+
     # Example list of cities to process
     cities = ["Lancaster, City of", "Los Angeles, City of", "San Diego, City of"]
 
-    # Initialize the CEQADataProcessor with the table name
-    processor = CEQADataProcessor(table_name="ceqa_data")
+    # Bring the ceqa_data schema up to date before loading typed rows into it
+    db_pool = get_db_pool()
+    with db_pool.connection() as connection:
+        migrate(connection)
+
+    # Initialize the CEQADataProcessor with the table name, skipping agencies whose export is unchanged
+    # and reusing pooled database connections across agencies. The per-stage metrics of the run go to
+    # the ingestion_runs table and to the outputs set in the environment (see metrics_from_env), and
+    # the job ledger lets a rerun skip the agencies already loaded by an interrupted run (see ledger.py)
+    processor = CEQADataProcessor(table_name="ceqa_data", fetcher=CEQAFetcher(), db_pool=db_pool, typed=True,
+                                  metrics=metrics_from_env(), ledger=get_job_ledger(db_pool))
     
     # Run the data processor for the specified cities
     processor.run_for_cities(cities)
\ No newline at end of file
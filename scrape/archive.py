@@ -0,0 +1,214 @@
+import io
+import re
+import gzip
+import json
+import shutil
+import hashlib
+import logging
+from datetime import datetime
+from const import ARCHIVE_PREFIX, ARCHIVE_COMPRESSION
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, gzip is always available
+    zstandard = None
+
+# File extension of each supported compression
+EXTENSIONS = {"gzip": "gz", "zstd": "zst"}
+
+def agency_slug(city_name):
+    """
+    Turn an agency name into a blob-safe path segment.
+
+    Args:
+        city_name (str): Agency name, e.g. 'Los Angeles, City of'.
+
+    Returns:
+        str: Lowercase slug, e.g. 'los-angeles-city-of'.
+    """
+    return re.sub(r'[^a-z0-9]+', '-', city_name.lower()).strip('-')
+
+def file_sha256(file_name, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def compress_file(file_name, compression):
+    """
+    Compress a file into an in-memory buffer.
+
+    Args:
+        file_name (str): The file to compress.
+        compression (str): 'gzip' or 'zstd'.
+
+    Returns:
+        bytes: The compressed content.
+    """
+    buffer = io.BytesIO()
+    with open(file_name, 'rb') as source:
+        if compression == "gzip":
+            with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as target:
+                shutil.copyfileobj(source, target)
+        elif compression == "zstd":
+            if zstandard is None:
+                raise ValueError("zstd compression requires the 'zstandard' package.")
+            zstandard.ZstdCompressor().copy_stream(source, buffer)
+        else:
+            raise ValueError(f"Unknown compression '{compression}', expected 'gzip' or 'zstd'.")
+    return buffer.getvalue()
+
+def compress_bytes(data, compression):
+    """
+    Compress an in-memory buffer.
+
+    Args:
+        data (bytes): The content to compress.
+        compression (str): 'gzip' or 'zstd'.
+
+    Returns:
+        bytes: The compressed content.
+    """
+    if compression == "gzip":
+        return gzip.compress(data, mtime=0)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression requires the 'zstandard' package.")
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError(f"Unknown compression '{compression}', expected 'gzip' or 'zstd'.")
+
+def decompress_bytes(data, compression):
+    """Reverse compress_file."""
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression requires the 'zstandard' package.")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    raise ValueError(f"Unknown compression '{compression}', expected 'gzip' or 'zstd'.")
+
+class ExportArchive:
+    """
+    Content-addressed archive of raw agency exports in blob storage.
+
+    Each export is stored compressed under its SHA-256, so an identical export is only
+    uploaded once. A small JSON manifest per agency and date records which object each
+    download produced:
+
+        {prefix}/objects/{sha[:2]}/{sha}.csv.{gz|zst}
+        {prefix}/manifests/{agency-slug}/{YYYY-MM-DD}.json
+    """
+
+    def __init__(self, blob_store, prefix=ARCHIVE_PREFIX, compression=ARCHIVE_COMPRESSION):
+        """
+        Initialize the archive.
+
+        Args:
+            blob_store (AzureBlobStore or LocalBlobStore): Where objects and manifests are stored.
+            prefix (str): Blob name prefix for the archive.
+            compression (str): 'gzip' or 'zstd'.
+        """
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unknown compression '{compression}', expected 'gzip' or 'zstd'.")
+        self.blob_store = blob_store
+        self.prefix = prefix
+        self.compression = compression
+
+    def object_name(self, sha256):
+        """Blob name of the archived object with the given hash."""
+        return f"{self.prefix}/objects/{sha256[:2]}/{sha256}.csv.{EXTENSIONS[self.compression]}"
+
+    def manifest_name(self, city_name, day):
+        """Blob name of the manifest of an agency for a given date."""
+        return f"{self.prefix}/manifests/{agency_slug(city_name)}/{day.isoformat()}.json"
+
+    def archive(self, city_name, file_name, sha256=None, fetched_at=None):
+        """
+        Store a downloaded export in the archive and record it in the agency manifest.
+
+        Args:
+            city_name (str): The agency the export belongs to.
+            file_name (str): The local CSV file.
+            sha256 (str): Hash of the file if already known, e.g. from the fetcher.
+            fetched_at (datetime): When the export was downloaded (default is now).
+
+        Returns:
+            str: The blob name of the archived object.
+        """
+        sha256 = sha256 or file_sha256(file_name)
+        return self._store(city_name, sha256, fetched_at, lambda: compress_file(file_name, self.compression))
+
+    def archive_bytes(self, city_name, data, sha256=None, fetched_at=None):
+        """
+        Store an export held in memory in the archive and record it in the agency manifest.
+
+        Args:
+            city_name (str): The agency the export belongs to.
+            data (bytes): The CSV content.
+            sha256 (str): Hash of the content if already known, e.g. from the fetcher.
+            fetched_at (datetime): When the export was downloaded (default is now).
+
+        Returns:
+            str: The blob name of the archived object.
+        """
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        return self._store(city_name, sha256, fetched_at, lambda: compress_bytes(data, self.compression))
+
+    def _store(self, city_name, sha256, fetched_at, compress):
+        fetched_at = fetched_at or datetime.now()
+        object_name = self.object_name(sha256)
+
+        if self.blob_store.exists(object_name):
+            logging.info(f"Export for {city_name} already archived as {object_name}, skipping upload")
+            uploaded = False
+        else:
+            data = compress()
+            self.blob_store.upload_bytes(object_name, data)
+            logging.info(f"Archived export for {city_name} as {object_name} ({len(data)} bytes compressed)")
+            uploaded = True
+
+        self._record(city_name, fetched_at, {
+            "sha256": sha256,
+            "object": object_name,
+            "compression": self.compression,
+            "fetched_at": fetched_at.isoformat(timespec='seconds'),
+            "uploaded": uploaded,
+        })
+        return object_name
+
+    def _record(self, city_name, fetched_at, entry):
+        # Manifests are tiny, so read-modify-write is fine; one agency is processed by one worker at a time
+        manifest_name = self.manifest_name(city_name, fetched_at.date())
+        manifest = {"agency": city_name, "date": fetched_at.date().isoformat(), "downloads": []}
+        if self.blob_store.exists(manifest_name):
+            manifest = json.loads(self.blob_store.download_bytes(manifest_name))
+        manifest["downloads"].append(entry)
+        self.blob_store.upload_bytes(manifest_name, json.dumps(manifest, indent=2).encode('utf-8'))
+
+    def read_manifest(self, city_name, day):
+        """
+        Return the manifest of an agency for a given date.
+
+        Args:
+            city_name (str): The agency name.
+            day (date): The date of the manifest.
+
+        Returns:
+            dict: The manifest, with the list of downloads made that day.
+        """
+        return json.loads(self.blob_store.download_bytes(self.manifest_name(city_name, day)))
+
+    def restore(self, object_name, file_name):
+        """
+        Decompress an archived object into a local CSV file.
+
+        Args:
+            object_name (str): Blob name of the archived object.
+            file_name (str): Local path to write.
+        """
+        compression = "zstd" if object_name.endswith(".zst") else "gzip"
+        with open(file_name, 'wb') as file:
+            file.write(decompress_bytes(self.blob_store.download_bytes(object_name), compression))
+        logging.info(f"Restored {object_name} to {file_name}")
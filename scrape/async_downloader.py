@@ -0,0 +1,361 @@
+import os
+import time
+import queue
+import random
+import asyncio
+import logging
+import threading
+import aiohttp
+from utils import build_download_url, cleanup_local_file
+from const import (BASE_URL, DOWNLOAD_CHUNK_SIZE, ASYNC_RATE_LIMIT, ASYNC_RATE_BURST, ASYNC_MAX_CONCURRENCY,
+                   ASYNC_MAX_IN_FLIGHT_BYTES, ASYNC_REQUEST_TIMEOUT, ASYNC_MAX_RETRIES, ASYNC_BACKOFF_BASE,
+                   ASYNC_BACKOFF_MAX)
+
+# Status codes worth retrying: rate limited or a server-side failure
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter shared by every request of a download run.
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        Args:
+            rate (float): Tokens added per second, i.e. the sustained requests per second.
+            capacity (int): Maximum number of tokens, i.e. the allowed burst.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a token is available and take it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class ByteBudget:
+    """
+    Cap on the number of response bytes held by the transfers running at the same time.
+
+    Transfers reserve their bytes one chunk at a time as the body streams in, whether or not the
+    response announced its size. A transfer may need another chunk before it can give back what it
+    holds, so when every reserved byte belongs to a waiting transfer, the one holding the most goes
+    over the cap, and keeps going until it finishes, instead of all of them waiting forever.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._in_flight = 0
+        self._waiting = {}  # Waiting transfer -> bytes it holds, in order of arrival
+        self._condition = asyncio.Condition()
+
+    def _may_take(self, waiter, n):
+        if self._in_flight + n <= self.max_bytes:
+            return True
+        stalled = sum(self._waiting.values()) >= self._in_flight
+        return stalled and max(self._waiting, key=self._waiting.get) is waiter
+
+    async def acquire(self, n, held=0):
+        """
+        Reserve n more bytes, waiting for other transfers to give theirs back if needed.
+
+        Args:
+            n (int): Bytes to reserve.
+            held (int): Bytes the caller already holds and keeps while it waits.
+
+        Returns:
+            float: Seconds spent waiting.
+        """
+        start = time.monotonic()
+        waiter = object()
+        async with self._condition:
+            self._waiting[waiter] = held
+            # Another waiter may be the one to go ahead now that this one is stuck too
+            self._condition.notify_all()
+            try:
+                await self._condition.wait_for(lambda: self._may_take(waiter, n))
+            finally:
+                del self._waiting[waiter]
+            self._in_flight += n
+        return time.monotonic() - start
+
+    async def release(self, n):
+        """Give back bytes reserved with acquire."""
+        async with self._condition:
+            self._in_flight -= n
+            self._condition.notify_all()
+
+def backoff_delay(attempt, retry_after=None, base=ASYNC_BACKOFF_BASE, cap=ASYNC_BACKOFF_MAX):
+    """
+    Compute the wait before the next attempt using jittered exponential backoff.
+
+    Args:
+        attempt (int): Number of attempts already made (starting at 1).
+        retry_after (str): Value of a Retry-After header, honoured when it is a number of seconds.
+        base (float): Delay in seconds after the first failure.
+        cap (float): Maximum delay in seconds.
+
+    Returns:
+        float: Seconds to wait.
+    """
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), cap)
+    delay = min(cap, base * (2 ** (attempt - 1)))
+    return random.uniform(delay / 2, delay)
+
+class RetryableStatus(Exception):
+    """Raised for a response status that should be retried."""
+
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+class AsyncCEQADownloader:
+    """
+    Download many CEQAnet agency exports concurrently while staying polite to the server:
+    a shared token bucket limits the request rate, a semaphore limits concurrent requests,
+    a byte budget caps the bytes in flight, and failed requests are retried with backoff.
+    """
+
+    def __init__(self, base_url=BASE_URL, rate=ASYNC_RATE_LIMIT, burst=ASYNC_RATE_BURST,
+                 max_concurrency=ASYNC_MAX_CONCURRENCY, max_in_flight_bytes=ASYNC_MAX_IN_FLIGHT_BYTES,
+                 timeout=ASYNC_REQUEST_TIMEOUT, max_retries=ASYNC_MAX_RETRIES, output_dir=".", in_memory=False):
+        """
+        Initialize the downloader.
+
+        Args:
+            base_url (str): The base URL for CEQA data.
+            rate (float): Sustained requests per second across all downloads.
+            burst (int): Requests allowed in a burst before the rate applies.
+            max_concurrency (int): Maximum number of requests open at once.
+            max_in_flight_bytes (int): Maximum response bytes being transferred at once.
+            timeout (float): Total seconds allowed for a single request, body included, not counting
+                the waits for the byte budget.
+            max_retries (int): Attempts per agency before giving up, at least 1.
+            output_dir (str): Directory where the CSV files are written.
+            in_memory (bool): Return each body as bytes instead of writing CSV files (default is False).
+        """
+        if max_retries < 1:
+            raise ValueError(f"max_retries must be at least 1, got {max_retries}.")
+        self.base_url = base_url
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.output_dir = output_dir
+        self.in_memory = in_memory
+
+    async def _fetch_once(self, session, url, file_name, bucket, budget):
+        """
+        Make one request. Returns the body as bytes in in-memory mode, otherwise None.
+
+        The timeout covers the request and the transfer of the body, but not the time spent
+        waiting for the byte budget: the first chunk is reserved before the request is sent,
+        and every wait for a later one moves the deadline back by as long. A body returned in
+        memory keeps its bytes of the budget; the caller gives them back once it is handed over.
+        """
+        await bucket.acquire()
+        loop = asyncio.get_running_loop()
+        waited = await budget.acquire(DOWNLOAD_CHUNK_SIZE)
+        reserved = DOWNLOAD_CHUNK_SIZE
+        deadline = loop.time() + self.timeout
+        waited = 0  # Already behind us: the deadline starts after it
+
+        def timed(awaitable):
+            return asyncio.wait_for(awaitable, max(0, deadline - loop.time()))
+
+        try:
+            async with await timed(session.get(url)) as response:
+                if response.status in RETRY_STATUSES:
+                    raise RetryableStatus(response.status, response.headers.get('Retry-After'))
+                response.raise_for_status()
+
+                # The first reservation is the read buffer. In memory, every byte read is then held
+                # until the end; on disk, a chunk is written before the next one is read
+                chunks = []
+                file = None if self.in_memory else open(file_name, 'wb')
+                try:
+                    while True:
+                        chunk = await timed(response.content.read(DOWNLOAD_CHUNK_SIZE))
+                        if not chunk:
+                            break
+                        if self.in_memory:
+                            chunks.append(chunk)
+                            waited = await budget.acquire(len(chunk), held=reserved)
+                            reserved += len(chunk)
+                        else:
+                            file.write(chunk)
+                        deadline += waited
+                        waited = 0
+                finally:
+                    if file is not None:
+                        file.close()
+                if not self.in_memory:
+                    return None
+                data = b''.join(chunks)
+                reserved -= len(data)
+                return data
+        finally:
+            await budget.release(reserved)
+
+    async def _fetch(self, session, city_name, bucket, budget, semaphore):
+        url = build_download_url(city_name, self.base_url)
+        file_name = os.path.join(self.output_dir, f"{city_name}_ceqa.csv")
+
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                # The semaphore is only held by running requests, not by those waiting to retry
+                async with semaphore:
+                    logging.debug(f"Downloading CSV from URL: {url} (attempt {attempt})")
+                    data = await self._fetch_once(session, url, file_name, bucket, budget)
+                if self.in_memory:
+                    logging.info(f"CSV for {city_name} downloaded into memory ({len(data)} bytes)")
+                    return data
+                logging.info(f"CSV downloaded and saved locally as {file_name}")
+                return file_name
+            except (RetryableStatus, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                    asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    logging.error(f"Giving up on {city_name} after {attempt} attempts: {e}")
+                    if not self.in_memory and os.path.exists(file_name):
+                        cleanup_local_file(file_name)
+                    raise
+                delay = backoff_delay(attempt, getattr(e, 'retry_after', None))
+                logging.warning(f"Download for {city_name} failed ({e!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def download_each(self, cities, deliver):
+        """
+        Download the exports for all cities concurrently, handing each one over as soon as it is complete.
+
+        In in-memory mode a body keeps its bytes of the byte budget until deliver returns, so the
+        bodies downloaded but not taken yet count against max_in_flight_bytes like those in transfer.
+
+        Args:
+            cities (list): List of city names to download.
+            deliver (callable): Coroutine function called with the city name and its local CSV path
+                (or bytes in in-memory mode), or the exception that stopped it.
+        """
+        bucket = TokenBucket(self.rate, self.burst)
+        budget = ByteBudget(self.max_in_flight_bytes)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        # Requests are timed by _fetch_once, which leaves out the waits for the byte budget
+        timeout = aiohttp.ClientTimeout(total=None)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+
+        async def download(city):
+            try:
+                result = await self._fetch(session, city, bucket, budget, semaphore)
+            except Exception as e:
+                result = e
+            try:
+                await deliver(city, result)
+            finally:
+                if isinstance(result, bytes):
+                    await budget.release(len(result))
+
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            await asyncio.gather(*(download(city) for city in cities))
+
+    async def download_many(self, cities):
+        """
+        Download the exports for all cities concurrently.
+
+        Args:
+            cities (list): List of city names to download.
+
+        Returns:
+            dict: City name mapped to the local CSV path (or bytes in in-memory mode),
+                or to the exception that stopped it.
+        """
+        results = {}
+
+        async def collect(city, result):
+            results[city] = result
+
+        await self.download_each(cities, collect)
+        return {city: results[city] for city in cities}
+
+def download_csvs(cities, base_url=BASE_URL, **kwargs):
+    """
+    Download the CSV exports for many cities concurrently from synchronous code.
+
+    Args:
+        cities (list): List of city names to download.
+        base_url (str): The base URL for CEQA data.
+        **kwargs: Extra settings passed to AsyncCEQADownloader.
+
+    Returns:
+        dict: City name mapped to the local CSV path (or bytes in in-memory mode),
+            or to the exception that stopped it.
+    """
+    downloader = AsyncCEQADownloader(base_url=base_url, **kwargs)
+    return asyncio.run(downloader.download_many(list(cities)))
+
+_DONE = object()
+
+def stream_csvs(cities, base_url=BASE_URL, **kwargs):
+    """
+    Download the CSV exports for many cities concurrently from synchronous code, yielding each one
+    as soon as it is complete, so the first ones can be processed while the others download.
+
+    The downloads run on an event loop in a background thread. In in-memory mode a body keeps its
+    bytes of the byte budget until it is taken from the generator, so max_in_flight_bytes also caps
+    the bodies waiting for the caller. Closing the generator early cancels the downloads left.
+
+    Args:
+        cities (list): List of city names to download.
+        base_url (str): The base URL for CEQA data.
+        **kwargs: Extra settings passed to AsyncCEQADownloader.
+
+    Yields:
+        tuple: City name and its local CSV path (or bytes in in-memory mode), or the exception
+            that stopped it, in order of completion.
+    """
+    downloader = AsyncCEQADownloader(base_url=base_url, **kwargs)
+    loop = asyncio.new_event_loop()
+    ready = queue.Queue()
+
+    async def deliver(city, result):
+        # Wait for the caller to take the download, which keeps its bytes until then
+        taken = loop.create_future()
+        ready.put((city, result, taken))
+        await taken
+
+    def run(downloads):
+        try:
+            loop.run_until_complete(downloads)
+        except BaseException:
+            pass  # Raised to the caller from the task itself
+
+    downloads = loop.create_task(downloader.download_each(list(cities), deliver))
+    downloads.add_done_callback(lambda _: ready.put(_DONE))
+    thread = threading.Thread(target=run, args=(downloads,), name="async-download", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is _DONE:
+                break
+            city, result, taken = item
+            loop.call_soon_threadsafe(taken.set_result, None)
+            yield city, result
+    finally:
+        if thread.is_alive():
+            loop.call_soon_threadsafe(downloads.cancel)
+        thread.join()
+        loop.close()
+    downloads.result()
@@ -0,0 +1,164 @@
+import os
+import shutil
+import logging
+import threading
+from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ResourceNotFoundError
+from const import BLOB_MAX_CONCURRENCY, BLOB_BLOCK_SIZE, BLOB_SINGLE_PUT_SIZE, BLOB_CHUNK_GET_SIZE, LOCAL_BLOB_DIR
+
+class AzureBlobStore:
+    """
+    Blob storage backed by an Azure container. The container client is created once and
+    reused, and large files are transferred in blocks with bounded parallelism.
+
+    Also works against the Azurite emulator with a development connection string
+    (e.g. 'UseDevelopmentStorage=true').
+    """
+
+    def __init__(self, connection_string=None, container_name=None, max_concurrency=BLOB_MAX_CONCURRENCY):
+        """
+        Initialize the store and its container client.
+
+        Args:
+            connection_string (str): Azure Storage connection string. Defaults to AZURE_STORAGE_CONNECTION_STRING.
+            container_name (str): Name of the container. Defaults to AZURE_CONTAINER_NAME.
+            max_concurrency (int): Parallel connections used for a single upload or download.
+        """
+        connection_string = connection_string or os.getenv('AZURE_STORAGE_CONNECTION_STRING')
+        self.container_name = container_name or os.getenv('AZURE_CONTAINER_NAME')
+        self.max_concurrency = max_concurrency
+
+        service_client = BlobServiceClient.from_connection_string(
+            connection_string,
+            max_block_size=BLOB_BLOCK_SIZE,
+            max_single_put_size=BLOB_SINGLE_PUT_SIZE,
+            max_chunk_get_size=BLOB_CHUNK_GET_SIZE,
+        )
+        self.container_client = service_client.get_container_client(self.container_name)
+        logging.debug(f"Created Azure container client for {self.container_name}")
+
+    def upload_file(self, blob_name, file_name):
+        """Upload a local file, overwriting any existing blob of the same name."""
+        with open(file_name, "rb") as data:
+            self.container_client.upload_blob(blob_name, data, overwrite=True, max_concurrency=self.max_concurrency)
+
+    def upload_bytes(self, blob_name, data):
+        """Upload an in-memory buffer, overwriting any existing blob of the same name."""
+        self.container_client.upload_blob(blob_name, data, overwrite=True, max_concurrency=self.max_concurrency)
+
+    def download_file(self, blob_name, file_name):
+        """Stream a blob into a local file without holding it in memory."""
+        with open(file_name, "wb") as download_file:
+            downloader = self.container_client.download_blob(blob_name, max_concurrency=self.max_concurrency)
+            downloader.readinto(download_file)
+
+    def download_bytes(self, blob_name):
+        """Return the content of a blob."""
+        return self.container_client.download_blob(blob_name, max_concurrency=self.max_concurrency).readall()
+
+    def delete(self, blob_name):
+        """Delete a blob."""
+        self.container_client.delete_blob(blob_name)
+
+    def exists(self, blob_name):
+        """Return True if the blob exists."""
+        return self.container_client.get_blob_client(blob_name).exists()
+
+class LocalBlobStore:
+    """
+    Blob storage kept in a local directory, with the same interface as AzureBlobStore.
+    Useful for tests and throughput measurements that must not touch the network.
+    """
+
+    def __init__(self, root=None):
+        """
+        Args:
+            root (str): Directory holding the blobs. Defaults to LOCAL_BLOB_DIR.
+        """
+        self.root = root or os.getenv('LOCAL_BLOB_DIR', LOCAL_BLOB_DIR)
+        self.container_name = self.root
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, blob_name):
+        path = os.path.join(self.root, blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _write(self, blob_name, write):
+        # Write next to the target and rename, so readers never see a partial blob
+        path = self._path(blob_name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            write(file)
+        os.replace(tmp_path, path)
+
+    def upload_file(self, blob_name, file_name):
+        """Copy a local file into the store."""
+        with open(file_name, "rb") as data:
+            self._write(blob_name, lambda file: shutil.copyfileobj(data, file))
+
+    def upload_bytes(self, blob_name, data):
+        """Write an in-memory buffer into the store."""
+        self._write(blob_name, lambda file: file.write(data))
+
+    def download_file(self, blob_name, file_name):
+        """Copy a blob into a local file."""
+        try:
+            shutil.copyfile(self._path(blob_name), file_name)
+        except FileNotFoundError:
+            raise ResourceNotFoundError(f"Blob {blob_name} not found in {self.root}")
+
+    def download_bytes(self, blob_name):
+        """Return the content of a blob."""
+        try:
+            with open(self._path(blob_name), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            raise ResourceNotFoundError(f"Blob {blob_name} not found in {self.root}")
+
+    def delete(self, blob_name):
+        """Delete a blob."""
+        try:
+            os.remove(self._path(blob_name))
+        except FileNotFoundError:
+            raise ResourceNotFoundError(f"Blob {blob_name} not found in {self.root}")
+
+    def exists(self, blob_name):
+        """Return True if the blob exists."""
+        return os.path.exists(os.path.join(self.root, blob_name))
+
+# One store per process, created on first use
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+def get_blob_store():
+    """
+    Return the process-wide blob store, selected by the BLOB_BACKEND environment
+    variable ('azure', the default, or 'local').
+
+    Returns:
+        AzureBlobStore or LocalBlobStore: The shared store.
+    """
+    global _blob_store
+    with _blob_store_lock:
+        if _blob_store is None:
+            backend = os.getenv('BLOB_BACKEND', 'azure').lower()
+            if backend == 'local':
+                _blob_store = LocalBlobStore()
+            elif backend == 'azure':
+                _blob_store = AzureBlobStore()
+            else:
+                raise ValueError(f"Unknown BLOB_BACKEND '{backend}', expected 'azure' or 'local'.")
+            logging.info(f"Using {backend} blob storage ({_blob_store.container_name})")
+        return _blob_store
+
+def set_blob_store(store):
+    """
+    Replace the process-wide blob store, e.g. with a LocalBlobStore in tests.
+
+    Args:
+        store (AzureBlobStore or LocalBlobStore): The store to use from now on.
+    """
+    global _blob_store
+    with _blob_store_lock:
+        _blob_store = store
@@ -1,6 +1,109 @@
 table_name = 'ceqa_data'
+
+# Table holding every expanded parcel of every filing, one (entry_id, parcel) row each
+PARCEL_TABLE = 'ceqa_parcels'
+
 BASE_URL = "https://ceqanet.opr.ca.gov/Search?LeadAgency="
 
+# HTTP download settings: (connect, read) timeout in seconds, pooled connections, bytes per streamed chunk
+HTTP_TIMEOUT = (10, 300)
+HTTP_POOL_SIZE = 10
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Async downloader settings: requests per second and burst, concurrent requests,
+# bytes transferred or held in memory at once, per-request timeout in seconds, and retry/backoff policy
+ASYNC_RATE_LIMIT = 2.0
+ASYNC_RATE_BURST = 4
+ASYNC_MAX_CONCURRENCY = 8
+ASYNC_MAX_IN_FLIGHT_BYTES = 256 * 1024 * 1024
+ASYNC_REQUEST_TIMEOUT = 300
+ASYNC_MAX_RETRIES = 5
+ASYNC_BACKOFF_BASE = 1.0
+ASYNC_BACKOFF_MAX = 60.0
+
+# Blob storage settings: parallel connections per transfer, block sizes for chunked transfers,
+# and the directory used when BLOB_BACKEND=local
+BLOB_MAX_CONCURRENCY = 4
+BLOB_BLOCK_SIZE = 4 * 1024 * 1024
+BLOB_SINGLE_PUT_SIZE = 8 * 1024 * 1024
+BLOB_CHUNK_GET_SIZE = 4 * 1024 * 1024
+LOCAL_BLOB_DIR = "local_blobs"
+
+# Raw export archive: blob prefix and compression ('gzip', or 'zstd' with the zstandard package)
+ARCHIVE_PREFIX = "archive"
+ARCHIVE_COMPRESSION = "gzip"
+
+# Number of distinct raw 'Location Parcel Number' strings memoized by the parcel expander, and the
+# longest expansion memoized: longer ones are rebuilt on each use, so the memo holds at most
+# PARCEL_CACHE_SIZE * PARCEL_CACHE_MAX_EXPANSION parcels (1.6 million, about 110 MB) across a run
+PARCEL_CACHE_SIZE = 100000
+PARCEL_CACHE_MAX_EXPANSION = 16
+
+# Widest 'to' / 'thru' range the parcel expander materializes. Suffixes have three digits, so a wider
+# range is malformed: it is left out of the expansion, the parcel table and the watchlist matches
+PARCEL_RANGE_MAX = 1000
+
+# Database pool settings: maximum and initial connections, and seconds of idleness after which
+# a pooled connection is pinged before reuse
+DB_POOL_SIZE = 4
+DB_POOL_MIN_SIZE = 1
+DB_POOL_PING_AFTER = 30
+
+# Agencies with fewer rows than GROUP_MAX_ROWS can be loaded together, GROUP_MAX_AGENCIES per transaction
+GROUP_MAX_ROWS = 500
+GROUP_MAX_AGENCIES = 10
+
+# Delta mode: content hash of every loaded filing, latest 'Received' date loaded per agency,
+# and the days before that date that are re-read to catch amended filings
+ROW_HASH_TABLE = 'ceqa_row_hashes'
+WATERMARK_TABLE = 'ceqa_agency_watermarks'
+DELTA_LOOKBACK_DAYS = 90
+
+# Chunked loads: rows per chunk, how much larger a chunk grows in memory once transformed than
+# once parsed, and rows read to estimate the parsed size of a row for a memory budget
+CHUNK_ROWS = 50000
+CHUNK_MEMORY_FACTOR = 4
+CHUNK_PROBE_ROWS = 1000
+
+# Raw export snapshots for offline replays: local directory and Parquet compression codec
+SNAPSHOT_DIR = "snapshots"
+SNAPSHOT_COMPRESSION = "zstd"
+
+# CSV report the APN watchlist matches are appended to after each load
+WATCHLIST_REPORT_PATH = "watchlist_matches.csv"
+
+# File remembering the ETag / Last-Modified / content hash of the last processed export per agency
+FETCH_STATE_PATH = "fetch_state.json"
+
+# Run metrics: log level of the entry points, table receiving the per-stage metrics of every run,
+# and where the opt-in profiler writes the profiles of the slowest agencies
+LOG_LEVEL = "INFO"
+INGESTION_RUNS_TABLE = 'ingestion_runs'
+PROFILE_DIR = "profiles"
+PROFILE_TOP_AGENCIES = 5
+
+# Job ledger of run_for_cities: 'sqlite' keeps it in LEDGER_PATH, 'postgres' in LEDGER_TABLE of the database.
+# A run resumes the unfinished batch of the same agencies started less than LEDGER_RESUME_HOURS ago, so a
+# rerun after a crash only processes the agencies not done yet. A failed agency is retried by a later run once
+# LEDGER_RETRY_BASE_SECONDS have passed, doubling after each failure up to LEDGER_RETRY_MAX_SECONDS,
+# and given up after LEDGER_MAX_ATTEMPTS failures
+LEDGER_BACKEND = 'sqlite'
+LEDGER_PATH = "job_ledger.sqlite"
+LEDGER_TABLE = 'ingestion_jobs'
+LEDGER_RESUME_HOURS = 20
+LEDGER_RETRY_BASE_SECONDS = 300
+LEDGER_RETRY_MAX_SECONDS = 6 * 3600
+LEDGER_MAX_ATTEMPTS = 5
+
+# Shared work queue of the worker mode, where processes on several machines claim agencies from the
+# database. A claim is a lease of WORK_QUEUE_LEASE_SECONDS, renewed every WORK_QUEUE_HEARTBEAT_SECONDS
+# while the worker is alive; the agencies of an expired lease are claimed again by another worker.
+# Failed agencies are retried on the schedule of the ledger above
+WORK_QUEUE_TABLE = 'agency_queue'
+WORK_QUEUE_LEASE_SECONDS = 600
+WORK_QUEUE_HEARTBEAT_SECONDS = 60
+WORK_QUEUE_CLAIM_SIZE = 4
+
 # Query to create table
 # Query to create table
 INSERT_QUERY = f"""
@@ -75,6 +178,80 @@ DO UPDATE SET
     document_type_details = EXCLUDED.document_type_details;
 """
 
+# Database columns in the order of INSERT_QUERY and of the rows built by the pipeline
+INSERT_COLUMNS = [
+    'entry_id', 'sch_number', 'lead_agency_title', 'document_title', 'document_type', 'received',
+    'posted', 'document_description', 'cities', 'counties', 'location_cross_streets',
+    'location_total_acres', 'noc_project_issues', 'noc_public_review_start_date',
+    'noc_public_review_end_date', 'noe_exempt_status', 'noe_exempt_citation',
+    'noe_reasons_for_exemption', 'nod_agency', 'nod_approved_by_lead_agency', 'nod_approved_date',
+    'nod_significant_environmental_impact', 'nod_environmental_impact_report_prepared',
+    'nod_negative_declaration_prepared', 'nod_other_document_type', 'nod_mitigation_measures',
+    'nod_mitigation_reporting_or_monitoring_plan', 'nod_statement_of_overriding_considerations_adopted',
+    'nod_findings_made_pursuant', 'nod_final_eir_available_location', 'date_gathered',
+    'location_parcel_number', 'document_type_details'
+]
+
+# entry_id of a filing: SCH number * ENTRY_ID_DATE_FACTOR + YYYYMMDD of its 'received' date, as a BIGINT.
+# SCH numbers must stay below MAX_SCH_NUMBER for the key to fit in 64 bits
+ENTRY_ID_DATE_FACTOR = 10 ** 8
+MAX_SCH_NUMBER = (2 ** 63 - 1) // ENTRY_ID_DATE_FACTOR
+
+# Declared type of every column of ceqa_data, in the order of INSERT_COLUMNS: (SQL type, maximum length).
+# The length only applies to VARCHAR columns
+COLUMN_SPECS = {
+    'entry_id': ('BIGINT', None),
+    'sch_number': ('VARCHAR', 16),
+    'lead_agency_title': ('VARCHAR', 255),
+    'document_title': ('TEXT', None),
+    'document_type': ('VARCHAR', 8),
+    'received': ('DATE', None),
+    'posted': ('DATE', None),
+    'document_description': ('TEXT', None),
+    'cities': ('TEXT', None),
+    'counties': ('TEXT', None),
+    'location_cross_streets': ('TEXT', None),
+    'location_total_acres': ('NUMERIC', None),
+    'noc_project_issues': ('TEXT', None),
+    'noc_public_review_start_date': ('DATE', None),
+    'noc_public_review_end_date': ('DATE', None),
+    'noe_exempt_status': ('VARCHAR', 64),
+    'noe_exempt_citation': ('TEXT', None),
+    'noe_reasons_for_exemption': ('TEXT', None),
+    'nod_agency': ('TEXT', None),
+    'nod_approved_by_lead_agency': ('BOOLEAN', None),
+    'nod_approved_date': ('DATE', None),
+    'nod_significant_environmental_impact': ('BOOLEAN', None),
+    'nod_environmental_impact_report_prepared': ('BOOLEAN', None),
+    'nod_negative_declaration_prepared': ('BOOLEAN', None),
+    'nod_other_document_type': ('TEXT', None),
+    'nod_mitigation_measures': ('BOOLEAN', None),
+    'nod_mitigation_reporting_or_monitoring_plan': ('BOOLEAN', None),
+    'nod_statement_of_overriding_considerations_adopted': ('BOOLEAN', None),
+    'nod_findings_made_pursuant': ('BOOLEAN', None),
+    'nod_final_eir_available_location': ('TEXT', None),
+    'date_gathered': ('DATE', None),
+    'location_parcel_number': ('VARCHAR', 50),
+    'document_type_details': ('VARCHAR', 64),
+}
+
+# What the pipeline does with a value longer than the width of its VARCHAR column: 'truncate' cuts it,
+# as the conversion of existing tables does, 'reject' leaves the whole filing out of the load
+WIDTH_POLICY = 'truncate'
+
+# Optional range partitioning of ceqa_data by 'received': 'year' or 'month' partitions, how many
+# partitions are kept created ahead of today, and the blob prefix retired partitions are archived under
+PARTITION_INTERVAL = 'year'
+PARTITION_AHEAD = 1
+PARTITION_ARCHIVE_PREFIX = 'archive/partitions'
+
+# Table recording the schema migrations applied to the database
+MIGRATIONS_TABLE = 'schema_migrations'
+
+# Bulk loader: 'copy' streams rows into a staging table with COPY, 'insert' uses INSERT_QUERY
+LOADER_METHOD = 'copy'
+INSERT_PAGE_SIZE = 1000
+
 
 # List of columns to keep
 KEEPS = [
@@ -91,6 +268,19 @@ KEEPS = [
         'NOD Findings Made Pursuant', 'NOD Final EIR Available Location'
     ]
 
+# Columns of KEEPS with few distinct values, parsed as categoricals; the others are parsed as strings
+CATEGORY_COLUMNS = [
+        'Lead Agency Title', 'Document Type', 'Counties', 'NOE Exempt Status',
+        'NOD Approved By Lead Agency', 'NOD Significant Environmental Impact',
+        'NOD Environmental Impact Report Prepared', 'NOD Negative Declaration Prepared',
+        'NOD Mitigation Measures', 'NOD Mitigation Reporting Or Monitoring Plan',
+        'NOD Statement Of Overriding Considerations Adopted', 'NOD Findings Made Pursuant'
+    ]
+
+# Encoding of the CEQAnet exports, and the CSV parser: 'pyarrow', 'c', or 'auto' for pyarrow when installed
+CSV_ENCODING = "ISO-8859-1"
+CSV_ENGINE = "auto"
+
 cities = ["Lancaster, City of", "Los Angeles, City of", "San Diego, City of"]
 
 DOCUMENT_TYPE = {
@@ -1,34 +1,86 @@
+import io
 import os 
+import time
 import logging
+import threading
+from datetime import datetime
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-from psycopg2.extras import execute_values
-from utils import db_connection, reorder_filtered_columns, split_received_date, generate_entry_id_and_date_gathered, download_csv, upload_to_blob, delete_from_blob, cleanup_local_file, run_parcel_expansion
-from const import KEEPS, BASE_URL, INSERT_QUERY, DOCUMENT_TYPE
+from utils import db_connection, reorder_filtered_columns, parse_received_date, generate_entry_id_and_date_gathered, drop_unkeyed_filings, download_csv, download_csv_bytes, cleanup_local_file, run_parcel_expansion
+from const import (INSERT_COLUMNS, KEEPS, BASE_URL, DOCUMENT_TYPE, WATCHLIST_REPORT_PATH, LOADER_METHOD, DELTA_LOOKBACK_DAYS, GROUP_MAX_AGENCIES,
+                   CHUNK_MEMORY_FACTOR, CHUNK_PROBE_ROWS, CSV_ENGINE, WIDTH_POLICY, WORK_QUEUE_CLAIM_SIZE)
+from pipeline import Stage, StagePipeline
+from blob_store import get_blob_store
+from parcel_index import build_parcel_rows, ensure_parcel_table, write_parcels
+from async_downloader import stream_csvs
+from loader import bulk_upsert, CONFLICT_COLUMNS, PARTITIONED_CONFLICT_COLUMNS
+from schema import to_db_types
+from reader import read_export, fill_missing
+from partitions import (partition_bounds, partition_name, ensure_partitions, ensure_future_partitions, list_partitions,
+                        retention_cutoff)
+from delta import (LoadStats, ensure_delta_tables, hash_rows, load_watermarks, filter_by_watermark,
+                   select_changed_rows, write_hashes, advance_watermark)
+from metrics import RunMetrics
+from validation import validate_widths
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+class AgencyJob:
+    """
+    State of a single city as it moves through the download, upload, transform and load stages.
+    """
+
+    def __init__(self, city, snapshot=None):
+        self.city = city
+        self.snapshot = snapshot  # Stored export replayed instead of a download
+        self.fetched_at = None
+        self.csv_file = None
+        self.data = None
+        self.fetch_result = None
+        self.result = None
+        self.upload_future = None
+        self.stats = None
 
-# Function to check for columns with values exceeding the specified length
-def check_column_lengths(df, max_length=50):
+    @property
+    def blob_name(self):
+        # Blobs are named after the local file, without its directory
+        if self.csv_file:
+            return os.path.basename(self.csv_file)
+        return f"{self.city}_ceqa.csv"
+
+class TransformResult:
     """
-    Check the maximum length of the values in each column of the DataFrame.
-    
-    Args:
-        df (pd.DataFrame): The DataFrame containing the columns to check.
-        max_length (int): The length limit to check for (default is 50).
-        
-    Returns:
-        dict: A dictionary of column names and their maximum value lengths.
+    Output of the transforms for one CSV: the rows for the UPSERT query and, when enabled,
+    the (entry_id, parcel) rows for the parcel table and the watchlist matches. In delta mode
+    it also holds the content hash of each row, the number of rows dropped by the agency
+    watermark and the latest 'Received' date of the export. widths reports the values found
+    over the width of their column, unkeyed counts the filings dropped for an SCH number
+    that is not a number, and retired those received before the retention cutoff of a
+    partitioned table.
     """
-    long_columns = {}
-    
-    for col in df.columns:
-        max_len = df[col].astype(str).map(len).max()
-        logging.debug(f"Max length of column {col}: {max_len}")
-        if max_len > max_length:
-            long_columns[col] = max_len
-    
-    return long_columns
+
+    def __init__(self, data_tuples, parcel_rows=None, watchlist_matches=None, row_hashes=None, skipped=0,
+                 latest_received=None, widths=None, unkeyed=0, retired=0):
+        self.data_tuples = data_tuples
+        self.parcel_rows = parcel_rows
+        self.watchlist_matches = watchlist_matches
+        self.row_hashes = row_hashes
+        self.skipped = skipped
+        self.latest_received = latest_received
+        self.widths = widths
+        self.unkeyed = unkeyed
+        self.retired = retired
+
+    def count_into(self, stats):
+        """Set the rows the transforms dropped or truncated on the LoadStats of their load, and return it."""
+        stats.skipped = self.skipped
+        stats.unkeyed = self.unkeyed
+        stats.retired = self.retired
+        if self.widths is not None:
+            stats.truncated = self.widths.truncated
+            stats.rejected = len(self.widths.rejected)
+        return stats
 
 class CEQADataProcessor:
     """
@@ -37,118 +89,977 @@ class CEQADataProcessor:
     and remove the file from the Blob storage after successful processing.
     """
     
-    def __init__(self, table_name):
+    def __init__(self, table_name, fetcher=None, blob_store=None, archive=None, in_memory=False, upload_workers=2,
+                 index_parcels=True, watchlist=None, watchlist_report=WATCHLIST_REPORT_PATH, loader=LOADER_METHOD,
+                 delta=False, lookback_days=DELTA_LOOKBACK_DAYS, db_pool=None, group_rows=0,
+                 group_size=GROUP_MAX_AGENCIES, typed=True, partitioned=False, chunk_rows=None, memory_budget=None,
+                 csv_engine=CSV_ENGINE, snapshots=None, base_url=BASE_URL, metrics=None, width_policy=WIDTH_POLICY,
+                 ledger=None):
         """
         Initialize the data processor with a specified database table.
         
         Args:
             table_name (str): The name of the table to insert the data into.
+            fetcher (CEQAFetcher): Optional conditional fetcher. When given, cities whose export
+                is unchanged since the last successful run are skipped entirely.
+            blob_store (AzureBlobStore or LocalBlobStore): Blob storage to use. Defaults to the
+                process-wide store selected by BLOB_BACKEND.
+            archive (ExportArchive): Optional archive. When given, each download is kept compressed
+                under its content hash instead of being uploaded as a temporary blob.
+            in_memory (bool): Keep each download in memory and parse it from there, with no local file.
+                The blob upload then runs in the background while the data is parsed (default is False).
+            upload_workers (int): Background threads uploading to blob storage in in-memory mode (default is 2).
+            index_parcels (bool): Also write every expanded parcel to the (entry_id, parcel) table,
+                in the same transaction as the upsert (default is True).
+            watchlist (WatchlistMatcher): Optional APN watchlist matched against every loaded filing.
+            watchlist_report (str): CSV file the watchlist matches are appended to once loaded.
+            loader (str): 'copy' to stream rows into a staging table with COPY and merge them with one
+                statement, falling back to INSERT_QUERY on failure, or 'insert' for INSERT_QUERY only.
+            delta (bool): Only send new or changed rows, found by comparing a content hash of each row
+                with the one stored at its last load, and skip the filings of an agency received before
+                its watermark minus lookback_days (default is False).
+            lookback_days (int): Days before the agency watermark still re-read in delta mode.
+            db_pool (DBPool): Optional connection pool. When given, every load borrows a connection
+                from it instead of opening and closing its own.
+            group_rows (int): Agencies with fewer rows than this are loaded together, in one transaction
+                per group_size agencies, each under its own savepoint so a failing agency is rolled back
+                alone. Requires run_for_cities; 0 turns grouping off (default is 0).
+            group_size (int): Maximum agencies per grouped transaction.
+            typed (bool): Send dates, numbers and Yes/No flags as their declared types (see schema.py)
+                with real NULLs instead of 'Unknown' placeholders, as the migrated schema expects. False
+                only suits a table that was never migrated, whose columns are all text (default is True).
+            partitioned (bool): ceqa_data is partitioned by 'received' (see partitions.py). Upserts then
+                conflict on (entry_id, received), and the partitions for the current and next periods
+                and for every date being loaded are created ahead of the load. Requires typed rows
+                (default is False).
+            chunk_rows (int): Read, transform and upsert each export chunk_rows rows at a time instead of
+                all at once, still in a single transaction. A filing repeated in a later chunk is dropped,
+                as the whole-file transforms keep the first row of each entry_id. Chunked exports are
+                never grouped (default is None, whole files).
+            memory_budget (int): Bytes a chunk may use once transformed. The chunk size is then estimated
+                from the first rows of each export; ignored when chunk_rows is given (default is None).
+            csv_engine (str): Parser of whole exports: 'pyarrow', 'c', or 'auto' for pyarrow when it is
+                installed. Chunks are always parsed by the C engine (default is CSV_ENGINE).
+            snapshots (SnapshotStore): Optional store keeping every raw download as a Parquet snapshot,
+                which replay can later transform and load again without fetching it.
+            base_url (str): The base URL the exports are downloaded from, e.g. a local stand-in of
+                CEQAnet; a fetcher keeps its own (default is BASE_URL).
+            metrics (RunMetrics): Collector of the timing, row-count and memory metrics of every stage
+                and transform step, per agency, with its outputs and optional profiler. A collector
+                without outputs is used by default, so self.metrics always holds the last run.
+            width_policy (str): What happens to a value longer than the width of its VARCHAR column:
+                'truncate' cuts it, 'reject' leaves its filing out of the load (see validation.py).
+                Either way the values are counted in the LoadStats and logged (default is WIDTH_POLICY).
+            ledger (JobLedger): Optional durable record of the stage reached by every agency of
+                run_for_cities. A restarted run then only processes the agencies not done yet, and
+                retries failed ones once their backoff has passed (see ledger.py).
         """
+        if partitioned and not typed:
+            raise ValueError("A partitioned table needs typed rows: partitions are routed by the 'received' date.")
         self.table_name = table_name
+        self.fetcher = fetcher
+        self._blob_store = blob_store
+        self.archive = archive
+        self.in_memory = in_memory
+        self.index_parcels = index_parcels
+        self.watchlist = watchlist
+        self.watchlist_report = watchlist_report
+        self.loader = loader
+        self.delta = delta
+        self.lookback_days = lookback_days
+        self.db_pool = db_pool
+        self.group_rows = group_rows
+        self.group_size = group_size
+        self.typed = typed
+        self.partitioned = partitioned
+        self.chunk_rows = chunk_rows
+        self.memory_budget = memory_budget
+        self._chunked = bool(chunk_rows or memory_budget)
+        self.csv_engine = csv_engine
+        self.snapshots = snapshots
+        self.base_url = base_url
+        self.metrics = metrics or RunMetrics()
+        self.width_policy = width_policy
+        self.ledger = ledger
+        self._conflict_columns = PARTITIONED_CONFLICT_COLUMNS if partitioned else CONFLICT_COLUMNS
+        self._partitions = set()
+        self._retention_cutoff = None
+        self._retention_loaded = False
+        self.run_report = {}
+        self._watermarks = None
+        self._group = []
+        self._group_done = []
+        self._group_lock = threading.Lock()
+        self._tables_ready = False
+        self._setup_lock = threading.Lock()
+        self._upload_executor = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix="upload") if in_memory else None
         logging.debug(f"CEQADataProcessor initialized with table {self.table_name}")
 
-    def process_csv(self, file_name):
+    def transform_csv(self, file_name, source_name=None, agency=None):
         """
-        Process a CSV file, clean the data, and insert it into the database using UPSERT.
+        Read a CSV file and clean the data into rows ready for the UPSERT query.
 
         Args:
-            file_name (str): The path to the file to process from Azure Blob Storage.
+            file_name (str or file-like): The path to the CSV file to transform, or a buffer holding it.
+            source_name (str): Name used in logs when reading from a buffer.
+            agency (str): Agency the export belongs to, whose watermark applies in delta mode.
+
+        Returns:
+            list: A list of tuples in the column order of INSERT_QUERY.
         """
-        logging.debug(f"Processing CSV file {file_name}")
-        connection = None
-        cursor = None  # Initialize cursor to None to handle errors correctly
+        return self._transform(file_name, source_name, agency).data_tuples
 
-        try:
+    def _transform(self, file_name, source_name=None, agency=None):
+        """Run the transforms of transform_csv and return a TransformResult."""
+        source_name = source_name or file_name
+        logging.debug(f"Transforming CSV file {source_name}")
 
-            """ METHODS FOR PROCESSING THE CSV FILE """
+        # Reading only the required columns of the CSV file, with their declared dtypes
+        with self.metrics.step(agency, 'transform', 'read') as metric:
+            df = read_export(file_name, engine=self.csv_engine)
+            metric['rows'] = len(df)
+        logging.info(f"Read {len(df)} rows from {source_name}")
+        return self._transform_frame(df, agency)
 
-            # Reading the CSV file
-            df = pd.read_csv(file_name, encoding="ISO-8859-1")
-            logging.info(f"Read {len(df)} rows from {file_name}")
+    def _transform_frame(self, df, agency=None):
+        """
+        Run the transforms on a DataFrame read from an export, or on one chunk of it.
+        Each step is recorded in self.metrics as a step of the 'transform' stage of the agency.
+        """
+        step = partial(self.metrics.step, agency, 'transform')
 
-            # Filter to keep only the required columns
-            df_filtered = df.loc[:, KEEPS]
-            logging.debug("Filtered dataframe to required columns")
+        # Filter to keep only the required columns, in order
+        df_filtered = df if list(df.columns) == KEEPS else df.loc[:, KEEPS]
+        logging.debug("Filtered dataframe to required columns")
 
-            # Replace null values with 'unknown'
-            df_filtered = df_filtered.fillna('Unknown')
+        # Replace null values with 'unknown', typed rows keep them as NULLs
+        if not self.typed:
+            with step('fill_missing'):
+                df_filtered = fill_missing(df_filtered, 'Unknown')
             logging.debug("Replaced NULL values with 'unknown'")
 
-            # Generate a unique entry_id by combining SCH Number
-            df_filtered = split_received_date(df_filtered, 'Received')
+        # Parse the received date, which the entry_id is built from
+        with step('parse_received_date') as metric:
+            df_filtered = parse_received_date(df_filtered, 'Received')
+            metric['rows'] = len(df_filtered)
+
+        # In delta mode, old history of the agency is not transformed again
+        skipped = 0
+        latest_received = None
+        if self.delta:
+            latest_received = df_filtered['Received'].max() if len(df_filtered) else None
+            df_filtered, skipped = filter_by_watermark(df_filtered, self._get_watermark(agency),
+                                                       lookback_days=self.lookback_days)
+            logging.debug(f"Skipped {skipped} rows older than the watermark of {agency}")
+
+        # Rows of retired partitions are not loaded again, nor are their partitions created again
+        retired = 0
+        if self.partitioned:
+            cutoff = self._get_retention_cutoff()
+            df_filtered, retired = filter_by_watermark(df_filtered, cutoff, lookback_days=0)
+            if retired:
+                logging.info(f"Left out {retired} rows of {agency or 'the export'} received before {cutoff}")
+
+        if df_filtered.empty and (self.delta or retired):
+            # Every filing is older than the watermark or retired, e.g. a whole chunk of old history
+            return self._empty_result(skipped=skipped, latest_received=latest_received, retired=retired)
 
-            # Generate entry_id and date_gathered
+        # Filings without a numeric SCH number have no entry_id: leave them out, counted, instead of failing the agency
+        with step('drop_unkeyed') as metric:
+            df_filtered, unkeyed = drop_unkeyed_filings(df_filtered)
+            metric['rows'] = unkeyed
+        if df_filtered.empty:
+            return self._empty_result(skipped=skipped, latest_received=latest_received, unkeyed=unkeyed,
+                                      retired=retired)
+
+        # Generate entry_id and date_gathered
+        with step('generate_entry_id'):
             df_filtered = generate_entry_id_and_date_gathered(df_filtered)
-            logging.debug(f"Generated entry_id successfully")
-            
-            # Expand parcel data and process it
+        logging.debug(f"Generated entry_id successfully")
+
+        # Keep every parcel of every filing for the parcel table, before the column is truncated
+        parcel_rows = None
+        if self.index_parcels:
+            with step('build_parcel_rows') as metric:
+                parcel_rows = build_parcel_rows(df_filtered['entry_id'], df_filtered['Location Parcel Number'])
+                metric['rows'] = len(parcel_rows)
+            logging.debug(f"Built {len(parcel_rows)} parcel rows")
+
+        # Match the raw parcels against the APN watchlist
+        watchlist_matches = None
+        if self.watchlist is not None:
+            with step('watchlist'):
+                watchlist_matches = self.watchlist.match_frame(df_filtered)
+        
+        # Expand parcel data and process it
+        with step('parcel_expansion'):
             df_expanded = run_parcel_expansion(df_filtered)
-            logging.debug("Expanded parcel data successfully")
+        logging.debug("Expanded parcel data successfully")
 
-            # map the dictionary to the document type column
-            df_expanded['Document Type Details'] = df_expanded['Document Type'].map(DOCUMENT_TYPE)
-            #logging.debug(f"Expanded columns: {df_expanded.columns}")
+        # map the dictionary to the document type column
+        df_expanded['Document Type Details'] = df_expanded['Document Type'].map(DOCUMENT_TYPE)
+        #logging.debug(f"Expanded columns: {df_expanded.columns}")
 
-            # Reorder the columns to fit the insert query
+        # Reorder the columns to fit the insert query
+        with step('reorder_columns') as metric:
             df_expanded = reorder_filtered_columns(df_expanded)
-            logging.debug("Reordered columns for insertion")
+            metric['rows'] = len(df_expanded)
+        logging.debug("Reordered columns for insertion")
+
+        # Check the text against the declared widths now, so an over-long value cannot fail a whole batch at load time
+        with step('validate_widths') as metric:
+            df_expanded, widths = validate_widths(df_expanded, self.width_policy)
+            metric['rows'] = widths.rows
+        if widths:
+            logging.warning(f"{agency or 'Export'}: {widths.summary()}")
+        if widths.rejected:
+            rejected = set(widths.rejected)
+            if parcel_rows is not None:
+                parcel_rows = [row for row in parcel_rows if row[0] not in rejected]
+            if watchlist_matches is not None:
+                watchlist_matches = watchlist_matches[~watchlist_matches['entry_id'].isin(rejected)]
 
-            # Convert the filtered DataFrame into a list of tuples for insertion
+        # Convert the columns to their database types
+        if self.typed:
+            with step('to_db_types'):
+                df_expanded = to_db_types(df_expanded)
+            logging.debug("Converted columns to their database types")
+
+        # Hash the rows as they will be stored, so unchanged filings are not sent again
+        row_hashes = None
+        if self.delta:
+            with step('hash_rows'):
+                row_hashes = hash_rows(df_expanded)
+
+        # Convert the filtered DataFrame into a list of tuples for insertion
+        with step('build_tuples') as metric:
             data_tuples = list(df_expanded.itertuples(index=False, name=None))
-            logging.debug(f"Prepared {len(data_tuples)} rows for insertion")
+            metric['rows'] = len(data_tuples)
+        logging.debug(f"Prepared {len(data_tuples)} rows for insertion")
+
+        return TransformResult(data_tuples, parcel_rows, watchlist_matches, row_hashes, skipped, latest_received, widths,
+                               unkeyed, retired)
 
-            # Establish database connection and insert data
-            connection = db_connection()
+    def _empty_result(self, **counts):
+        """TransformResult of a frame whose filings were all left out, with the counts of why."""
+        return TransformResult([], [] if self.index_parcels else None, None,
+                               np.empty(0, dtype=np.int64) if self.delta else None, **counts)
+
+    def upsert_rows(self, data_tuples, source, parcel_rows=None, row_hashes=None, agency=None, latest_received=None):
+        """
+        Insert rows into the database using UPSERT, in a single transaction.
+
+        Args:
+            data_tuples (list): Rows produced by transform_csv.
+            source (str): Name of the file the rows came from, used in logs.
+            parcel_rows (list): Optional (entry_id, parcel) rows replacing the parcels of these
+                filings in the parcel table, written in the same transaction.
+            row_hashes (np.ndarray): Content hash of each row. When given, only new or changed rows
+                are sent and the stored hashes are updated in the same transaction.
+            agency (str): Agency whose watermark is moved to latest_received once the rows are loaded.
+            latest_received (datetime): Latest 'Received' date of the export.
+
+        Returns:
+            LoadStats: Number of rows sent, and with row_hashes how many were inserted, updated or unchanged.
+        """
+        self._ensure_tables(parcels=parcel_rows is not None, delta=row_hashes is not None)
+        if self.partitioned:
+            self._ensure_partitions(data_tuples)
+
+        with self._connection() as connection:
             cursor = connection.cursor()
+            try:
+                stats = self._write_rows(cursor, data_tuples, parcel_rows, row_hashes, agency, latest_received)
+                connection.commit()
 
-            # UPSERT query execution using psycopg2's execute_values
-            insert_query = INSERT_QUERY
-            execute_values(cursor, insert_query, data_tuples)
-            connection.commit()
+                logging.info(f"Data from {source} successfully upserted: {stats}")
+                return stats
 
-            logging.info(f"Data from {file_name} successfully upserted.")
+            except Exception as e:
+                connection.rollback()  # Rollback transaction in case of error
+                logging.error(f"Error inserting data from {source}: {e}")
+                raise  # Re-raise the exception after logging it
 
+            finally:
+                cursor.close()
+
+    def _write_rows(self, cursor, data_tuples, parcel_rows=None, row_hashes=None, agency=None, latest_received=None):
+        """Write the rows of one export inside the caller's transaction and return its LoadStats."""
+        # Leave out the rows whose content hash is unchanged since their last load
+        stats = LoadStats(len(data_tuples))
+        if row_hashes is not None:
+            data_tuples, changed_hashes, stats = select_changed_rows(cursor, data_tuples, row_hashes)
+
+        # UPSERT through the staging table, or INSERT_QUERY with execute_values
+        if data_tuples:
+            bulk_upsert(cursor, data_tuples, self.loader, self._conflict_columns)
+
+        # Replace the parcels of the same filings in the parcel table
+        if parcel_rows is not None and data_tuples:
+            entry_ids = {row[0] for row in data_tuples}
+            if row_hashes is not None:
+                parcel_rows = [row for row in parcel_rows if row[0] in entry_ids]
+            write_parcels(cursor, entry_ids, parcel_rows)
+
+        if row_hashes is not None:
+            write_hashes(cursor, changed_hashes)
+            advance_watermark(cursor, agency, latest_received)
+        return stats
+
+    def process_csv(self, file_name, agency=None):
+        """
+        Process a CSV file, clean the data, and insert it into the database using UPSERT.
+
+        Args:
+            file_name (str): The path to the file to process from Azure Blob Storage.
+            agency (str): Agency the export belongs to, whose watermark applies in delta mode.
+
+        Returns:
+            LoadStats: Row counts of the load.
+        """
+        logging.debug(f"Processing CSV file {file_name}")
+        if self._chunked:
+            stats, result = self.metrics.call(agency, "load", self._load_chunks, file_name, file_name, agency,
+                                              rows=lambda output: output[0].rows)
+            self._report_watchlist_matches(result)
+            return stats
+
+        try:
+            result = self.metrics.call(agency, "transform", self._transform, file_name, None, agency,
+                                       rows=lambda result: len(result.data_tuples))
         except Exception as e:
-            if connection:
-                connection.rollback()  # Rollback transaction in case of error
-            logging.error(f"Error inserting data from {file_name}: {e}")
-            raise  # Re-raise the exception after logging it
+            logging.error(f"Error processing data from {file_name}: {e}")
+            raise
 
-        finally:
-            # Ensure that both cursor and connection are properly closed
-            if cursor:
+        stats = self.metrics.call(agency, "load", self._load_result, result, file_name, agency,
+                                  rows=lambda stats: stats.rows)
+        self._report_watchlist_matches(result)
+        return stats
+
+    def _load_result(self, result, source, agency):
+        """Upsert a TransformResult and return its LoadStats."""
+        stats = self.upsert_rows(result.data_tuples, source, result.parcel_rows, result.row_hashes,
+                                 agency, result.latest_received)
+        return result.count_into(stats)
+
+    def _load_chunks(self, source, source_name, agency):
+        """
+        Read, transform and upsert an export one chunk at a time, in a single transaction,
+        so only one chunk of it is ever held in memory.
+
+        Args:
+            source (str or file-like): The path to the CSV file, or a buffer holding it.
+            source_name (str): Name used in logs.
+            agency (str): Agency the export belongs to, whose watermark applies in delta mode.
+
+        Returns:
+            tuple: (LoadStats of the whole export, TransformResult holding only its watchlist matches).
+        """
+        chunk_rows = self._chunk_size(source)
+        self._ensure_tables(parcels=self.index_parcels, delta=self.delta)
+        if self.partitioned:
+            # Found ahead of the transaction, which must not wait on DDL halfway through
+            self._ensure_partition_starts(self._scan_partition_starts(source, chunk_rows))
+
+        stats = LoadStats()
+        matches = []
+        loaded = set()
+        chunks = 0
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            try:
+                with read_export(source, chunksize=chunk_rows) as reader:
+                    for chunk in reader:
+                        result = self._drop_loaded_entries(self._transform_frame(chunk, agency), loaded)
+                        chunk_stats = self._write_rows(cursor, result.data_tuples, result.parcel_rows,
+                                                       result.row_hashes, agency, result.latest_received)
+                        stats.add(result.count_into(chunk_stats))
+                        if result.watchlist_matches is not None:
+                            matches.append(result.watchlist_matches)
+                        chunks += 1
+                        logging.debug(f"Upserted chunk {chunks} of {source_name}: {chunk_stats}")
+                connection.commit()
+
+            except Exception as e:
+                connection.rollback()  # Nothing of the export is kept when one chunk fails
+                logging.error(f"Error inserting data from {source_name}: {e}")
+                raise
+
+            finally:
                 cursor.close()
-            if connection:
-                connection.close()
 
-    def run_for_cities(self, cities):
+        logging.info(f"Data from {source_name} successfully upserted in {chunks} chunks: {stats}")
+        watchlist_matches = pd.concat(matches, ignore_index=True) if matches else None
+        return stats, TransformResult([], watchlist_matches=watchlist_matches)
+
+    def _chunk_size(self, source):
+        """Rows per chunk: chunk_rows, or the rows of the first CHUNK_PROBE_ROWS that fit the memory budget."""
+        if self.chunk_rows:
+            return self.chunk_rows
+        sample = read_export(source, nrows=CHUNK_PROBE_ROWS)
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        row_bytes = sample.memory_usage(deep=True).sum() / max(len(sample), 1) * CHUNK_MEMORY_FACTOR
+        rows = max(int(self.memory_budget // max(row_bytes, 1)), 1)
+        logging.debug(f"Chunks of {rows} rows fit a memory budget of {self.memory_budget} bytes")
+        return rows
+
+    def _scan_partition_starts(self, source, chunk_rows):
+        """Return the first day of every partition an export loads into, reading only its 'Received' column."""
+        starts = set()
+        cutoff = self._get_retention_cutoff()
+        with read_export(source, columns=['Received'], chunksize=chunk_rows) as reader:
+            for chunk in reader:
+                received = pd.to_datetime(chunk['Received'], format='%m/%d/%Y', errors='coerce').dropna()
+                if cutoff is not None:
+                    received = received[received >= pd.Timestamp(cutoff)]
+                starts.update(partition_bounds(day)[0] for day in received.dt.date.unique())
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        return starts
+
+    @staticmethod
+    def _drop_loaded_entries(result, loaded):
+        """
+        Drop the filings of a chunk whose entry_id was loaded by an earlier chunk of the same export,
+        with their parcels, hashes and watchlist matches, and add the remaining ones to loaded.
+        """
+        repeated = {row[0] for row in result.data_tuples if row[0] in loaded}
+        if repeated:
+            keep = [row[0] not in repeated for row in result.data_tuples]
+            result.data_tuples = [row for row, kept in zip(result.data_tuples, keep) if kept]
+            if result.row_hashes is not None:
+                result.row_hashes = result.row_hashes[keep]
+            if result.parcel_rows is not None:
+                result.parcel_rows = [row for row in result.parcel_rows if row[0] not in repeated]
+            if result.watchlist_matches is not None:
+                result.watchlist_matches = result.watchlist_matches[
+                    ~result.watchlist_matches['entry_id'].isin(repeated)]
+            logging.debug(f"Dropped {len(keep) - len(result.data_tuples)} filings loaded by an earlier chunk")
+        loaded.update(row[0] for row in result.data_tuples)
+        return result
+
+    @contextmanager
+    def _connection(self):
+        """Borrow a connection from the pool, or open one that is closed afterwards."""
+        if self.db_pool is not None:
+            with self.db_pool.connection() as connection:
+                yield connection
+            return
+        connection = db_connection()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def _report_watchlist_matches(self, result):
+        # Only reported once the filings are in the database
+        if result.watchlist_matches is not None:
+            self.watchlist.append_report(result.watchlist_matches, self.watchlist_report)
+
+    def _ensure_tables(self, parcels=False, delta=False):
+        # Created once per processor, in their own transaction so concurrent loads never race on them
+        if not (parcels or delta or self.partitioned):
+            return
+        with self._setup_lock:
+            if self._tables_ready:
+                return
+            with self._connection() as connection:
+                with connection.cursor() as cursor:
+                    if self.index_parcels:
+                        ensure_parcel_table(cursor)
+                    if self.delta:
+                        ensure_delta_tables(cursor)
+                    if self.partitioned:
+                        ensure_future_partitions(cursor)
+                        self._partitions = {name for name, _, _ in list_partitions(cursor)}
+                connection.commit()
+            self._tables_ready = True
+
+    def _ensure_partitions(self, data_tuples):
+        # Created before the load in their own transaction, since creating a partition locks the whole table
+        position = INSERT_COLUMNS.index('received')
+        starts = {partition_bounds(row[position])[0] for row in data_tuples if row[position] is not None}
+        self._ensure_partition_starts(starts)
+
+    def _ensure_partition_starts(self, starts):
+        with self._setup_lock:
+            if {partition_name(start) for start in starts} <= self._partitions:
+                return
+            with self._connection() as connection:
+                with connection.cursor() as cursor:
+                    ensure_partitions(cursor, starts)
+                    self._partitions = {name for name, _, _ in list_partitions(cursor)}
+                connection.commit()
+
+    def _get_retention_cutoff(self):
+        # Read once per processor, the rows received before it belong to retired partitions
+        with self._setup_lock:
+            if not self._retention_loaded:
+                with self._connection() as connection:
+                    with connection.cursor() as cursor:
+                        self._retention_cutoff = retention_cutoff(cursor)
+                    connection.commit()
+                self._retention_loaded = True
+                if self._retention_cutoff is not None:
+                    logging.debug(f"Rows received before {self._retention_cutoff} are retired")
+        return self._retention_cutoff
+
+    def _get_watermark(self, agency):
+        # Watermarks are read once per processor; each agency is loaded at most once per run
+        if agency is None:
+            return None
+        with self._setup_lock:
+            if self._watermarks is None:
+                with self._connection() as connection:
+                    with connection.cursor() as cursor:
+                        ensure_delta_tables(cursor)
+                    connection.commit()
+                    self._watermarks = load_watermarks(connection)
+                    connection.commit()
+                logging.debug(f"Loaded watermarks of {len(self._watermarks)} agencies")
+        return self._watermarks.get(agency)
+
+    @property
+    def blob_store(self):
+        if self._blob_store is None:
+            self._blob_store = get_blob_store()
+        return self._blob_store
+
+    """ STAGES OF THE PER-CITY PIPELINE """
+
+    def _measured(self, stage, func):
+        """
+        Wrap a stage function so every call is recorded in self.metrics, see RunMetrics.call,
+        and the stage reached by the agency in the ledger.
+        """
+        def run(job):
+            if self.ledger is not None and job.snapshot is None:
+                self.ledger.stage(job.city, stage)
+            return self.metrics.call(job.city, stage, func, job, rows=partial(self._stage_rows, stage))
+        return run
+
+    def _stage_rows(self, stage, job):
+        # Rows a stage handed on: the rows built by the transforms, or those sent by the load
+        if stage == "transform" and job.result is not None:
+            return len(job.result.data_tuples)
+        if stage == "load" and job.stats is not None:
+            return job.stats.rows
+        if stage == "count":
+            return self.run_report.get(job.city, {}).get('rows')
+        return None
+
+    def _download_stage(self, job):
+        # Step 1: Download the CSV file
+        job.fetched_at = datetime.now()
+        if self.fetcher is not None:
+            job.fetch_result = self.fetcher.fetch(job.city, in_memory=self.in_memory)
+            if job.fetch_result is None:
+                # Unchanged export, nothing else to do for this city
+                if self.ledger is not None:
+                    self.ledger.done(job.city)
+                return None
+            job.csv_file = job.fetch_result.file_name
+            job.data = job.fetch_result.data
+            job.fetch_result.data = None
+        elif self.in_memory:
+            job.data = download_csv_bytes(job.city, self.base_url)
+        else:
+            job.csv_file = download_csv(job.city, self.base_url)
+        return job
+
+    def _upload_stage(self, job):
+        # Step 2: Upload the CSV file to Azure Blob Storage
+        sha256 = job.fetch_result.sha256 if job.fetch_result else None
+        if self.snapshots is not None:
+            self.snapshots.save(job.city, job.csv_file if job.data is None else job.data, job.fetched_at, sha256)
+
+        if self.archive is not None:
+            if job.data is not None:
+                self.archive.archive_bytes(job.city, job.data, sha256=sha256, fetched_at=job.fetched_at)
+            else:
+                self.archive.archive(job.city, job.csv_file, sha256=sha256, fetched_at=job.fetched_at)
+            return job
+
+        if job.data is not None:
+            self.blob_store.upload_bytes(job.blob_name, job.data)
+        else:
+            self.blob_store.upload_file(job.blob_name, job.csv_file)
+        logging.info(f"Uploaded {job.blob_name} to blob storage.")
+        return job
+
+    def _transform_stage(self, job):
+        # Step 3a: Clean the CSV into rows for the database
+        if job.data is None:
+            if not self._chunked:
+                job.result = self._transform(job.csv_file, agency=job.city)
+            return job
+
+        # In memory, the upload branches off the same buffer and runs while the data is parsed
+        job.upload_future = self._upload_executor.submit(self._measured("upload", self._upload_stage), job)
+        if self._chunked:
+            # Chunked exports are transformed chunk by chunk as they are loaded
+            return job
+        job.result = self._transform(io.BytesIO(job.data), source_name=job.blob_name, agency=job.city)
+        return job
+
+    def _load_stage(self, job):
+        # Wait for the background upload, so a failed upload fails the city before anything is written
+        if job.upload_future is not None:
+            job.upload_future.result()
+            job.upload_future = None
+
+        # Step 3b, chunked: transform and insert the rows one chunk at a time
+        if self._chunked and job.snapshot is None:
+            source = job.csv_file if job.data is None else io.BytesIO(job.data)
+            job.data = None
+            job.stats, job.result = self._load_chunks(source, job.blob_name, job.city)
+            self._finish_job(job)
+            return job
+        job.data = None
+
+        # Small agencies wait to be loaded in one transaction with others
+        if self.group_rows and len(job.result.data_tuples) < self.group_rows:
+            logging.debug(f"Queued {job.city} for a grouped load")
+            self._add_to_group(job)
+            return None
+
+        # Step 3b: Insert the rows into the database
+        job.stats = self._load_result(job.result, job.blob_name, job.city)
+        self._finish_job(job)
+        return job
+
+    def _finish_job(self, job):
+        """Steps following a successful load: reports, blob and local file cleanup, fetch state."""
+        self.run_report[job.city] = job.stats.as_dict()
+        self._report_watchlist_matches(job.result)
+        job.result = None
+
+        # Replayed snapshots have no blob, local file or fetch state
+        if job.snapshot is not None:
+            return
+
+        # Step 4: Remove the file from Azure Blob Storage, archived exports are kept
+        if self.archive is None:
+            self.blob_store.delete(job.blob_name)
+            logging.info(f"Successfully processed and deleted {job.blob_name} from Azure Blob Storage.")
+
+        # Step 5: Cleanup local file
+        if job.csv_file:
+            cleanup_local_file(job.csv_file)
+
+        # Step 6: Remember the export so an unchanged one is skipped next time
+        if self.fetcher is not None and job.fetch_result is not None:
+            self.fetcher.mark_processed(job.fetch_result)
+
+        # Step 7: Leave the city out of a resumed run
+        if self.ledger is not None:
+            self.ledger.done(job.city)
+
+    def _add_to_group(self, job):
+        # The job that fills the group loads it
+        with self._group_lock:
+            self._group.append(job)
+            if len(self._group) < self.group_size:
+                return
+            group, self._group = self._group, []
+        self._load_group(group)
+
+    def _flush_group(self):
+        """Load the agencies still waiting for a grouped load."""
+        with self._group_lock:
+            group, self._group = self._group, []
+        if group:
+            self._load_group(group)
+
+    def _load_group(self, jobs):
+        """
+        Load several small agencies in one transaction. Each agency is written under its own
+        savepoint, so one that fails is rolled back and reported alone while the others commit.
+        """
+        loaded = []
+        failed = []
+        try:
+            self._ensure_tables(parcels=self.index_parcels, delta=self.delta)
+            if self.partitioned:
+                self._ensure_partitions([row for job in jobs for row in job.result.data_tuples])
+
+            with self._connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    for job in jobs:
+                        result = job.result
+                        cursor.execute("SAVEPOINT agency_load")
+                        try:
+                            with self.metrics.step(job.city, "load", "group_write") as metric:
+                                job.stats = self._write_rows(cursor, result.data_tuples, result.parcel_rows,
+                                                             result.row_hashes, job.city, result.latest_received)
+                                metric['rows'] = job.stats.rows
+                        except Exception as e:
+                            cursor.execute("ROLLBACK TO SAVEPOINT agency_load")
+                            self._handle_failure(job, "load", e)
+                            failed.append(job)
+                            continue
+                        cursor.execute("RELEASE SAVEPOINT agency_load")
+                        result.count_into(job.stats)
+                        loaded.append(job)
+                    connection.commit()
+                except Exception:
+                    connection.rollback()
+                    raise
+                finally:
+                    cursor.close()
+        except Exception as e:
+            # Nothing of the group was committed
+            for job in jobs:
+                if job not in failed:
+                    self._handle_failure(job, "load", e)
+            return
+
+        logging.info(f"Loaded {len(loaded)} agencies in one transaction: {[job.city for job in loaded]}")
+        for job in loaded:
+            try:
+                self._finish_job(job)
+            except Exception as e:
+                self._handle_failure(job, "load", e)
+                continue
+            with self._group_lock:
+                self._group_done.append(job.city)
+
+    def _handle_failure(self, job, stage, error):
+        """Log a failed city and clean up whatever it left behind, without stopping the run."""
+        logging.error(f"Error processing data for {job.city} during {stage}: {error}")
+        if self.ledger is not None and job.snapshot is None:
+            self.ledger.fail(job.city, stage, error)
+        if job.upload_future is not None:
+            # Let a background upload finish so it does not race with the next run of this city
+            job.upload_future.exception()
+            job.upload_future = None
+        job.data = None
+        job.result = None
+        # Make sure to clean up the local file if it exists
+        if job.csv_file:
+            cleanup_local_file(job.csv_file)
+
+    def _snapshot_stage(self, job):
+        # Steps 1 to 3a of a replay: read the stored export instead of downloading it, and clean it
+        df = job.snapshot.read()
+        logging.info(f"Read {len(df)} rows from {job.snapshot}")
+        job.result = self._transform_frame(df, agency=job.city)
+        return job
+
+    def _count_stage(self, job):
+        # Last stage of a replay without load: only report the rows that would be loaded
+        self.run_report[job.city] = job.result.count_into(LoadStats(len(job.result.data_tuples))).as_dict()
+        self._report_watchlist_matches(job.result)
+        job.result = None
+        return job
+
+    def replay(self, snapshots, load=True, transform_workers=2, load_workers=1, queue_size=4):
+        """
+        Run the transforms, and the loads, over stored snapshots instead of fresh downloads.
+        Nothing is fetched, uploaded or deleted, so transform changes can be backfilled offline.
+
+        Exports are transformed in parallel and loaded in completion order, so an agency should
+        appear only once (see SnapshotStore.latest): an older export loaded after a newer one
+        would bring its filings back to their older state.
+
+        Args:
+            snapshots (list): Snapshot objects to replay.
+            load (bool): Upsert the rows as a normal run would; when False only the transforms run
+                and run_report holds the rows each agency would load (default is True).
+            transform_workers (int): Threads reading and cleaning snapshots (default is 2).
+            load_workers (int): Threads upserting into the database (default is 1).
+            queue_size (int): Maximum agencies waiting between two stages (default is 4).
+
+        Returns:
+            list: Names of the agencies replayed successfully. Their row counts are left in run_report.
+        """
+        self.run_report = {}
+        self._group_done = []
+        self.metrics.start()
+        stages = [
+            Stage("transform", self._measured("transform", self._snapshot_stage), transform_workers),
+            Stage("load", self._measured("load", self._load_stage), load_workers) if load
+            else Stage("count", self._measured("count", self._count_stage)),
+        ]
+        jobs = (AgencyJob(snapshot.agency, snapshot=snapshot) for snapshot in snapshots)
+        pipeline = StagePipeline(stages, queue_size=queue_size, on_error=self._handle_failure)
+        done = [job.city for job in pipeline.run(jobs)]
+        return self._end_run(done)
+
+    def _download_all(self, cities):
+        """
+        Download every city with the asyncio downloader and yield the jobs that succeeded as their
+        downloads complete, so the first cities are processed while the others are downloading.
+        In in-memory mode the bodies not taken yet count against ASYNC_MAX_IN_FLIGHT_BYTES.
+        """
+        start = time.perf_counter()
+        downloaded = 0
+        status = 'error'
+        try:
+            for city, result in stream_csvs(cities, self.base_url, in_memory=self.in_memory):
+                downloaded += 1
+                job = AgencyJob(city)
+                job.fetched_at = datetime.now()
+                if isinstance(result, Exception):
+                    self.metrics.record(city, "download", 0.0, status='error', error=str(result)[:1000])
+                    self._handle_failure(job, "download", result)
+                    continue
+                if self.in_memory:
+                    job.data = result
+                else:
+                    job.csv_file = result
+                yield job
+            status = 'ok'
+        finally:
+            # Spans the whole download, which overlaps the processing of the first cities
+            self.metrics.record(None, "download", time.perf_counter() - start, "async_download", status, downloaded)
+
+    def run_for_cities(self, cities, pipelined=False, download_workers=4, upload_workers=2,
+                       transform_workers=2, load_workers=1, queue_size=4, async_download=False):
         """
         Process data for multiple cities by downloading CSVs, uploading them to Azure Blob Storage, 
         processing them, and removing them from the blob storage if successful.
 
+        In pipelined mode the stages run concurrently in worker threads connected by bounded
+        queues, so the download of one city overlaps the parsing and loading of others.
+        A failure in any stage only affects that city.
+
+        With async_download, the exports are fetched concurrently by the asyncio downloader, which
+        rate limits and retries requests, and each one goes through the remaining stages as soon
+        as it is downloaded.
+        Conditional fetching through the fetcher does not apply to this mode.
+
         Args:
             cities (list): List of city names to process.
+            pipelined (bool): Run the stages concurrently instead of one city at a time (default is False).
+            download_workers (int): Threads downloading CSVs in pipelined mode (default is 4).
+            upload_workers (int): Threads uploading to Azure Blob Storage in pipelined mode (default is 2).
+                In in-memory mode the processor's own upload threads are used instead.
+            transform_workers (int): Threads cleaning CSVs in pipelined mode (default is 2).
+            load_workers (int): Threads upserting into the database in pipelined mode (default is 1).
+            queue_size (int): Maximum cities waiting between two stages in pipelined mode (default is 4).
+            async_download (bool): Download the exports with the asyncio downloader (default is False).
+
+        With a ledger, the run resumes the ledger's batch when it holds the same cities: cities already
+        done in it are skipped, and failed ones wait for their retry time.
+
+        Returns:
+            list: Names of the cities that were processed successfully. The row counts of each of them
+                are left in run_report, keyed by city.
         """
-        for city in cities:
-            logging.debug(f"Starting process for city: {city}")
+        self.run_report = {}
+        self._group_done = []
+        self.metrics.start()
+        if self.ledger is not None:
+            # Only the agencies not done in the batch being resumed, and failed ones due for a retry
+            cities = self.ledger.begin(cities, self.metrics.run_id)
+        stages = [
+            Stage("download", self._measured("download", self._download_stage), download_workers),
+            Stage("upload", self._measured("upload", self._upload_stage), upload_workers),
+            Stage("transform", self._measured("transform", self._transform_stage), transform_workers),
+            Stage("load", self._measured("load", self._load_stage), load_workers),
+        ]
+        if self.in_memory:
+            # The upload runs as a side branch of the transform stage
+            stages = [stage for stage in stages if stage.name != "upload"]
+        jobs = (AgencyJob(city) for city in cities)
+
+        if async_download:
+            stages = stages[1:]
+            jobs = self._download_all(cities)
+
+        if pipelined:
+            pipeline = StagePipeline(stages, queue_size=queue_size, on_error=self._handle_failure)
+            done = [job.city for job in pipeline.run(jobs)]
+            return self._end_run(done)
+
+        done = []
+        for job in jobs:
+            logging.debug(f"Starting process for city: {job.city}")
+            stage = None
             try:
-                # Step 1: Download the CSV file
-                csv_file = download_csv(city, BASE_URL)
-                
-                # Step 2: Upload the CSV file to Azure Blob Storage
-                upload_to_blob(csv_file)
-                
-                # Step 3: Process the CSV (Insert into the database)
-                self.process_csv(csv_file)
-
-                # Step 4: Remove the file from Azure Blob Storage
-                delete_from_blob(csv_file)
-                logging.info(f"Successfully processed and deleted {csv_file} from Azure Blob Storage.")
-                
-                # Step 5: Cleanup local file
-                cleanup_local_file(csv_file)
+                for stage in stages:
+                    if stage.func(job) is None:
+                        logging.info(f"No further stages for {job.city} after {stage.name}")
+                        break
+                else:
+                    done.append(job.city)
+            except Exception as e:
+                self._handle_failure(job, stage.name, e)
+        return self._end_run(done)
+
+    def run_worker(self, work_queue, claim_size=WORK_QUEUE_CLAIM_SIZE, wait_for_retries=False, **run_options):
+        """
+        Process agencies claimed from a queue shared with workers on other machines, until the batch
+        has none left to claim. Each claim goes through run_for_cities, with the queue in place of
+        the ledger: the stages reached, the agencies done and the failures are recorded in the queue,
+        and the leases of this worker are renewed in the background.
+
+        While other workers hold agencies, this one waits, so it takes them over if their lease
+        expires. Failed agencies waiting for their retry are left to a later worker, unless
+        wait_for_retries is set.
+
+        Args:
+            work_queue (AgencyQueue): The shared queue, see work_queue.py.
+            claim_size (int): Agencies claimed at a time (default is WORK_QUEUE_CLAIM_SIZE).
+            wait_for_retries (bool): Keep running until every queued agency was processed (default is False).
+            **run_options: Arguments for run_for_cities, e.g. pipelined=True.
 
+        Returns:
+            list: Names of the agencies this worker processed successfully.
+        """
+        ledger, self.ledger = self.ledger, work_queue
+        done = []
+        try:
+            with work_queue.heartbeats():
+                while True:
+                    cities = work_queue.claim(claim_size)
+                    if cities:
+                        done.extend(self.run_for_cities(cities, **run_options))
+                        continue
+                    pending = work_queue.pending()
+                    if not (pending['running'] or pending['expired'] or (wait_for_retries and pending['queued'])):
+                        break
+                    time.sleep(work_queue.heartbeat_seconds)
+        finally:
+            self.ledger = ledger
+        if pending['queued']:
+            logging.info(f"{pending['queued']} agencies wait for a retry, the first after "
+                         f"{pending['next_available_at']:%Y-%m-%d %H:%M:%S}")
+        logging.info(f"Worker {work_queue.worker} processed {len(done)} agencies of batch {work_queue.batch_id}")
+        return done
+
+    def _end_run(self, done):
+        """Load the agencies left in a partial group and report the run."""
+        self._flush_group()
+        done = done + self._group_done
+        self._log_run_report()
+        if self.ledger is not None and self.ledger.batch_id is not None:
+            try:
+                logging.info(f"Batch {self.ledger.batch_id}: {self.ledger.summary()}")
             except Exception as e:
-                logging.error(f"Error processing data for {city}: {e}")
-                # Make sure to clean up the local file if it exists
-                cleanup_local_file(csv_file)
\ No newline at end of file
+                logging.error(f"Could not read the job ledger: {e}")
+        self._publish_metrics(done)
+        return done
+
+    def _publish_metrics(self, done):
+        """Write the metrics of the run to the outputs of self.metrics; never fails the run."""
+        if not self.metrics.table:
+            self.metrics.finish(done)
+            return
+        try:
+            with self._connection() as connection:
+                self.metrics.finish(done, connection)
+        except Exception as e:
+            logging.error(f"Could not record the metrics of the run: {e}")
+
+    def _log_run_report(self):
+        """Log the row counts of every city loaded by the run, and their totals."""
+        totals = {}
+        for city, counts in self.run_report.items():
+            logging.info(f"{city}: {counts}")
+            for key, value in counts.items():
+                totals[key] = totals.get(key, 0) + value
+        logging.info(f"Run loaded {len(self.run_report)} cities: {totals}")
@@ -0,0 +1,154 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.pool import ThreadedConnectionPool
+from utils import db_connection_params
+from const import DB_POOL_SIZE, DB_POOL_MIN_SIZE, DB_POOL_PING_AFTER
+
+class DBPool:
+    """
+    Thread-safe pool of PostgreSQL connections shared by every agency of a run.
+
+    A connection is checked before it is handed out: closed connections are replaced,
+    and one that sat idle for longer than ping_after seconds must answer 'SELECT 1' first.
+    When every connection is in use, callers wait for one to be returned instead of failing.
+    """
+
+    def __init__(self, size=DB_POOL_SIZE, min_size=DB_POOL_MIN_SIZE, ping_after=DB_POOL_PING_AFTER, **connect_kwargs):
+        """
+        Args:
+            size (int): Maximum number of open connections.
+            min_size (int): Connections opened up front.
+            ping_after (float): Seconds of idleness after which a connection is pinged before reuse.
+            **connect_kwargs: Arguments for psycopg2.connect, read from the environment by default.
+        """
+        self.size = size
+        self.ping_after = ping_after
+        self._connect_kwargs = connect_kwargs or db_connection_params()
+        self._pool = ThreadedConnectionPool(min(min_size, size), size, **self._connect_kwargs)
+        self._slots = threading.BoundedSemaphore(size)
+        self._last_used = {}
+        self._lock = threading.Lock()
+        logging.debug(f"Created database pool with {size} connections")
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+        with self._lock:
+            last_used = self._last_used.get(id(connection))
+        if last_used is not None and time.monotonic() - last_used < self.ping_after:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error as e:
+            logging.warning(f"Discarding broken database connection: {e}")
+            return False
+
+    def _discard(self, connection):
+        with self._lock:
+            self._last_used.pop(id(connection), None)
+        self._pool.putconn(connection, close=True)
+
+    def getconn(self):
+        """
+        Check out a healthy connection, waiting while all of them are in use.
+
+        Returns:
+            connection: A psycopg2 connection, to be given back with putconn.
+        """
+        self._slots.acquire()
+        try:
+            # Every idle connection may be stale after a database restart, plus one new connection
+            for _ in range(self.size + 1):
+                connection = self._pool.getconn()
+                if self._is_healthy(connection):
+                    return connection
+                self._discard(connection)
+            raise psycopg2.OperationalError("No healthy database connection available")
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, connection, close=False):
+        """
+        Return a connection to the pool. An unfinished transaction is rolled back first.
+
+        Args:
+            connection: A connection from getconn.
+            close (bool): Close the connection instead of keeping it (default is False).
+        """
+        try:
+            if not close and not connection.closed and connection.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    close = True
+            if close or connection.closed:
+                self._discard(connection)
+            else:
+                with self._lock:
+                    self._last_used[id(connection)] = time.monotonic()
+                self._pool.putconn(connection)
+        finally:
+            self._slots.release()
+
+    def dedicated_connection(self):
+        """
+        Open a connection outside the pool, with the settings of the pooled ones, for a thread that
+        must never wait for a free connection, e.g. a heartbeat. The caller closes it.
+
+        Returns:
+            connection: A new psycopg2 connection.
+        """
+        return psycopg2.connect(**self._connect_kwargs)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a with block. Committing is up to the caller;
+        whatever is left uncommitted is rolled back when the block exits.
+        """
+        connection = self.getconn()
+        try:
+            yield connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # The connection itself may be broken, do not hand it out again
+            self.putconn(connection, close=True)
+            raise
+        except BaseException:
+            self.putconn(connection)
+            raise
+        else:
+            self.putconn(connection)
+
+    def closeall(self):
+        """Close every connection of the pool."""
+        self._pool.closeall()
+        with self._lock:
+            self._last_used.clear()
+        logging.debug("Closed database pool")
+
+# Pool shared by every processor of the process
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """
+    Return the process-wide database pool, created on first use.
+    Its size can be set with the DB_POOL_SIZE environment variable.
+
+    Returns:
+        DBPool: The shared pool.
+    """
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = DBPool(size=int(os.getenv('DB_POOL_SIZE', DB_POOL_SIZE)))
+        return _db_pool
@@ -0,0 +1,197 @@
+import logging
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from psycopg2.extras import execute_values
+from const import table_name, ROW_HASH_TABLE, WATERMARK_TABLE, DELTA_LOOKBACK_DAYS
+
+# Content hash of every loaded filing, and the latest 'Received' date loaded per agency
+CREATE_DELTA_TABLES = f"""
+CREATE TABLE IF NOT EXISTS public.{ROW_HASH_TABLE} (
+    entry_id BIGINT PRIMARY KEY,
+    row_hash BIGINT NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS public.{WATERMARK_TABLE} (
+    agency TEXT PRIMARY KEY,
+    received DATE NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT now()
+);
+"""
+
+# Existing filings of a batch with their stored hash; a filing missing from the result is new
+EXISTING_HASHES_QUERY = f"""
+SELECT d.entry_id, h.row_hash
+FROM public.{table_name} d
+LEFT JOIN public.{ROW_HASH_TABLE} h ON h.entry_id = d.entry_id
+WHERE d.entry_id = ANY(%s)
+"""
+
+UPSERT_HASHES_QUERY = f"""
+INSERT INTO public.{ROW_HASH_TABLE} (entry_id, row_hash) VALUES %s
+ON CONFLICT (entry_id) DO UPDATE SET row_hash = EXCLUDED.row_hash, updated_at = now()
+"""
+
+UPSERT_WATERMARK_QUERY = f"""
+INSERT INTO public.{WATERMARK_TABLE} (agency, received) VALUES (%s, %s)
+ON CONFLICT (agency) DO UPDATE SET
+    received = GREATEST({WATERMARK_TABLE}.received, EXCLUDED.received),
+    updated_at = now()
+"""
+
+# Columns left out of the content hash: date_gathered is stamped anew on every run
+UNHASHED_COLUMNS = ('date_gathered',)
+
+class LoadStats:
+    """
+    Row counts of one load. In delta mode every row is counted as inserted, updated or
+    unchanged; otherwise only the number of rows sent is known.
+    """
+
+    def __init__(self, rows=0, inserted=None, updated=None, unchanged=None, skipped=0, truncated=0, rejected=0,
+                 unkeyed=0, retired=0):
+        self.rows = rows
+        self.inserted = inserted
+        self.updated = updated
+        self.unchanged = unchanged
+        self.skipped = skipped  # Rows older than the agency watermark, dropped before the transforms
+        self.truncated = truncated  # Rows with a value cut to the width of its column
+        self.rejected = rejected  # Rows left out for a value over the width of its column
+        self.unkeyed = unkeyed  # Rows left out for an SCH number that cannot key an entry_id
+        self.retired = retired  # Rows received before the retention cutoff of a partitioned table
+
+    def add(self, other):
+        """Add the counts of another load, e.g. the next chunk of the same export, and return self."""
+        for key, value in vars(other).items():
+            total = getattr(self, key)
+            setattr(self, key, value if total is None else total if value is None else total + value)
+        return self
+
+    def as_dict(self):
+        return {key: value for key, value in vars(self).items() if value is not None}
+
+    def __repr__(self):
+        return f"LoadStats({', '.join(f'{key}={value}' for key, value in self.as_dict().items())})"
+
+def ensure_delta_tables(cursor):
+    """
+    Create the row hash and watermark tables if they do not exist.
+
+    Args:
+        cursor: A psycopg2 cursor.
+    """
+    cursor.execute(CREATE_DELTA_TABLES)
+    logging.debug(f"Ensured tables {ROW_HASH_TABLE} and {WATERMARK_TABLE} exist")
+
+def hash_rows(df, exclude=UNHASHED_COLUMNS):
+    """
+    Compute a stable 64-bit content hash of each row, vectorized.
+
+    The hash only depends on the values (pandas' fixed hash key), so the same filing
+    hashes the same from one run or process to the next.
+
+    Args:
+        df (pd.DataFrame): The rows in their final form, as sent to the database.
+        exclude (tuple): Columns that change on every run and are not part of the content.
+
+    Returns:
+        np.ndarray: One int64 hash per row, in row order.
+    """
+    columns = [column for column in df.columns if column not in exclude]
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy().view(np.int64)
+
+def load_watermarks(connection):
+    """
+    Read the latest 'Received' date loaded for every agency.
+
+    Args:
+        connection: A psycopg2 connection.
+
+    Returns:
+        dict: Agency name to datetime.date.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT agency, received FROM public.{WATERMARK_TABLE}")
+        return dict(cursor.fetchall())
+
+def filter_by_watermark(df, watermark, column='Received', lookback_days=DELTA_LOOKBACK_DAYS):
+    """
+    Drop the filings received before the agency watermark minus a lookback window.
+    The window lets late amendments of recent filings through.
+
+    Args:
+        df (pd.DataFrame): Filings with a parsed datetime column.
+        watermark (datetime.date): The agency watermark, or None to keep everything.
+        column (str): The parsed 'Received' column.
+        lookback_days (int): Days before the watermark that are still re-read.
+
+    Returns:
+        tuple: (the remaining filings, number of filings dropped).
+    """
+    if watermark is None:
+        return df, 0
+    cutoff = pd.Timestamp(watermark) - timedelta(days=lookback_days)
+    keep = df[column] >= cutoff
+    skipped = int((~keep).sum())
+    if skipped:
+        df = df.loc[keep]
+    return df, skipped
+
+def select_changed_rows(cursor, data_tuples, row_hashes):
+    """
+    Split a batch against the stored hashes, inside the caller's transaction.
+
+    Args:
+        cursor: A psycopg2 cursor.
+        data_tuples (list): Rows with entry_id first.
+        row_hashes (np.ndarray): The hash of each row, see hash_rows.
+
+    Returns:
+        tuple: (rows to send, their (entry_id, row_hash) pairs, LoadStats of the batch).
+    """
+    entry_ids = [row[0] for row in data_tuples]
+    cursor.execute(EXISTING_HASHES_QUERY, (entry_ids,))
+    existing = dict(cursor.fetchall())
+
+    changed_rows = []
+    changed_hashes = []
+    inserted = updated = 0
+    for row, row_hash in zip(data_tuples, row_hashes.tolist()):
+        entry_id = row[0]
+        if entry_id not in existing:
+            inserted += 1
+        elif existing[entry_id] != row_hash:
+            updated += 1
+        else:
+            continue
+        changed_rows.append(row)
+        changed_hashes.append((entry_id, row_hash))
+
+    stats = LoadStats(len(data_tuples), inserted, updated, len(data_tuples) - inserted - updated)
+    return changed_rows, changed_hashes, stats
+
+def write_hashes(cursor, hashes, page_size=1000):
+    """
+    Store the hashes of the rows just written, inside the caller's transaction.
+
+    Args:
+        cursor: A psycopg2 cursor.
+        hashes (list): (entry_id, row_hash) tuples.
+        page_size (int): Rows sent per INSERT statement.
+    """
+    if hashes:
+        execute_values(cursor, UPSERT_HASHES_QUERY, hashes, page_size=page_size)
+
+def advance_watermark(cursor, agency, received):
+    """
+    Move the agency watermark forward to the latest 'Received' date loaded; it never moves back.
+
+    Args:
+        cursor: A psycopg2 cursor.
+        agency (str): The agency name.
+        received (datetime.date or datetime.datetime): Latest 'Received' date of the batch.
+    """
+    if agency is None or received is None or pd.isna(received):
+        return
+    cursor.execute(UPSERT_WATERMARK_QUERY, (agency, received))
+    logging.debug(f"Watermark of {agency} is now at least {received}")
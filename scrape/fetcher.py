@@ -0,0 +1,144 @@
+import os
+import json
+import logging
+import threading
+from datetime import datetime
+from utils import get_http_session, build_download_url, stream_to_file, stream_to_bytes, cleanup_local_file
+from const import BASE_URL, HTTP_TIMEOUT, FETCH_STATE_PATH
+
+class FetchResult:
+    """
+    A downloaded agency export together with the validators needed to detect changes next time.
+    The export is either a local file (file_name) or an in-memory body (data).
+    """
+
+    def __init__(self, city, file_name, etag=None, last_modified=None, sha256=None, data=None):
+        self.city = city
+        self.file_name = file_name
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.sha256 = sha256
+
+class CEQAFetcher:
+    """
+    Download CEQAnet exports over a pooled keep-alive session, streaming them to disk,
+    and skip agencies whose export has not changed since it was last processed.
+
+    An export counts as unchanged when the server answers 304 to the stored ETag /
+    Last-Modified validators, or when the body hashes to the same SHA-256 as last time.
+    Validators are only saved by mark_processed, so an export that failed downstream
+    is downloaded and processed again on the next run.
+    """
+
+    def __init__(self, base_url=BASE_URL, state_path=None, timeout=HTTP_TIMEOUT):
+        """
+        Initialize the fetcher.
+
+        Args:
+            base_url (str): The base URL for CEQA data.
+            state_path (str): JSON file holding the validators per agency. Defaults to the
+                FETCH_STATE_PATH environment variable, then to const.FETCH_STATE_PATH.
+            timeout (tuple): (connect, read) timeout in seconds for each request.
+        """
+        self.base_url = base_url
+        self.state_path = state_path or os.getenv('FETCH_STATE_PATH', FETCH_STATE_PATH)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._state = self._load_state()
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable fetch state {self.state_path}: {e}")
+            return {}
+
+    def _save_state(self):
+        # Write to a temporary file first so a crash never leaves a half-written state file
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self._state, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def fetch(self, city_name, file_name=None, in_memory=False):
+        """
+        Download the export for a city unless it is unchanged since it was last processed.
+
+        Args:
+            city_name (str): The name of the city for which to download the data.
+            file_name (str): Local path for the CSV (default is '{city_name}_ceqa.csv').
+            in_memory (bool): Keep the body in memory instead of writing a local file (default is False).
+
+        Returns:
+            FetchResult: The downloaded export, or None when it has not changed.
+        """
+        download_url = build_download_url(city_name, self.base_url)
+        file_name = None if in_memory else (file_name or f"{city_name}_ceqa.csv")
+
+        with self._lock:
+            previous = dict(self._state.get(city_name, {}))
+
+        headers = {}
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
+
+        try:
+            logging.debug(f"Downloading CSV from URL: {download_url}")
+            with get_http_session().get(download_url, headers=headers, stream=True, timeout=self.timeout) as response:
+                if response.status_code == 304:
+                    logging.info(f"Export for {city_name} not modified since last run, skipping")
+                    return None
+                response.raise_for_status()
+                data = None
+                if in_memory:
+                    data, sha256 = stream_to_bytes(response)
+                else:
+                    sha256 = stream_to_file(response, file_name)
+                result = FetchResult(
+                    city_name,
+                    file_name,
+                    etag=response.headers.get('ETag'),
+                    last_modified=response.headers.get('Last-Modified'),
+                    sha256=sha256,
+                    data=data,
+                )
+        except Exception as e:
+            logging.error(f"Error downloading CSV for {city_name}: {e}")
+            if file_name and os.path.exists(file_name):
+                cleanup_local_file(file_name)
+            raise
+
+        if sha256 == previous.get('sha256'):
+            logging.info(f"Export for {city_name} has the same content hash as last run, skipping")
+            if file_name:
+                cleanup_local_file(file_name)
+            return None
+
+        if in_memory:
+            logging.info(f"CSV for {city_name} downloaded into memory ({len(data)} bytes)")
+        else:
+            logging.info(f"CSV downloaded and saved locally as {file_name}")
+        return result
+
+    def mark_processed(self, result):
+        """
+        Remember the validators of an export once it has been fully processed.
+
+        Args:
+            result (FetchResult): The export returned by fetch.
+        """
+        with self._lock:
+            self._state[result.city] = {
+                'etag': result.etag,
+                'last_modified': result.last_modified,
+                'sha256': result.sha256,
+                'processed_at': datetime.now().isoformat(timespec='seconds'),
+            }
+            self._save_state()
+        logging.debug(f"Saved fetch state for {result.city}")
@@ -0,0 +1,328 @@
+import os
+import sys
+import uuid
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from const import (LEDGER_BACKEND, LEDGER_PATH, LEDGER_TABLE, LEDGER_RESUME_HOURS, LEDGER_RETRY_BASE_SECONDS,
+                   LEDGER_RETRY_MAX_SECONDS, LEDGER_MAX_ATTEMPTS)
+
+# Status of an agency in a batch; pending, running and failed agencies are unfinished
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+ABANDONED = 'abandoned'
+UNFINISHED = (PENDING, RUNNING, FAILED)
+
+# One row per agency of a batch, the same statements in SQLite and Postgres
+CREATE_LEDGER_TABLE = """
+CREATE TABLE IF NOT EXISTS {table} (
+    batch_id TEXT NOT NULL,
+    batch_started_at TIMESTAMP NOT NULL,
+    agency TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP,
+    last_error TEXT,
+    run_id TEXT,
+    updated_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (batch_id, agency)
+)
+"""
+CREATE_LEDGER_INDEX = "CREATE INDEX IF NOT EXISTS {name}_started_at_idx ON {table} (batch_started_at)"
+
+LEDGER_COLUMNS = ('agency', 'status', 'stage', 'attempts', 'next_attempt_at', 'last_error', 'run_id', 'updated_at')
+
+class JobLedger:
+    """
+    Durable state of every agency of a batch, so that a run stopped by a crash, or one with failed
+    agencies, can be started again without redoing the agencies already loaded.
+
+    A batch is the list of agencies given to run_for_cities. While it has unfinished agencies, a later
+    run over the same agencies started less than resume_hours after the batch resumes it: done agencies
+    are skipped, pending ones and those left running by a crashed run are processed, and failed ones
+    are retried once their backoff has passed. Any other run starts a new batch. Every stage an agency
+    enters is recorded, and the error of the stage that failed. Loads are upserts, so an agency
+    processed again after a crash is loaded again safely.
+
+    The ledger is a local SQLite file by default, or a table of the Postgres database.
+    """
+
+    def __init__(self, backend=LEDGER_BACKEND, path=None, db_pool=None, table=LEDGER_TABLE,
+                 resume_hours=LEDGER_RESUME_HOURS, retry_base=LEDGER_RETRY_BASE_SECONDS,
+                 retry_max=LEDGER_RETRY_MAX_SECONDS, max_attempts=LEDGER_MAX_ATTEMPTS):
+        """
+        Args:
+            backend (str): 'sqlite' or 'postgres' (default is LEDGER_BACKEND).
+            path (str): SQLite file of the ledger (default is LEDGER_PATH).
+            db_pool (DBPool): Pool the Postgres ledger borrows its connections from; without one,
+                a connection is opened for every write.
+            table (str): Table holding the ledger (default is LEDGER_TABLE).
+            resume_hours (float): Age up to which a batch is resumed instead of a new one started.
+            retry_base (float): Seconds before a failed agency is retried, doubled after each failure.
+            retry_max (float): Longest wait before a retry, in seconds.
+            max_attempts (int): Failures after which an agency is abandoned until the next batch.
+        """
+        if backend not in ('sqlite', 'postgres'):
+            raise ValueError(f"Unknown ledger backend '{backend}', expected 'sqlite' or 'postgres'.")
+        self.backend = backend
+        self.path = path or LEDGER_PATH
+        self.db_pool = db_pool
+        self.table = table
+        self.resume_hours = resume_hours
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.max_attempts = max_attempts
+        self.batch_id = None
+        self.run_id = None
+        self._lock = threading.Lock()
+        self._sqlite = None
+        self._qualified = table if backend == 'sqlite' else f"public.{table}"
+        self._run([(CREATE_LEDGER_TABLE, ()), (CREATE_LEDGER_INDEX.replace('{name}', table), ())])
+
+    def __repr__(self):
+        where = self.path if self.backend == 'sqlite' else self._qualified
+        return f"JobLedger({self.backend}: {where})"
+
+    @contextmanager
+    def _connection(self):
+        if self.backend == 'sqlite':
+            # One connection shared by the pipeline threads, one statement at a time
+            with self._lock:
+                if self._sqlite is None:
+                    self._sqlite = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                    self._sqlite.execute("PRAGMA journal_mode=WAL")
+                yield self._sqlite
+            return
+        if self.db_pool is not None:
+            with self.db_pool.connection() as connection:
+                yield connection
+            return
+        from utils import db_connection
+        connection = db_connection()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def _run(self, statements):
+        """Execute (query, params) statements in one transaction and return the rows of the last one."""
+        rows = None
+        with self._connection() as connection:
+            cursor = connection.cursor()
+            try:
+                for query, params in statements:
+                    query = query.replace('{table}', self._qualified)
+                    if self.backend == 'sqlite':
+                        query = query.replace('%s', '?')
+                        params = [value.isoformat(sep=' ') if isinstance(value, datetime) else value
+                                  for value in params]
+                    cursor.execute(query, params)
+                    rows = cursor.fetchall() if cursor.description else None
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                cursor.close()
+        return rows
+
+    def _write(self, statements, agency):
+        # The ledger only follows the run: a failed write is logged and the agency carries on
+        try:
+            self._run(statements)
+        except Exception as e:
+            logging.error(f"Could not record the state of {agency} in the job ledger: {e}")
+
+    @staticmethod
+    def _timestamp(value):
+        # SQLite hands timestamps back as the ISO strings they were stored as
+        return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+    def _latest_batch(self):
+        rows = self._run([("SELECT batch_id, batch_started_at FROM {table} "
+                           "ORDER BY batch_started_at DESC LIMIT 1", ())])
+        if not rows:
+            return None, None
+        return rows[0][0], self._timestamp(rows[0][1])
+
+    def jobs(self, batch_id=None):
+        """
+        Return the state of every agency of a batch.
+
+        Args:
+            batch_id (str): The batch (default is the current one, or the latest one before begin).
+
+        Returns:
+            dict: Agency to a dict of the LEDGER_COLUMNS.
+        """
+        batch_id = batch_id or self.batch_id or self._latest_batch()[0]
+        rows = self._run([(f"SELECT {', '.join(LEDGER_COLUMNS)} FROM {{table}} WHERE batch_id = %s", (batch_id,))])
+        jobs = {}
+        for row in rows or []:
+            job = dict(zip(LEDGER_COLUMNS, row))
+            job['next_attempt_at'] = self._timestamp(job['next_attempt_at'])
+            job['updated_at'] = self._timestamp(job['updated_at'])
+            jobs[job['agency']] = job
+        return jobs
+
+    def begin(self, cities, run_id=None):
+        """
+        Start a run: resume the latest batch when it holds the same agencies, some of them unfinished,
+        and is recent enough; otherwise start a new batch of every agency.
+
+        Args:
+            cities (list): The agencies of the run.
+            run_id (str): Identifier of the run, recorded with the agencies it processes.
+
+        Returns:
+            list: The agencies to process now, in the given order.
+        """
+        cities = list(dict.fromkeys(cities))
+        now = datetime.now()
+        self.run_id = run_id or uuid.uuid4().hex
+        batch_id, started_at = self._latest_batch()
+        if batch_id is not None and now - started_at < timedelta(hours=self.resume_hours):
+            jobs = self.jobs(batch_id)
+            if set(jobs) == set(cities) and any(job['status'] in UNFINISHED for job in jobs.values()):
+                self.batch_id = batch_id
+                return self._resume(cities, jobs, started_at, now)
+
+        self.batch_id = f"{now:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        self._run([("INSERT INTO {table} (batch_id, batch_started_at, agency, status, updated_at) "
+                    "VALUES (%s, %s, %s, %s, %s)", (self.batch_id, now, city, PENDING, now)) for city in cities])
+        logging.info(f"Started batch {self.batch_id} of {len(cities)} agencies in {self!r}")
+        return cities
+
+    def _resume(self, cities, jobs, started_at, now):
+        due = []
+        waiting = []
+        for city in cities:
+            job = jobs[city]
+            if job['status'] == FAILED and job['next_attempt_at'] and job['next_attempt_at'] > now:
+                waiting.append(job['next_attempt_at'])
+            elif job['status'] in UNFINISHED:
+                due.append(city)
+        finished = len(cities) - len(due) - len(waiting)
+        message = (f"Resuming batch {self.batch_id} started at {started_at:%Y-%m-%d %H:%M}: {finished} agencies "
+                   f"finished, {len(due)} to process, {len(waiting)} waiting to be retried")
+        if waiting:
+            message += f", the first at {min(waiting):%H:%M:%S}"
+        logging.info(message)
+        return due
+
+    def retry_delay(self, attempts):
+        """Seconds before an agency that failed `attempts` times is retried."""
+        return min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+
+    def stage(self, agency, stage):
+        """Record that an agency entered a stage of the current run."""
+        if self.batch_id is None:
+            return
+        self._write([("UPDATE {table} SET status = %s, stage = %s, run_id = %s, updated_at = %s "
+                      "WHERE batch_id = %s AND agency = %s",
+                      (RUNNING, stage, self.run_id, datetime.now(), self.batch_id, agency))], agency)
+
+    def done(self, agency):
+        """Record that an agency was loaded, or had nothing to load."""
+        if self.batch_id is None:
+            return
+        self._write([("UPDATE {table} SET status = %s, next_attempt_at = NULL, last_error = NULL, run_id = %s, "
+                      "updated_at = %s WHERE batch_id = %s AND agency = %s",
+                      (DONE, self.run_id, datetime.now(), self.batch_id, agency))], agency)
+
+    def fail(self, agency, stage, error):
+        """
+        Record the failure of an agency in a stage and schedule its retry, or abandon it after
+        max_attempts failures.
+
+        Args:
+            agency (str): The agency.
+            stage (str): The stage that failed.
+            error (Exception or str): The error, stored as text.
+        """
+        if self.batch_id is None:
+            return
+        now = datetime.now()
+        try:
+            attempts = (self.jobs().get(agency) or {}).get('attempts', 0) + 1
+        except Exception as e:
+            logging.error(f"Could not read the state of {agency} from the job ledger: {e}")
+            return
+        if attempts >= self.max_attempts:
+            status, next_attempt_at = ABANDONED, None
+            logging.warning(f"Giving up on {agency} after {attempts} failed attempts in batch {self.batch_id}")
+        else:
+            status, next_attempt_at = FAILED, now + timedelta(seconds=self.retry_delay(attempts))
+            logging.info(f"{agency} will be retried after {next_attempt_at:%Y-%m-%d %H:%M:%S}")
+        self._write([("UPDATE {table} SET status = %s, stage = %s, attempts = %s, next_attempt_at = %s, "
+                      "last_error = %s, run_id = %s, updated_at = %s WHERE batch_id = %s AND agency = %s",
+                      (status, stage, attempts, next_attempt_at, str(error)[:1000], self.run_id, now,
+                       self.batch_id, agency))], agency)
+
+    def summary(self, batch_id=None):
+        """Return the number of agencies of a batch in each status (default is the current batch)."""
+        counts = {}
+        for job in self.jobs(batch_id).values():
+            counts[job['status']] = counts.get(job['status'], 0) + 1
+        return counts
+
+    def abandon(self):
+        """
+        Abandon the unfinished agencies of the latest batch, so the next run starts a new batch.
+
+        Returns:
+            int: The number of agencies abandoned.
+        """
+        batch_id = self.batch_id or self._latest_batch()[0]
+        if batch_id is None:
+            return 0
+        rows = self._run([("UPDATE {table} SET status = %s, next_attempt_at = NULL, updated_at = %s "
+                           "WHERE batch_id = %s AND status IN (%s, %s, %s) RETURNING agency",
+                           (ABANDONED, datetime.now(), batch_id) + UNFINISHED)])
+        return len(rows or [])
+
+    def close(self):
+        if self._sqlite is not None:
+            self._sqlite.close()
+            self._sqlite = None
+
+def get_job_ledger(db_pool=None):
+    """
+    Build the job ledger of a command-line run from the LEDGER_BACKEND ('sqlite' or 'postgres')
+    and LEDGER_PATH environment variables.
+
+    Args:
+        db_pool (DBPool): Pool used by the Postgres ledger.
+
+    Returns:
+        JobLedger: The ledger.
+    """
+    return JobLedger(os.getenv('LEDGER_BACKEND', LEDGER_BACKEND).lower(), os.getenv('LEDGER_PATH', LEDGER_PATH),
+                     db_pool=db_pool)
+
+if __name__ == "__main__":
+    # Usage: python ledger.py [--abandon]
+    # Prints the state of the latest batch; --abandon gives up its unfinished agencies so the next run starts afresh
+    from metrics import configure_logging
+    configure_logging()
+    ledger = get_job_ledger()
+    try:
+        if '--abandon' in sys.argv[1:]:
+            print(f"Abandoned {ledger.abandon()} unfinished agencies")
+        batch_id, started_at = ledger._latest_batch()
+        if batch_id is None:
+            print(f"No batch in {ledger!r}")
+            sys.exit(0)
+        print(f"Batch {batch_id} started at {started_at:%Y-%m-%d %H:%M:%S}: {ledger.summary(batch_id)}")
+        for agency, job in sorted(ledger.jobs(batch_id).items()):
+            if job['status'] != DONE:
+                retry = f", retry after {job['next_attempt_at']:%Y-%m-%d %H:%M:%S}" if job['next_attempt_at'] else ''
+                print(f"  {agency}: {job['status']} in {job['stage']} after {job['attempts']} failures{retry}"
+                      f"{': ' + job['last_error'] if job['last_error'] else ''}")
+    finally:
+        ledger.close()
@@ -0,0 +1,176 @@
+import io
+import csv
+import logging
+from psycopg2.extras import execute_values
+from const import table_name, INSERT_QUERY, INSERT_COLUMNS, INSERT_PAGE_SIZE
+
+# Text written for None so COPY loads a real NULL (empty strings stay empty strings)
+COPY_NULL = '\\N'
+
+STAGING_TABLE = f"{table_name}_staging"
+
+# Unique key of ceqa_data, and of a ceqa_data partitioned by 'received' (see partitions.py)
+CONFLICT_COLUMNS = ('entry_id',)
+PARTITIONED_CONFLICT_COLUMNS = ('entry_id', 'received')
+
+def build_insert_query(columns=INSERT_COLUMNS, conflict_columns=CONFLICT_COLUMNS, target=f"public.{table_name}"):
+    """
+    Build an execute_values upsert of the same shape as INSERT_QUERY for another unique key.
+
+    Args:
+        columns (list): Columns of the rows.
+        conflict_columns (tuple): Columns of the unique key used for ON CONFLICT.
+        target (str): The target table.
+
+    Returns:
+        str: The INSERT ... VALUES %s ... ON CONFLICT DO UPDATE query.
+    """
+    if tuple(columns) == tuple(INSERT_COLUMNS) and tuple(conflict_columns) == CONFLICT_COLUMNS:
+        return INSERT_QUERY
+    updates = ',\n    '.join(f"{column} = EXCLUDED.{column}" for column in columns if column not in conflict_columns)
+    return f"""
+INSERT INTO {target} ({', '.join(columns)}) VALUES %s
+ON CONFLICT ({', '.join(conflict_columns)})
+DO UPDATE SET
+    {updates};
+"""
+
+def build_merge_query(columns=INSERT_COLUMNS, conflict_columns=CONFLICT_COLUMNS, target=f"public.{table_name}",
+                      staging=STAGING_TABLE):
+    """
+    Build the set-based upsert moving the staging table into the target table.
+
+    Args:
+        columns (list): Columns loaded into the staging table.
+        conflict_columns (tuple): Columns of the unique key used for ON CONFLICT.
+        target (str): The target table.
+        staging (str): The staging table.
+
+    Returns:
+        str: The INSERT ... SELECT ... ON CONFLICT DO UPDATE query.
+    """
+    column_list = ', '.join(columns)
+    key_list = ', '.join(conflict_columns)
+    updates = ',\n    '.join(f"{column} = EXCLUDED.{column}" for column in columns if column not in conflict_columns)
+    # DISTINCT ON guards against a key appearing twice, which ON CONFLICT cannot handle
+    return f"""
+INSERT INTO {target} ({column_list})
+SELECT DISTINCT ON ({key_list}) {column_list}
+FROM {staging}
+ORDER BY {key_list}
+ON CONFLICT ({key_list})
+DO UPDATE SET
+    {updates};
+"""
+
+class CopyStream(io.TextIOBase):
+    """
+    File-like object producing the CSV text of rows on demand, so COPY can stream
+    a large batch without the whole CSV being built in memory first.
+    """
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+        self._pending = ''
+
+    def readable(self):
+        return True
+
+    def _fill(self, size):
+        # Write rows until at least size characters are waiting
+        while len(self._pending) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._writer.writerow([COPY_NULL if value is None else value for value in row])
+            self._pending += self._buffer.getvalue()
+            self._buffer.seek(0)
+            self._buffer.truncate()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            self._fill(float('inf'))
+            data, self._pending = self._pending, ''
+            return data
+        self._fill(size)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+def copy_upsert(cursor, data_tuples, columns=INSERT_COLUMNS, conflict_columns=CONFLICT_COLUMNS):
+    """
+    Stream rows into a temporary staging table with COPY and merge them into the target table
+    with a single upsert. Runs in the caller's transaction; the staging table is dropped on commit.
+
+    Args:
+        cursor: A psycopg2 cursor.
+        data_tuples (iterable): Rows in the order of columns.
+        columns (list): Columns of the rows (default is INSERT_COLUMNS).
+        conflict_columns (tuple): Unique key of the target table.
+
+    Returns:
+        int: Number of rows inserted or updated.
+    """
+    column_list = ', '.join(columns)
+    cursor.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE}
+        (LIKE public.{table_name} INCLUDING DEFAULTS) ON COMMIT DROP
+    """)
+    # The table survives a failed merge rolled back to a savepoint, so start from empty
+    cursor.execute(f"TRUNCATE {STAGING_TABLE}")
+    cursor.copy_expert(
+        f"COPY {STAGING_TABLE} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')",
+        CopyStream(data_tuples),
+    )
+    logging.debug(f"Copied {cursor.rowcount} rows into {STAGING_TABLE}")
+
+    cursor.execute(build_merge_query(columns, conflict_columns))
+    return cursor.rowcount
+
+def insert_upsert(cursor, data_tuples, page_size=INSERT_PAGE_SIZE, conflict_columns=CONFLICT_COLUMNS):
+    """
+    Upsert rows with INSERT_QUERY through execute_values, page_size rows per statement.
+
+    Args:
+        cursor: A psycopg2 cursor.
+        data_tuples (list): Rows in the order of INSERT_COLUMNS.
+        page_size (int): Rows sent per statement.
+        conflict_columns (tuple): Unique key of the target table.
+
+    Returns:
+        int: Number of rows sent.
+    """
+    execute_values(cursor, build_insert_query(conflict_columns=conflict_columns), data_tuples, page_size=page_size)
+    return len(data_tuples)
+
+def bulk_upsert(cursor, data_tuples, method='copy', conflict_columns=CONFLICT_COLUMNS):
+    """
+    Upsert rows with the requested method, in the caller's transaction. The COPY path runs
+    under a savepoint and falls back to INSERT_QUERY if it fails (e.g. no right to create
+    temporary tables), so the transaction stays usable.
+
+    Args:
+        cursor: A psycopg2 cursor.
+        data_tuples (list): Rows in the order of INSERT_COLUMNS.
+        method (str): 'copy' or 'insert'.
+        conflict_columns (tuple): Unique key of the target table, PARTITIONED_CONFLICT_COLUMNS
+            when it is partitioned.
+
+    Returns:
+        int: Number of rows upserted.
+    """
+    if method == 'insert':
+        return insert_upsert(cursor, data_tuples, conflict_columns=conflict_columns)
+    if method != 'copy':
+        raise ValueError(f"Unknown loader method '{method}', expected 'copy' or 'insert'.")
+
+    cursor.execute("SAVEPOINT bulk_copy")
+    try:
+        count = copy_upsert(cursor, data_tuples, conflict_columns=conflict_columns)
+    except Exception as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT bulk_copy")
+        logging.warning(f"COPY load failed ({e}), falling back to INSERT_QUERY")
+        return insert_upsert(cursor, data_tuples, conflict_columns=conflict_columns)
+    cursor.execute("RELEASE SAVEPOINT bulk_copy")
+    return count
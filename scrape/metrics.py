@@ -0,0 +1,453 @@
+import io
+import os
+import re
+import sys
+import time
+import uuid
+import pstats
+import logging
+import cProfile
+import resource
+import threading
+import tracemalloc
+from datetime import datetime
+from contextlib import contextmanager
+from psycopg2.extras import execute_values
+from const import INGESTION_RUNS_TABLE, LOG_LEVEL, PROFILE_DIR, PROFILE_TOP_AGENCIES
+from archive import agency_slug
+
+# One row per agency and stage (step NULL) or transform step of a run, plus one row for the run (agency NULL)
+CREATE_INGESTION_RUNS_TABLE = f"""
+CREATE TABLE IF NOT EXISTS public.{INGESTION_RUNS_TABLE} (
+    run_id TEXT NOT NULL,
+    started_at TIMESTAMP NOT NULL,
+    agency TEXT,
+    stage TEXT NOT NULL,
+    step TEXT,
+    status TEXT NOT NULL,
+    seconds DOUBLE PRECISION NOT NULL,
+    cpu_seconds DOUBLE PRECISION,
+    rows BIGINT,
+    rss_mb DOUBLE PRECISION,
+    error TEXT,
+    recorded_at TIMESTAMP NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS {INGESTION_RUNS_TABLE}_started_at_idx ON public.{INGESTION_RUNS_TABLE} (started_at);
+CREATE INDEX IF NOT EXISTS {INGESTION_RUNS_TABLE}_agency_stage_idx ON public.{INGESTION_RUNS_TABLE} (agency, stage);
+"""
+
+INSERT_INGESTION_RUNS_QUERY = f"""
+INSERT INTO public.{INGESTION_RUNS_TABLE}
+    (run_id, started_at, agency, stage, step, status, seconds, cpu_seconds, rows, rss_mb, error)
+VALUES %s
+"""
+
+# Fields of a metric record, in the column order of INSERT_INGESTION_RUNS_QUERY after run_id and started_at
+RECORD_FIELDS = ('agency', 'stage', 'step', 'status', 'seconds', 'cpu_seconds', 'rows', 'rss_mb', 'error')
+
+def configure_logging(level=None):
+    """
+    Configure the root logger for a command-line run. Called by the entry points rather than
+    at import time, so importing the pipeline leaves the logging of its caller alone.
+
+    Args:
+        level (str or int): Log level; defaults to the LOG_LEVEL variable, then const.LOG_LEVEL.
+    """
+    level = level or os.getenv('LOG_LEVEL', LOG_LEVEL)
+    logging.basicConfig(level=level.upper() if isinstance(level, str) else level,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+def current_rss_mb():
+    """Resident memory of the process in MB, or its peak where the current value is not available."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    """Peak resident memory of the process in MB."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def ensure_ingestion_runs_table(cursor):
+    """
+    Create the ingestion_runs table if it does not exist.
+
+    Args:
+        cursor: A psycopg2 cursor.
+    """
+    cursor.execute(CREATE_INGESTION_RUNS_TABLE)
+    logging.debug(f"Ensured table {INGESTION_RUNS_TABLE} exists")
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Profiler:
+    """
+    Opt-in profiling of every stage call, per agency. Profiles are kept until the end of the run,
+    when those of the slowest agencies are written to a directory and the others dropped.
+
+    'cprofile' profiles the thread running the stage; on Python 3.12 and later only one profiler
+    can be active at a time, so a stage starting while another is profiled runs unprofiled.
+    'tracemalloc' traces allocations of the whole process and keeps, after each stage, the lines
+    holding the most memory with the traced peak; concurrent stages share those figures.
+    """
+
+    def __init__(self, kind='cprofile', directory=None, top=PROFILE_TOP_AGENCIES, lines=25):
+        """
+        Args:
+            kind (str): 'cprofile' or 'tracemalloc'.
+            directory (str): Where profiles are written. Defaults to PROFILE_DIR.
+            top (int): Number of slowest agencies whose profiles are written.
+            lines (int): Allocation sites kept per stage in tracemalloc mode.
+        """
+        if kind not in ('cprofile', 'tracemalloc'):
+            raise ValueError(f"Unknown profiler '{kind}', expected 'cprofile' or 'tracemalloc'.")
+        self.kind = kind
+        self.directory = directory or os.getenv('PROFILE_DIR', PROFILE_DIR)
+        self.top = top
+        self.lines = lines
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Drop the profiles of a previous run; in tracemalloc mode, start tracing."""
+        with self._lock:
+            self._profiles = {}
+        if self.kind == 'tracemalloc' and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def call(self, agency, stage, func, *args):
+        """Run func(*args) as the given stage of an agency, profiled, and return its result."""
+        if self.kind == 'cprofile':
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another thread is being profiled (Python 3.12+)
+                return func(*args)
+            try:
+                return func(*args)
+            finally:
+                profile.disable()
+                with self._lock:
+                    self._profiles.setdefault(agency, []).append(profile)
+
+        try:
+            return func(*args)
+        finally:
+            if tracemalloc.is_tracing():
+                current, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+                statistics = snapshot.statistics('lineno')[:self.lines]
+                report = [f"{stage}: traced {current / 2**20:.1f} MB, peak {peak / 2**20:.1f} MB"]
+                report.extend(f"    {statistic}" for statistic in statistics)
+                with self._lock:
+                    self._profiles.setdefault(agency, []).append('\n'.join(report))
+
+    def dump(self, agency_seconds):
+        """
+        Write the profiles of the slowest agencies and drop the others.
+
+        Args:
+            agency_seconds (dict): Agency name to the seconds its stages took.
+
+        Returns:
+            list: Paths of the files written.
+        """
+        with self._lock:
+            profiles, self._profiles = self._profiles, {}
+        if self.kind == 'tracemalloc' and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        slowest = sorted((agency for agency in profiles if agency in agency_seconds),
+                         key=lambda agency: agency_seconds[agency], reverse=True)[:self.top]
+        os.makedirs(self.directory, exist_ok=True)
+        # Files ranked by an earlier run of the same kind would be mixed with these
+        for name in os.listdir(self.directory):
+            tracemalloc_file = name.endswith('.tracemalloc.txt')
+            ours = tracemalloc_file if self.kind == 'tracemalloc' else name.endswith(('.prof', '.txt')) and not tracemalloc_file
+            if ours and re.match(r'\d{2}-', name):
+                os.remove(os.path.join(self.directory, name))
+        paths = []
+        for rank, agency in enumerate(slowest, 1):
+            base = os.path.join(self.directory, f"{rank:02d}-{agency_slug(agency)}")
+            if self.kind == 'cprofile':
+                stats = pstats.Stats(*profiles[agency])
+                stats.dump_stats(f"{base}.prof")
+                text = io.StringIO()
+                pstats.Stats(f"{base}.prof", stream=text).sort_stats('cumulative').print_stats(40)
+                with open(f"{base}.txt", 'w') as file:
+                    file.write(f"{agency}: {agency_seconds[agency]:.2f} s\n{text.getvalue()}")
+                paths.extend([f"{base}.prof", f"{base}.txt"])
+            else:
+                with open(f"{base}.tracemalloc.txt", 'w') as file:
+                    file.write(f"{agency}: {agency_seconds[agency]:.2f} s\n\n" + '\n\n'.join(profiles[agency]) + '\n')
+                paths.append(f"{base}.tracemalloc.txt")
+        logging.info(f"Wrote {self.kind} profiles of the {len(slowest)} slowest agencies to {self.directory}")
+        return paths
+
+class RunMetrics:
+    """
+    Timing, row-count and memory metrics of the stages of a run, per agency.
+
+    Every stage call of run_for_cities or replay is one record, with its wall and CPU seconds,
+    rows and the resident memory of the process when it ended; the transforms also record each
+    of their steps. At the end of a run the records can be written as a Prometheus textfile
+    (for the node_exporter textfile collector), as JSON and into the ingestion_runs table.
+    """
+
+    def __init__(self, textfile=None, json_path=None, table=False, profiler=None):
+        """
+        Args:
+            textfile (str): Prometheus textfile written at the end of each run, e.g.
+                '/var/lib/node_exporter/ceqa.prom'.
+            json_path (str): JSON file written at the end of each run.
+            table (bool): Insert the records into the ingestion_runs table at the end of each run.
+            profiler (Profiler): Optional profiler run around every stage call.
+        """
+        self.textfile = textfile
+        self.json_path = json_path
+        self.table = table
+        self.profiler = profiler
+        self.records = []
+        self._lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        """Begin a new run: a new run_id, and no records."""
+        self.run_id = uuid.uuid4().hex
+        self.started_at = datetime.now()
+        self._started = time.perf_counter()
+        self.seconds = None
+        with self._lock:
+            self.records = []
+        if self.profiler is not None:
+            self.profiler.start()
+
+    def record(self, agency, stage, seconds, step=None, status='ok', rows=None, cpu_seconds=None, error=None):
+        """Add one record to the run."""
+        record = {
+            'agency': agency,
+            'stage': stage,
+            'step': step,
+            'status': status,
+            'seconds': seconds,
+            'cpu_seconds': cpu_seconds,
+            'rows': rows,
+            'rss_mb': round(current_rss_mb(), 1),
+            'error': error,
+        }
+        with self._lock:
+            self.records.append(record)
+        return record
+
+    @contextmanager
+    def step(self, agency, stage, step):
+        """
+        Time the block as a step of a stage. The yielded dict takes the rows of the step, e.g.
+        metric['rows'] = len(df).
+        """
+        metric = {'rows': None}
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        status = 'ok'
+        try:
+            yield metric
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            self.record(agency, stage, time.perf_counter() - start, step, status, metric['rows'],
+                        time.thread_time() - cpu_start)
+
+    def call(self, agency, stage, func, *args, rows=None):
+        """
+        Run func(*args) as a stage of an agency, through the profiler when there is one, and
+        record it. A None result is recorded as 'skipped' and an exception as 'error'.
+
+        Args:
+            rows (callable): Called with the result to count the rows of the stage.
+        """
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            if self.profiler is not None:
+                result = self.profiler.call(agency, stage, func, *args)
+            else:
+                result = func(*args)
+        except Exception as e:
+            self.record(agency, stage, time.perf_counter() - start, status='error',
+                        cpu_seconds=time.thread_time() - cpu_start, error=str(e)[:1000])
+            raise
+        self.record(agency, stage, time.perf_counter() - start, status='ok' if result is not None else 'skipped',
+                    rows=rows(result) if rows is not None and result is not None else None,
+                    cpu_seconds=time.thread_time() - cpu_start)
+        return result
+
+    def stages(self):
+        """Return the records of whole stages, leaving out the steps of the transforms."""
+        with self._lock:
+            return [record for record in self.records if record['step'] is None]
+
+    def agency_seconds(self):
+        """Return the seconds the stages of each agency took, summed."""
+        seconds = {}
+        for record in self.stages():
+            seconds[record['agency']] = seconds.get(record['agency'], 0.0) + record['seconds']
+        return seconds
+
+    def summary(self, done=None):
+        """
+        Return the totals of the run.
+
+        Args:
+            done (list): Agencies that made it through every stage.
+
+        Returns:
+            dict: Run id, start time, seconds, agencies, errors, rows loaded and peak RSS.
+        """
+        stages = self.stages()
+        seconds = self.seconds if self.seconds is not None else time.perf_counter() - self._started
+        return {
+            'run_id': self.run_id,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'seconds': round(seconds, 3),
+            'agencies': len({record['agency'] for record in stages}),
+            'succeeded': len(done) if done is not None else None,
+            'errors': len({record['agency'] for record in stages if record['status'] == 'error'}),
+            'rows': sum(record['rows'] or 0 for record in stages if record['stage'] in ('load', 'count')),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+
+    def finish(self, done=None, connection=None):
+        """
+        End the run and write its metrics to every configured output; a failing output is logged
+        and does not fail the run.
+
+        Args:
+            done (list): Agencies that made it through every stage.
+            connection: A psycopg2 connection, used when table is set.
+
+        Returns:
+            dict: The summary of the run.
+        """
+        self.seconds = time.perf_counter() - self._started
+        summary = self.summary(done)
+        logging.info(f"Run {self.run_id} took {summary['seconds']} s for {summary['agencies']} agencies: {summary}")
+        outputs = [
+            (self.textfile, self.write_textfile),
+            (self.json_path, lambda path: self.write_json(path, summary)),
+            (self.table and connection, lambda connection: self.write_table(connection, summary)),
+            (self.profiler, lambda profiler: profiler.dump(self.agency_seconds())),
+        ]
+        for target, write in outputs:
+            if not target:
+                continue
+            try:
+                write(target)
+            except Exception as e:
+                logging.error(f"Could not write the metrics of run {self.run_id}: {e}")
+        return summary
+
+    def prometheus_text(self):
+        """Return the metrics of the run in the Prometheus text exposition format."""
+        stages = self.stages()
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{_escape_label(label)}"' for key, label in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        metric('ceqa_run_timestamp_seconds', 'gauge', "Start of the last run, as a Unix time.",
+               [({}, round(self.started_at.timestamp(), 3))])
+        metric('ceqa_run_seconds', 'gauge', "Wall seconds of the last run.", [({}, summary['seconds'])])
+        metric('ceqa_run_agencies', 'gauge', "Agencies of the last run, and those with a failed stage.",
+               [({'status': 'total'}, summary['agencies']), ({'status': 'error'}, summary['errors'])])
+        metric('ceqa_run_rows', 'gauge', "Rows loaded by the last run.", [({}, summary['rows'])])
+        metric('ceqa_run_peak_rss_bytes', 'gauge', "Peak resident memory of the last run.",
+               [({}, int(summary['peak_rss_mb'] * 1024 * 1024))])
+
+        totals = {}
+        for record in stages:
+            key = (record['agency'], record['stage'])
+            total = totals.setdefault(key, {'seconds': 0.0, 'rows': None, 'status': 'ok'})
+            total['seconds'] += record['seconds']
+            if record['rows'] is not None:
+                total['rows'] = (total['rows'] or 0) + record['rows']
+            if record['status'] == 'error':
+                total['status'] = 'error'
+        metric('ceqa_stage_seconds', 'gauge', "Wall seconds of each stage of each agency in the last run.",
+               [({'agency': agency, 'stage': stage}, round(total['seconds'], 6))
+                for (agency, stage), total in sorted(totals.items())])
+        metric('ceqa_stage_rows', 'gauge', "Rows of each stage of each agency in the last run.",
+               [({'agency': agency, 'stage': stage}, total['rows'])
+                for (agency, stage), total in sorted(totals.items()) if total['rows'] is not None])
+        metric('ceqa_stage_failed', 'gauge', "1 when the stage of the agency failed in the last run.",
+               [({'agency': agency, 'stage': stage}, int(total['status'] == 'error'))
+                for (agency, stage), total in sorted(totals.items())])
+
+        # Steps are summed over the agencies, which keeps the number of series small
+        steps = {}
+        with self._lock:
+            for record in self.records:
+                if record['step'] is not None:
+                    key = (record['stage'], record['step'])
+                    steps[key] = steps.get(key, 0.0) + record['seconds']
+        metric('ceqa_step_seconds', 'gauge', "Wall seconds of each transform step in the last run, all agencies.",
+               [({'stage': stage, 'step': step}, round(seconds, 6)) for (stage, step), seconds in sorted(steps.items())])
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """Write the Prometheus textfile, renamed into place so the collector never reads half of it."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as file:
+            file.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+        logging.debug(f"Wrote Prometheus metrics of run {self.run_id} to {path}")
+
+    def write_json(self, path, summary=None):
+        """Write the summary and every record of the run as JSON."""
+        import json
+        with self._lock:
+            records = list(self.records)
+        with open(path, 'w') as file:
+            json.dump({'run': summary or self.summary(), 'records': records}, file, indent=2)
+        logging.debug(f"Wrote metrics of run {self.run_id} to {path}")
+
+    def write_table(self, connection, summary=None, page_size=1000):
+        """Insert the records of the run, and one row for the run itself, into ingestion_runs."""
+        summary = summary or self.summary()
+        with self._lock:
+            records = list(self.records)
+        rows = [(self.run_id, self.started_at) + tuple(record[field] for field in RECORD_FIELDS)
+                for record in records]
+        rows.append((self.run_id, self.started_at, None, 'run', None,
+                     'error' if summary['errors'] else 'ok', summary['seconds'], None, summary['rows'],
+                     summary['peak_rss_mb'], None))
+        try:
+            with connection.cursor() as cursor:
+                ensure_ingestion_runs_table(cursor)
+                execute_values(cursor, INSERT_INGESTION_RUNS_QUERY, rows, page_size=page_size)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        logging.debug(f"Inserted {len(rows)} metric rows of run {self.run_id} into {INGESTION_RUNS_TABLE}")
+
+def metrics_from_env():
+    """
+    Build the RunMetrics of a command-line run from the environment:
+    METRICS_TEXTFILE and METRICS_JSON paths, METRICS_TABLE ('0' to skip the ingestion_runs table),
+    and PROFILE ('cprofile' or 'tracemalloc') with PROFILE_DIR and PROFILE_TOP.
+
+    Returns:
+        RunMetrics: The metrics collector.
+    """
+    profile = os.getenv('PROFILE')
+    profiler = Profiler(profile, top=int(os.getenv('PROFILE_TOP', PROFILE_TOP_AGENCIES))) if profile else None
+    return RunMetrics(textfile=os.getenv('METRICS_TEXTFILE'), json_path=os.getenv('METRICS_JSON'),
+                      table=os.getenv('METRICS_TABLE', '1') != '0', profiler=profiler)
@@ -0,0 +1,113 @@
+import re
+import logging
+import numpy as np
+from psycopg2.extras import execute_values
+from parcels import default_expander
+from const import PARCEL_TABLE, table_name
+
+_NON_DIGIT = re.compile(r'\D')
+
+# Narrow (entry_id, parcel) table holding every expanded parcel of every filing
+CREATE_PARCEL_TABLE = f"""
+CREATE TABLE IF NOT EXISTS public.{PARCEL_TABLE} (
+    entry_id BIGINT NOT NULL,
+    parcel VARCHAR(10) NOT NULL,
+    PRIMARY KEY (entry_id, parcel)
+);
+CREATE INDEX IF NOT EXISTS {PARCEL_TABLE}_parcel_idx ON public.{PARCEL_TABLE} (parcel);
+"""
+
+DELETE_PARCELS_QUERY = f"DELETE FROM public.{PARCEL_TABLE} WHERE entry_id = ANY(%s)"
+
+INSERT_PARCELS_QUERY = f"""
+INSERT INTO public.{PARCEL_TABLE} (entry_id, parcel) VALUES %s
+ON CONFLICT (entry_id, parcel) DO NOTHING
+"""
+
+def ensure_parcel_table(cursor):
+    """
+    Create the parcel table and its parcel index if they do not exist.
+
+    Args:
+        cursor: A psycopg2 cursor.
+    """
+    cursor.execute(CREATE_PARCEL_TABLE)
+    logging.debug(f"Ensured table {PARCEL_TABLE} exists")
+
+def build_parcel_rows(entry_ids, raw_parcels, expander=default_expander):
+    """
+    Expand the raw parcel column into (entry_id, parcel) rows, without truncation.
+
+    Args:
+        entry_ids (pd.Series): The entry_id of each filing.
+        raw_parcels (pd.Series): The raw 'Location Parcel Number' of each filing.
+        expander (ParcelExpander): The expansion engine (default is the shared one).
+
+    Returns:
+        list: Distinct (entry_id, parcel) tuples, 'Unknown' parcels and ranges wider than
+            the max_range of the expander left out.
+    """
+    row_idx, parcels = expander.expand_batch(raw_parcels)
+    wide = expander.count_wide_ranges(raw_parcels)
+    if wide:
+        logging.warning(f"Left out the parcels of {wide} filings with a range wider than {expander.max_range}")
+    known = parcels != 'Unknown'
+    ids = np.asarray(entry_ids, dtype=object)[row_idx[known]]
+    return list(dict.fromkeys(zip(ids.tolist(), parcels[known].tolist())))
+
+def write_parcels(cursor, entry_ids, parcel_rows, page_size=1000):
+    """
+    Replace the parcels of the given filings, inside the caller's transaction.
+
+    Args:
+        cursor: A psycopg2 cursor.
+        entry_ids (list): Every entry_id being loaded, including those without parcels.
+        parcel_rows (list): (entry_id, parcel) tuples from build_parcel_rows.
+        page_size (int): Rows sent per INSERT statement.
+    """
+    cursor.execute(DELETE_PARCELS_QUERY, (list(entry_ids),))
+    execute_values(cursor, INSERT_PARCELS_QUERY, parcel_rows, page_size=page_size)
+    logging.debug(f"Wrote {len(parcel_rows)} parcels for {len(entry_ids)} filings")
+
+def normalize_parcel(parcel):
+    """Reduce an APN as typed by a user ('3204-008-045') to the stored digits ('3204008045')."""
+    return _NON_DIGIT.sub('', str(parcel))
+
+def find_entries_by_parcels(connection, parcels):
+    """
+    Look up the filings that touch any of the given APNs, using the parcel index.
+
+    Args:
+        connection: A psycopg2 connection.
+        parcels (list): APNs, with or without dashes.
+
+    Returns:
+        tuple: (column names, rows), with the matched parcel as the first column
+            followed by every column of the filing.
+    """
+    normalized = [normalize_parcel(parcel) for parcel in parcels]
+    query = f"""
+    SELECT p.parcel, d.*
+    FROM public.{PARCEL_TABLE} p
+    JOIN public.{table_name} d ON d.entry_id = p.entry_id
+    WHERE p.parcel = ANY(%s)
+    ORDER BY p.parcel, d.received
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query, (normalized,))
+        rows = cursor.fetchall()
+        columns = [column[0] for column in cursor.description]
+    return columns, rows
+
+def find_entries_by_parcel(connection, parcel):
+    """
+    Look up the filings that touch a single APN.
+
+    Args:
+        connection: A psycopg2 connection.
+        parcel (str): The APN, with or without dashes.
+
+    Returns:
+        tuple: (column names, rows) as returned by find_entries_by_parcels.
+    """
+    return find_entries_by_parcels(connection, [parcel])
@@ -0,0 +1,297 @@
+import re
+import functools
+import numpy as np
+import pandas as pd
+from const import PARCEL_CACHE_SIZE, PARCEL_CACHE_MAX_EXPANSION, PARCEL_RANGE_MAX
+
+# Precompiled patterns shared by every expansion
+_NON_DIGIT = re.compile(r'\D')
+_SEPARATORS = re.compile(r'[;,]+')
+
+UNKNOWN = "Unknown"
+
+def _clean_and_validate(parcel):
+    """
+    Keep the digits of a parcel number and accept it only if 9 or 10 digits remain.
+    Same result as validate_parcel(clean_parcel(parcel)) for a string.
+    """
+    digits = _NON_DIGIT.sub('', parcel)
+    return digits if 9 <= len(digits) <= 10 else UNKNOWN
+
+def _base_prefix(base_parcel):
+    # '3123-014-900' -> '3123-014-'
+    return '-'.join(base_parcel.split('-')[:-1]) + '-'
+
+class ParcelRange:
+    """
+    A 'to' / 'thru' range of parcels: the cleaned prefix digits followed by each number
+    from start to end, zero-padded to three digits. Kept unexpanded so that large ranges
+    can be matched without materializing them.
+    """
+
+    __slots__ = ('prefix', 'start', 'end')
+
+    def __init__(self, prefix, start, end):
+        self.prefix = prefix
+        self.start = start
+        self.end = end
+
+    def __iter__(self):
+        # Generate the parcels, 'Unknown' for those that are not 9-10 digits long
+        for i in range(self.start, self.end + 1):
+            digits = self.prefix + f"{i:03d}"
+            yield digits if 9 <= len(digits) <= 10 else UNKNOWN
+
+    def __len__(self):
+        return max(0, self.end - self.start + 1)
+
+    def __contains__(self, parcel):
+        # True if the range generates this exact parcel
+        if not parcel.startswith(self.prefix):
+            return False
+        suffix = parcel[len(self.prefix):]
+        if len(suffix) < 3 or not suffix.isdecimal() or not suffix.isascii():
+            return False
+        number = int(suffix)
+        return f"{number:03d}" == suffix and self.start <= number <= self.end and 9 <= len(parcel) <= 10
+
+    def __repr__(self):
+        return f"ParcelRange({self.prefix!r}, {self.start}, {self.end})"
+
+def parse_parcel_segments(parcel):
+    """
+    Split a raw 'Location Parcel Number' value into segments, handling 'and', '&', 'to' / 'thru'
+    ranges, slashes, comma-separated suffixes and other edge cases.
+
+    Args:
+        parcel: The raw value; anything that is not a non-blank string gives ('Unknown',).
+
+    Returns:
+        tuple: Segments in order, each either a parcel string ('Unknown' for parts that are not
+            a valid 9-10 digit parcel) or a ParcelRange.
+    """
+    if not isinstance(parcel, str) or not parcel.strip():
+        return (UNKNOWN,)
+
+    # Replace 'and' with a comma and normalize 'thru'
+    parcel = parcel.replace(' and ', ', ').replace('thru', ' thru ').replace('&', ', ')
+
+    # Replace runs of semicolons or commas with a single comma
+    parcel = _SEPARATORS.sub(',', parcel)
+
+    segments = []
+    base_parcel = None
+
+    for part in parcel.strip().split(','):
+        part = part.strip()
+
+        # Slashes, e.g. '3204008045/047'
+        if '/' in part:
+            split_parts = part.split('/')
+            base_parcel = split_parts[0]
+            for suffix in split_parts[1:]:
+                if suffix.isdigit():
+                    base_prefix = base_parcel[:-len(suffix)]  # Adjust the prefix based on suffix length
+                    segments.append(_clean_and_validate(base_prefix + suffix.zfill(3)))
+                else:
+                    segments.append(UNKNOWN)
+            segments.append(_clean_and_validate(base_parcel))
+
+        # Ranges with 'to', e.g. '3123-014-900 to 916'
+        elif ' to ' in part:
+            try:
+                start, end = part.split(' to ')
+                start = start.strip()
+                end = end.strip()
+
+                if base_parcel is None:
+                    base_parcel = start  # Base is the starting parcel number
+
+                base_prefix = _base_prefix(base_parcel)
+                start_number = int(start.split('-')[-1])
+                end_number = int(end)
+            except Exception:
+                segments.append(UNKNOWN)  # Invalid range format
+                continue
+            segments.append(ParcelRange(_NON_DIGIT.sub('', base_prefix), start_number, end_number))
+
+        # Ranges with 'thru', e.g. '3203-018-064 thru -071'
+        elif 'thru' in part:
+            try:
+                start, end = part.split('thru')
+                start = start.strip()
+                end = end.strip().strip('-')
+
+                if base_parcel is None:
+                    base_parcel = start  # Base is the starting parcel number
+
+                base_prefix = _base_prefix(base_parcel)
+                start_number = int(start.split('-')[-1])
+                end_number = int(end.split('-')[-1])
+            except Exception:
+                segments.append(UNKNOWN)  # Invalid range format
+                continue
+            segments.append(ParcelRange(_NON_DIGIT.sub('', base_prefix), start_number, end_number))
+
+        # Full parcel numbers, e.g. '3219-018-01'
+        elif part.count('-') == 2:
+            base_parcel = part
+            segments.append(_clean_and_validate(base_parcel))
+
+        # Extensions of the previous parcel, e.g. '02' after '3219-018-01'
+        elif base_parcel:
+            segments.append(_clean_and_validate(_base_prefix(base_parcel) + part.strip('-')))
+
+        else:
+            segments.append(UNKNOWN)  # No base parcel to extend
+
+    return tuple(segments)
+
+def _expand_segments(segments, max_range):
+    # Ranges wider than max_range give a single 'Unknown'
+    expanded_parcels = []
+    for segment in segments:
+        if isinstance(segment, ParcelRange) and len(segment) > max_range:
+            expanded_parcels.append(UNKNOWN)
+        elif isinstance(segment, ParcelRange):
+            # The prefix is cleaned once, instead of cleaning each generated parcel
+            expanded_parcels.extend(segment)
+        else:
+            expanded_parcels.append(segment)
+    return tuple(expanded_parcels)
+
+def _expanded_length(segments, max_range):
+    return sum(len(segment) if isinstance(segment, ParcelRange) and len(segment) <= max_range else 1
+               for segment in segments)
+
+def expand_parcel_string(parcel, max_range=PARCEL_RANGE_MAX):
+    """
+    Expand a raw 'Location Parcel Number' value into the list of parcels it describes.
+
+    Args:
+        parcel: The raw value; anything that is not a non-blank string expands to ['Unknown'].
+        max_range (int): Widest range expanded; a wider one gives a single 'Unknown'.
+
+    Returns:
+        tuple: The expanded parcels, 'Unknown' for parts that are not a valid 9-10 digit parcel.
+    """
+    return _expand_segments(parse_parcel_segments(parcel), max_range)
+
+class ParcelExpander:
+    """
+    Parcel-number expansion engine with a bounded LRU memo of raw strings.
+
+    The same raw value shows up many times across the NOD/NOE filings of a project,
+    so each distinct string is expanded once and then served from the memo. Ranges wider
+    than max_range are not expanded, and expansions longer than max_cached parcels are
+    rebuilt from the memoized segments instead of being memoized themselves, so the memo
+    holds at most cache_size * max_cached parcels.
+    """
+
+    def __init__(self, cache_size=PARCEL_CACHE_SIZE, max_range=PARCEL_RANGE_MAX, max_cached=PARCEL_CACHE_MAX_EXPANSION):
+        """
+        Args:
+            cache_size (int): Maximum number of raw strings kept in the memo.
+            max_range (int): Widest 'to' / 'thru' range expanded (default is PARCEL_RANGE_MAX).
+            max_cached (int): Longest expansion memoized (default is PARCEL_CACHE_MAX_EXPANSION).
+        """
+        self.max_range = max_range
+        self.max_cached = max_cached
+        self._segments_cached = functools.lru_cache(maxsize=cache_size)(parse_parcel_segments)
+        self._expand_cached = functools.lru_cache(maxsize=cache_size)(
+            lambda parcel: _expand_segments(self._segments_cached(parcel), max_range))
+
+    def expand(self, parcel):
+        """
+        Expand a single raw value.
+
+        Args:
+            parcel: The raw 'Location Parcel Number' value.
+
+        Returns:
+            tuple: The expanded parcels.
+        """
+        if not isinstance(parcel, str):
+            return (UNKNOWN,)
+        # Segments keep ranges unexpanded, so they are cheap to memoize whatever the expansion
+        segments = self._segments_cached(parcel)
+        if _expanded_length(segments, self.max_range) > self.max_cached:
+            return _expand_segments(segments, self.max_range)
+        return self._expand_cached(parcel)
+
+    def segments(self, parcel):
+        """
+        Parse a single raw value into segments, keeping ranges unexpanded.
+
+        Args:
+            parcel: The raw 'Location Parcel Number' value.
+
+        Returns:
+            tuple: Parcel strings and ParcelRange objects, see parse_parcel_segments.
+        """
+        if not isinstance(parcel, str):
+            return (UNKNOWN,)
+        return self._segments_cached(parcel)
+
+    def expand_batch(self, values):
+        """
+        Expand a whole column at once. Each distinct value is expanded a single time.
+
+        Args:
+            values (pd.Series or array-like): Raw 'Location Parcel Number' values.
+
+        Returns:
+            tuple: Two flat arrays of equal length, the position of the source row (int64)
+                and the parcel (object), in row order.
+        """
+        codes, uniques = pd.factorize(pd.Series(values, dtype=object), use_na_sentinel=True)
+
+        # Expansions of the distinct values laid end to end, plus one for missing values at the end
+        expansions = [self.expand(value) for value in uniques] + [(UNKNOWN,)]
+        lengths = np.fromiter((len(e) for e in expansions), dtype=np.int64, count=len(expansions))
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        flat = np.empty(int(lengths.sum()), dtype=object)
+        flat[:] = [parcel for expansion in expansions for parcel in expansion]
+
+        # Missing values (code -1) point at the trailing 'Unknown' expansion
+        codes = np.where(codes < 0, len(expansions) - 1, codes)
+        row_lengths = lengths[codes]
+        row_idx = np.repeat(np.arange(len(codes), dtype=np.int64), row_lengths)
+
+        # Position of each output element inside the expansion of its row
+        row_starts = np.repeat(np.cumsum(row_lengths) - row_lengths, row_lengths)
+        within = np.arange(len(row_idx), dtype=np.int64) - row_starts
+        parcels = flat[np.repeat(offsets[codes], row_lengths) + within]
+        return row_idx, parcels
+
+    def is_wide(self, segment):
+        """True if a segment is a range wider than max_range, which is left out."""
+        return isinstance(segment, ParcelRange) and len(segment) > self.max_range
+
+    def count_wide_ranges(self, values):
+        """
+        Count the values holding a range wider than max_range, i.e. whose range expand left out.
+
+        Args:
+            values (pd.Series or array-like): Raw 'Location Parcel Number' values.
+
+        Returns:
+            int: Number of values, repeats included, with at least one wide range.
+        """
+        counts = pd.Series(values, dtype=object).value_counts()
+        # Only values with 'to' or 'thru' can hold a range, so the others are not parsed at all
+        return int(sum(count for value, count in counts.items()
+                       if isinstance(value, str) and (' to ' in value or 'thru' in value)
+                       and any(self.is_wide(segment) for segment in self.segments(value))))
+
+    def cache_info(self):
+        """Return hit/miss statistics of the memo."""
+        return self._expand_cached.cache_info()
+
+    def cache_clear(self):
+        """Empty the memo."""
+        self._expand_cached.cache_clear()
+        self._segments_cached.cache_clear()
+
+# Engine shared by the pipeline, so the memo carries over from one agency to the next
+default_expander = ParcelExpander()
@@ -0,0 +1,369 @@
+import os
+import re
+import sys
+import gzip
+import logging
+import tempfile
+from datetime import date
+from const import table_name, COLUMN_SPECS, INSERT_COLUMNS, PARTITION_INTERVAL, PARTITION_AHEAD, PARTITION_ARCHIVE_PREFIX
+from schema import column_type, create_indexes, migrate, MIGRATIONS
+
+DEFAULT_PARTITION = f"{table_name}_default"
+
+# Name the unpartitioned table is kept under after the conversion
+UNPARTITIONED_TABLE = f"{table_name}_unpartitioned"
+
+# Single row holding the retention cutoff: rows received before it were retired with their partitions,
+# and are neither loaded nor given a partition again
+RETENTION_TABLE = f"{table_name}_retention"
+CREATE_RETENTION_TABLE = f"""
+CREATE TABLE IF NOT EXISTS public.{RETENTION_TABLE} (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    cutoff DATE NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+_BOUND = re.compile(r"FROM \('([\d-]+)'\) TO \('([\d-]+)'\)")
+
+def partition_bounds(day, interval=PARTITION_INTERVAL):
+    """
+    Return the range of the partition holding a date.
+
+    Args:
+        day (date): A 'received' date.
+        interval (str): 'year' or 'month'.
+
+    Returns:
+        tuple: (first day, first day of the next partition).
+    """
+    if interval == 'year':
+        return date(day.year, 1, 1), date(day.year + 1, 1, 1)
+    if interval == 'month':
+        start = date(day.year, day.month, 1)
+        return start, date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    raise ValueError(f"Unknown partition interval '{interval}', expected 'year' or 'month'.")
+
+def partition_name(start, interval=PARTITION_INTERVAL):
+    """Name of the partition starting on a date, e.g. ceqa_data_y2024 or ceqa_data_m2024_08."""
+    if interval == 'year':
+        return f"{table_name}_y{start.year}"
+    return f"{table_name}_m{start.year}_{start.month:02d}"
+
+def create_partitioned_table_query():
+    """
+    Build the CREATE TABLE statement of ceqa_data partitioned by 'received'.
+    The primary key has to include the partition key, so it is (entry_id, received);
+    entry_id already encodes the received date, so it is just as unique.
+    """
+    columns = ',\n    '.join(
+        f"{column} {column_type(column)}" + (" NOT NULL" if column == 'received' else "")
+        for column in COLUMN_SPECS
+    )
+    return f"""
+CREATE TABLE IF NOT EXISTS public.{table_name} (
+    {columns},
+    PRIMARY KEY (entry_id, received)
+) PARTITION BY RANGE (received);
+CREATE TABLE IF NOT EXISTS public.{DEFAULT_PARTITION} PARTITION OF public.{table_name} DEFAULT;
+"""
+
+def is_partitioned(cursor):
+    """Return True if ceqa_data is a partitioned table."""
+    cursor.execute(
+        "SELECT c.relkind = 'p' FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = 'public' AND c.relname = %s",
+        (table_name,),
+    )
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+def list_partitions(cursor):
+    """
+    List the range partitions of ceqa_data, oldest first. The default partition is left out.
+
+    Args:
+        cursor: A psycopg2 cursor.
+
+    Returns:
+        list: (name, first day, first day of the next partition) tuples.
+    """
+    cursor.execute(
+        """
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        JOIN pg_namespace n ON n.oid = p.relnamespace
+        WHERE n.nspname = 'public' AND p.relname = %s
+        """,
+        (table_name,),
+    )
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = _BOUND.search(bound or '')
+        if match:
+            partitions.append((name, date.fromisoformat(match.group(1)), date.fromisoformat(match.group(2))))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+def _table_exists(cursor, name):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"public.{name}",))
+    return cursor.fetchone()[0]
+
+def retention_cutoff(cursor):
+    """
+    Return the retention cutoff set by retire_partitions.
+
+    Args:
+        cursor: A psycopg2 cursor.
+
+    Returns:
+        date: Rows received before this date are retired, or None when no partition was ever retired.
+    """
+    if not _table_exists(cursor, RETENTION_TABLE):
+        return None
+    cursor.execute(f"SELECT cutoff FROM public.{RETENTION_TABLE}")
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def set_retention_cutoff(cursor, cutoff):
+    """
+    Move the retention cutoff forward to a date; it never moves back.
+
+    Args:
+        cursor: A psycopg2 cursor.
+        cutoff (date): Rows received before this date are retired.
+
+    Returns:
+        date: The cutoff now in force.
+    """
+    cursor.execute(CREATE_RETENTION_TABLE)
+    cursor.execute(
+        f"INSERT INTO public.{RETENTION_TABLE} (cutoff) VALUES (%s) "
+        f"ON CONFLICT (id) DO UPDATE SET cutoff = greatest({RETENTION_TABLE}.cutoff, excluded.cutoff), "
+        f"updated_at = now() RETURNING cutoff",
+        (cutoff,),
+    )
+    cutoff = cursor.fetchone()[0]
+    logging.info(f"Retention cutoff of {table_name} is {cutoff}")
+    return cutoff
+
+def ensure_partitions(cursor, days, interval=PARTITION_INTERVAL):
+    """
+    Create the partitions needed to hold the given dates, if they do not exist.
+
+    Args:
+        cursor: A psycopg2 cursor.
+        days (iterable): 'received' dates (date or datetime).
+        interval (str): 'year' or 'month'.
+
+    Returns:
+        list: Names of the partitions created.
+
+    Raises:
+        ValueError: A partition would end on or before the retention cutoff, or a table of the
+            same name exists without being attached, e.g. a detached partition.
+    """
+    existing = {name for name, _, _ in list_partitions(cursor)}
+    wanted = {partition_bounds(day, interval) for day in days if day is not None}
+    cutoff = retention_cutoff(cursor)
+    created = []
+    for start, end in sorted(wanted):
+        name = partition_name(start, interval)
+        if name in existing:
+            continue
+        if cutoff is not None and end <= cutoff:
+            raise ValueError(f"Partition {name} would end on {end}, not after the retention cutoff {cutoff}: "
+                             f"its rows were retired.")
+        if _table_exists(cursor, name):
+            raise ValueError(f"Table {name} exists but is not a partition of {table_name}; "
+                             f"attach or drop it first.")
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS public.{name} PARTITION OF public.{table_name} "
+            f"FOR VALUES FROM (%s) TO (%s)",
+            (start, end),
+        )
+        created.append(name)
+        logging.info(f"Created partition {name} for {start} to {end}")
+    return created
+
+def ensure_future_partitions(cursor, ahead=PARTITION_AHEAD, interval=PARTITION_INTERVAL, today=None):
+    """
+    Create the partition of today and of the next `ahead` intervals, so loads never wait on DDL.
+
+    Args:
+        cursor: A psycopg2 cursor.
+        ahead (int): Number of future partitions to keep created.
+        interval (str): 'year' or 'month'.
+        today (date): Reference date (default is today).
+
+    Returns:
+        list: Names of the partitions created.
+    """
+    start = partition_bounds(today or date.today(), interval)[0]
+    days = [start]
+    for _ in range(ahead):
+        start = partition_bounds(start, interval)[1]
+        days.append(start)
+    return ensure_partitions(cursor, days, interval)
+
+def _partition_table(cursor, interval=PARTITION_INTERVAL):
+    # Convert an unpartitioned ceqa_data in place, keeping the original under UNPARTITIONED_TABLE
+    if is_partitioned(cursor):
+        return
+    cursor.execute(f"LOCK TABLE public.{table_name} IN ACCESS EXCLUSIVE MODE")
+    cursor.execute(f"ALTER TABLE public.{table_name} RENAME TO {UNPARTITIONED_TABLE}")
+    cursor.execute(f"ALTER INDEX IF EXISTS public.{table_name}_pkey RENAME TO {UNPARTITIONED_TABLE}_pkey")
+    cursor.execute(
+        "SELECT indexname FROM pg_indexes WHERE schemaname = 'public' AND tablename = %s AND indexname <> %s",
+        (UNPARTITIONED_TABLE, f"{UNPARTITIONED_TABLE}_pkey"),
+    )
+    for (index_name,) in cursor.fetchall():
+        cursor.execute(f"DROP INDEX public.{index_name}")
+
+    cursor.execute(create_partitioned_table_query())
+    cursor.execute(f"SELECT DISTINCT date_trunc('{interval}', received)::date FROM public.{UNPARTITIONED_TABLE} "
+                   f"WHERE received IS NOT NULL")
+    ensure_partitions(cursor, [row[0] for row in cursor.fetchall()], interval)
+    ensure_future_partitions(cursor, interval=interval)
+
+    columns = ', '.join(INSERT_COLUMNS)
+    cursor.execute(f"INSERT INTO public.{table_name} ({columns}) SELECT {columns} FROM public.{UNPARTITIONED_TABLE} "
+                   f"WHERE received IS NOT NULL")
+    logging.info(f"Copied {cursor.rowcount} rows into the partitioned {table_name}")
+    cursor.execute(f"SELECT count(*) FROM public.{UNPARTITIONED_TABLE} WHERE received IS NULL")
+    left = cursor.fetchone()[0]
+    if left:
+        logging.warning(f"{left} rows without a received date were left in {UNPARTITIONED_TABLE}")
+    create_indexes(cursor)
+
+# Optional migration, applied with 'python partitions.py migrate' rather than by schema.migrate
+PARTITION_MIGRATIONS = [
+    (4, f"Partition {table_name} by received {PARTITION_INTERVAL}", _partition_table),
+]
+
+def detach_partition(cursor, name):
+    """
+    Detach a partition from ceqa_data. Its rows stay in the now standalone table.
+
+    Args:
+        cursor: A psycopg2 cursor.
+        name (str): The partition name.
+    """
+    cursor.execute(f"ALTER TABLE public.{table_name} DETACH PARTITION public.{name}")
+    logging.info(f"Detached partition {name}")
+
+def archive_partition(cursor, name, blob_store, prefix=PARTITION_ARCHIVE_PREFIX):
+    """
+    Export a (detached) partition as a gzipped CSV with a header row to blob storage.
+
+    Args:
+        cursor: A psycopg2 cursor.
+        name (str): The table to export.
+        blob_store (AzureBlobStore or LocalBlobStore): Where the export is uploaded.
+        prefix (str): Blob name prefix.
+
+    Returns:
+        str: The blob name of the export.
+    """
+    blob_name = f"{prefix}/{name}.csv.gz"
+    # Spooled through a temporary file, so a large partition never has to fit in memory
+    with tempfile.NamedTemporaryFile(suffix='.csv.gz', delete=False) as file:
+        temp_path = file.name
+        with gzip.GzipFile(fileobj=file, mode='wb') as target:
+            cursor.copy_expert(f"COPY public.{name} TO STDOUT WITH (FORMAT csv, HEADER)", target)
+    try:
+        blob_store.upload_file(blob_name, temp_path)
+    finally:
+        os.remove(temp_path)
+    logging.info(f"Archived {name} to {blob_name}")
+    return blob_name
+
+def retire_partitions(connection, before, blob_store=None, drop=False, prefix=PARTITION_ARCHIVE_PREFIX,
+                      interval=PARTITION_INTERVAL):
+    """
+    Detach every partition holding only dates before a cutoff, optionally archiving and dropping it.
+    The cutoff is stored first, in RETENTION_TABLE, so later loads leave out the rows received before
+    it and never create their partitions again. Each partition is then handled in its own transaction;
+    one is only dropped once archived.
+
+    Args:
+        connection: A psycopg2 connection.
+        before (date): Partitions ending on or before this date are retired.
+        blob_store (AzureBlobStore or LocalBlobStore): Archive detached partitions here when given.
+        drop (bool): Drop each partition once detached (and archived, when blob_store is given).
+        prefix (str): Blob name prefix of the archives.
+        interval (str): 'year' or 'month', the interval of the partitions.
+
+    Returns:
+        list: Names of the retired partitions.
+    """
+    # The cutoff is the partition boundary on or before the date, so no partition is cut in two
+    cutoff = partition_bounds(before, interval)[0]
+    if cutoff > partition_bounds(date.today(), interval)[0]:
+        raise ValueError(f"Cannot retire the current partition: {before} is after its start.")
+    with connection.cursor() as cursor:
+        cutoff = set_retention_cutoff(cursor, cutoff)
+        partitions = [name for name, _, end in list_partitions(cursor) if end <= cutoff]
+    connection.commit()
+
+    retired = []
+    for name in partitions:
+        with connection.cursor() as cursor:
+            try:
+                detach_partition(cursor, name)
+                if blob_store is not None:
+                    archive_partition(cursor, name, blob_store, prefix)
+                if drop:
+                    cursor.execute(f"DROP TABLE public.{name}")
+                    logging.info(f"Dropped partition {name}")
+                connection.commit()
+            except Exception as e:
+                connection.rollback()
+                logging.error(f"Error retiring partition {name}: {e}")
+                raise
+        retired.append(name)
+    return retired
+
+if __name__ == "__main__":
+    # Usage:
+    #   python partitions.py migrate                  apply the schema migrations, then partition ceqa_data
+    #   python partitions.py ensure [AHEAD]           create the current and next partitions
+    #   python partitions.py list                     list the partitions
+    #   python partitions.py retire YEAR [--archive] [--drop]
+    #                                                 detach partitions before YEAR, whose rows are no
+    #                                                 longer loaded
+    from utils import db_connection
+    from blob_store import get_blob_store
+    from metrics import configure_logging
+    configure_logging()
+
+    args = sys.argv[1:]
+    if not args or args[0] not in ('migrate', 'ensure', 'list', 'retire'):
+        print("Usage: python partitions.py migrate | ensure [AHEAD] | list | retire YEAR [--archive] [--drop]")
+        sys.exit(1)
+
+    connection = db_connection()
+    try:
+        command = args[0]
+        if command == 'migrate':
+            # The base schema first, the partitioned table is created with its final column types
+            print(f"Applied migrations: {migrate(connection, MIGRATIONS + PARTITION_MIGRATIONS) or 'none'}")
+        elif command == 'ensure':
+            with connection.cursor() as cursor:
+                ahead = int(args[1]) if len(args) > 1 else PARTITION_AHEAD
+                print(f"Created partitions: {ensure_future_partitions(cursor, ahead) or 'none'}")
+            connection.commit()
+        elif command == 'list':
+            with connection.cursor() as cursor:
+                for name, start, end in list_partitions(cursor):
+                    print(f"{name:<30} {start} .. {end}")
+                cutoff = retention_cutoff(cursor)
+                if cutoff is not None:
+                    print(f"Rows received before {cutoff} are retired")
+        else:
+            store = get_blob_store() if '--archive' in args else None
+            retired = retire_partitions(connection, date(int(args[1]), 1, 1), store, drop='--drop' in args)
+            print(f"Retired partitions: {retired or 'none'}")
+    finally:
+        connection.close()
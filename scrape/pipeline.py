@@ -0,0 +1,137 @@
+import logging
+import queue
+import threading
+
+# Sentinel placed on a queue to tell a stage worker to shut down
+_STOP = object()
+
+class Stage:
+    """
+    A single step of a StagePipeline.
+
+    Args:
+        name (str): Name of the stage, used in logs and error reports.
+        func (callable): Function called with each item. It returns the item to pass
+            to the next stage, or None to drop the item from the pipeline.
+        workers (int): Number of worker threads running this stage (default is 1).
+    """
+
+    def __init__(self, name, func, workers=1):
+        if workers < 1:
+            raise ValueError(f"Stage {name} needs at least one worker.")
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+class StagePipeline:
+    """
+    Run items through a sequence of stages connected by bounded queues, so that
+    different items can be in different stages at the same time.
+
+    A failing item is reported to `on_error` and dropped; the other items keep flowing.
+    """
+
+    def __init__(self, stages, queue_size=4, on_error=None):
+        """
+        Initialize the pipeline.
+
+        Args:
+            stages (list): List of Stage objects, in execution order.
+            queue_size (int): Maximum number of items waiting in front of each stage (default is 4).
+            on_error (callable): Called as on_error(item, stage_name, exception) when a stage fails.
+        """
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage.")
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_error = on_error
+
+    def run(self, items):
+        """
+        Feed the items through every stage and wait for the pipeline to drain.
+
+        If the items raise, the items already fed finish their stages before the error is raised.
+        If a stage raises something that is not an Exception (e.g. SystemExit), every worker drops
+        the items it takes from then on, and the error is raised once the pipeline has drained.
+
+        Args:
+            items (iterable): Items to process.
+
+        Returns:
+            list: Items that made it through the last stage, in completion order.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        results = []
+        results_lock = threading.Lock()
+        fatal = []  # Errors that stop the run, raised once every worker is done
+
+        # Count the live workers of each stage so the last one out can stop the next stage
+        remaining = [stage.workers for stage in self.stages]
+        remaining_lock = threading.Lock()
+
+        def worker(index):
+            stage = self.stages[index]
+            inbox = queues[index]
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+
+            try:
+                while True:
+                    item = inbox.get()
+                    if item is _STOP:
+                        break
+                    if fatal:
+                        continue  # Drain without processing so the stages before this one are not blocked
+                    try:
+                        result = stage.func(item)
+                    except Exception as e:
+                        logging.error(f"Stage {stage.name} failed: {e}")
+                        if self.on_error:
+                            try:
+                                self.on_error(item, stage.name, e)
+                            except Exception as handler_error:
+                                logging.error(f"Error handler for stage {stage.name} failed: {handler_error}")
+                        continue
+                    except BaseException as e:
+                        logging.error(f"Stage {stage.name} stopped the pipeline: {e!r}")
+                        fatal.append(e)
+                        continue
+
+                    if result is None:
+                        continue
+                    if outbox is not None:
+                        outbox.put(result)
+                    else:
+                        with results_lock:
+                            results.append(result)
+            finally:
+                with remaining_lock:
+                    remaining[index] -= 1
+                    last_worker = remaining[index] == 0
+                if last_worker and outbox is not None:
+                    for _ in range(self.stages[index + 1].workers):
+                        outbox.put(_STOP)
+
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                thread = threading.Thread(target=worker, args=(index,), name=f"{stage.name}-{n}", daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        logging.debug(f"Pipeline started with stages: {[(s.name, s.workers) for s in self.stages]}")
+
+        try:
+            for item in items:
+                if fatal:
+                    break
+                queues[0].put(item)
+        finally:
+            # Also when the items raise, so the workers finish and the error is raised after them
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_STOP)
+            for thread in threads:
+                thread.join()
+
+        if fatal:
+            raise fatal[0]
+        return results
@@ -0,0 +1,112 @@
+import pandas as pd
+from const import KEEPS, CATEGORY_COLUMNS, CSV_ENCODING, CSV_ENGINE
+
+try:
+    import pyarrow
+    from pyarrow import csv as pyarrow_csv
+except ImportError:  # pyarrow is optional, the C engine is always available
+    pyarrow = None
+
+# Strings read as missing values, the defaults of pd.read_csv so both engines agree
+NULL_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+               '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+def export_dtypes(columns=KEEPS):
+    """
+    Return the dtype declared for each column of an export.
+
+    Args:
+        columns (list): The columns to parse (default is KEEPS).
+
+    Returns:
+        dict: Column name to 'category' for CATEGORY_COLUMNS, str for the others.
+    """
+    return {column: 'category' if column in CATEGORY_COLUMNS else str for column in columns}
+
+def resolve_engine(engine=CSV_ENGINE):
+    """
+    Return the CSV parser to use: 'pyarrow' or 'c'. 'auto' picks pyarrow when it is installed.
+
+    Args:
+        engine (str): 'auto', 'pyarrow' or 'c'.
+
+    Returns:
+        str: 'pyarrow' or 'c'.
+    """
+    if engine == 'auto':
+        return 'pyarrow' if pyarrow is not None else 'c'
+    if engine == 'pyarrow' and pyarrow is None:
+        raise ValueError("The pyarrow CSV engine requires the 'pyarrow' package.")
+    if engine not in ('pyarrow', 'c'):
+        raise ValueError(f"Unknown CSV engine '{engine}', expected 'auto', 'pyarrow' or 'c'.")
+    return engine
+
+def _read_pyarrow(source, columns):
+    # Called directly rather than through pd.read_csv(engine='pyarrow'), which cannot parse the
+    # line breaks CEQAnet leaves inside quoted descriptions. The export is transcoded from
+    # CSV_ENCODING to UTF-8 as it is read, and categoricals come out of dictionary-encoded columns
+    column_types = {
+        column: pyarrow.dictionary(pyarrow.int32(), pyarrow.string()) if column in CATEGORY_COLUMNS
+        else pyarrow.string()
+        for column in columns
+    }
+    table = pyarrow_csv.read_csv(
+        source,
+        read_options=pyarrow_csv.ReadOptions(encoding=CSV_ENCODING),
+        parse_options=pyarrow_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pyarrow_csv.ConvertOptions(
+            include_columns=list(columns),
+            column_types=column_types,
+            null_values=NULL_VALUES,
+            strings_can_be_null=True,
+        ),
+    )
+    return table.to_pandas()
+
+def read_export(source, columns=KEEPS, engine=CSV_ENGINE, nrows=None, chunksize=None):
+    """
+    Read a CEQAnet export, parsing only the given columns with their declared dtypes.
+
+    The pyarrow engine reads the whole export at once; reading a number of rows or in chunks
+    always uses the C engine.
+
+    Args:
+        source (str or file-like): The path to the CSV file, or a buffer holding it.
+        columns (list): The columns to parse, in the order they are returned (default is KEEPS).
+        engine (str): 'auto', 'pyarrow' or 'c' (default is CSV_ENGINE).
+        nrows (int): Only read the first nrows rows.
+        chunksize (int): Return an iterator of DataFrames of chunksize rows instead.
+
+    Returns:
+        pd.DataFrame or TextFileReader: The export, or an iterator over its chunks.
+    """
+    if nrows is None and chunksize is None and resolve_engine(engine) == 'pyarrow':
+        return _read_pyarrow(source, columns)
+
+    reader = pd.read_csv(source, encoding=CSV_ENCODING, usecols=columns, dtype=export_dtypes(columns),
+                         nrows=nrows, chunksize=chunksize)
+    if chunksize is not None:
+        return reader
+    # usecols keeps the order of the file
+    return reader if list(reader.columns) == list(columns) else reader.loc[:, columns]
+
+def fill_missing(df, value='Unknown'):
+    """
+    Replace the missing values of every column with a placeholder. The placeholder is first
+    added to the categories of categorical columns, which cannot hold a value outside them.
+
+    Args:
+        df (pd.DataFrame): Columns as returned by read_export.
+        value (str): The placeholder (default is 'Unknown').
+
+    Returns:
+        pd.DataFrame: A DataFrame without missing values.
+    """
+    categoricals = {
+        column: df[column].cat.add_categories([value])
+        for column in df.columns
+        if isinstance(df[column].dtype, pd.CategoricalDtype) and value not in df[column].cat.categories
+    }
+    if categoricals:
+        df = df.assign(**categoricals)
+    return df.fillna(value)
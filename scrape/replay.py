@@ -0,0 +1,50 @@
+import sys
+import argparse
+from datetime import datetime
+from data_processor import CEQADataProcessor
+from snapshots import SnapshotStore
+from metrics import configure_logging, metrics_from_env
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Transform and load stored export snapshots again, without fetching anything.")
+    parser.add_argument('--root', help="Snapshot directory (default is SNAPSHOT_DIR).")
+    parser.add_argument('--agency', action='append', help="Only replay this agency; may be repeated.")
+    parser.add_argument('--since', type=datetime.fromisoformat, help="Only snapshots fetched at or after this time.")
+    parser.add_argument('--until', type=datetime.fromisoformat,
+                        help="Only snapshots fetched at or before this time, e.g. to rebuild the state of a past day.")
+    parser.add_argument('--workers', type=int, default=4, help="Threads transforming snapshots (default is 4).")
+    parser.add_argument('--load-workers', type=int, default=1, help="Threads loading into the database (default is 1).")
+    parser.add_argument('--dry-run', action='store_true', help="Only run the transforms and report the row counts.")
+    parser.add_argument('--delta', action='store_true', help="Only load new or changed rows (see delta.py).")
+    parser.add_argument('--partitioned', action='store_true', help="ceqa_data is partitioned (see partitions.py).")
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    # Usage: python replay.py [--agency NAME ...] [--since TIME] [--until TIME] [--workers N] [--dry-run]
+    # The latest snapshot of every selected agency is replayed
+    args = parse_args(sys.argv[1:])
+    configure_logging()
+    snapshots = SnapshotStore(args.root).latest(args.agency, args.since, args.until)
+    if not snapshots:
+        print("No snapshots to replay")
+        sys.exit(0)
+
+    db_pool = None
+    if not args.dry_run:
+        from db_pool import get_db_pool
+        from schema import migrate
+        db_pool = get_db_pool()
+        with db_pool.connection() as connection:
+            migrate(connection)
+
+    # Metrics outputs and profiling are set in the environment, see metrics_from_env
+    metrics = metrics_from_env()
+    metrics.table = metrics.table and not args.dry_run
+    processor = CEQADataProcessor(table_name="ceqa_data", db_pool=db_pool, typed=True, delta=args.delta,
+                                  partitioned=args.partitioned, metrics=metrics)
+    done = processor.replay(snapshots, load=not args.dry_run, transform_workers=args.workers,
+                            load_workers=args.load_workers)
+    print(f"Replayed {len(done)} of {len(snapshots)} agencies")
+    for agency, counts in sorted(processor.run_report.items()):
+        print(f"{agency}: {counts}")
@@ -0,0 +1,296 @@
+import sys
+import logging
+import pandas as pd
+from const import (table_name, COLUMN_SPECS, INSERT_COLUMNS, MIGRATIONS_TABLE, PARCEL_TABLE, ROW_HASH_TABLE,
+                   ENTRY_ID_DATE_FACTOR, MAX_SCH_NUMBER)
+
+# Indexes serving the queries of frontend/utils.py: the city / document type filters combined
+# with a recent 'received' window, the DISTINCT lists of the filter widgets, and project lookups
+INDEXES = {
+    f"{table_name}_received_idx": "(received)",
+    f"{table_name}_agency_received_idx": "(lead_agency_title, received)",
+    f"{table_name}_type_details_received_idx": "(document_type_details, received)",
+    f"{table_name}_sch_number_idx": "(sch_number)",
+}
+
+# Yes/No answers of the NOD columns
+BOOLEAN_VALUES = {'yes': True, 'y': True, 'true': True, 'no': False, 'n': False, 'false': False}
+
+# First number of a free-text acreage, e.g. '7,153' or '20 acres'
+_NUMBER = r'(-?\d+(?:\.\d+)?)'
+
+def column_type(column):
+    """
+    Return the SQL type declared for a column of ceqa_data.
+
+    Args:
+        column (str): The database column name.
+
+    Returns:
+        str: The type, e.g. 'DATE' or 'VARCHAR(50)'.
+    """
+    sql_type, width = COLUMN_SPECS[column]
+    return f"{sql_type}({width})" if width else sql_type
+
+def create_table_query():
+    """Build the CREATE TABLE statement of ceqa_data from COLUMN_SPECS."""
+    columns = ',\n    '.join(f"{column} {column_type(column)}" for column in COLUMN_SPECS)
+    return f"""
+CREATE TABLE IF NOT EXISTS public.{table_name} (
+    {columns},
+    PRIMARY KEY (entry_id)
+);
+"""
+
+def _conversion(column):
+    # SQL expression turning the current value of a column, whatever its type, into the declared type.
+    # The text the pipeline used to store for missing values becomes a real NULL
+    value = f"NULLIF(NULLIF(btrim({column}::text), 'Unknown'), '')"
+    sql_type, width = COLUMN_SPECS[column]
+    if sql_type == 'DATE':
+        return (f"CASE WHEN {value} ~ '^\\d{{1,2}}/\\d{{1,2}}/\\d{{4}}$' THEN to_date({value}, 'MM/DD/YYYY') "
+                f"ELSE {value}::date END")
+    if sql_type == 'NUMERIC':
+        return f"substring(replace({value}, ',', '') from '{_NUMBER}')::numeric"
+    if sql_type == 'BOOLEAN':
+        return f"CASE lower({value}) WHEN 'yes' THEN true WHEN 'no' THEN false WHEN 'true' THEN true WHEN 'false' THEN false END"
+    if sql_type == 'VARCHAR':
+        return f"left({value}, {width})"
+    return value
+
+def _create_table(cursor):
+    cursor.execute(create_table_query())
+
+def _convert_columns(cursor):
+    # Only columns whose type differs from COLUMN_SPECS are rewritten, in a single ALTER TABLE
+    cursor.execute(
+        """
+        SELECT column_name, upper(data_type), character_maximum_length
+        FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = %s
+        """,
+        (table_name,),
+    )
+    current = {name: (data_type, width) for name, data_type, width in cursor.fetchall()}
+    aliases = {'CHARACTER VARYING': 'VARCHAR'}
+
+    changes = []
+    placeholders = []
+    for column, (sql_type, width) in COLUMN_SPECS.items():
+        if column not in current or column == 'entry_id':
+            continue
+        data_type, current_width = current[column]
+        if (aliases.get(data_type, data_type), current_width) == (sql_type, width):
+            if sql_type in ('TEXT', 'VARCHAR'):
+                placeholders.append(column)
+            continue
+        changes.append(f"ALTER COLUMN {column} TYPE {column_type(column)} USING {_conversion(column)}")
+        logging.info(f"Converting {table_name}.{column} from {data_type} to {column_type(column)}")
+
+    if changes:
+        cursor.execute(f"ALTER TABLE public.{table_name}\n    " + ',\n    '.join(changes))
+
+    # Text columns keep their type, only the 'Unknown' placeholders become NULLs
+    if placeholders:
+        assignments = ', '.join(f"{column} = NULLIF({column}, 'Unknown')" for column in placeholders)
+        condition = ' OR '.join(f"{column} = 'Unknown'" for column in placeholders)
+        cursor.execute(f"UPDATE public.{table_name} SET {assignments} WHERE {condition}")
+        logging.info(f"Replaced 'Unknown' placeholders with NULL in {cursor.rowcount} rows")
+
+def _entry_id_key():
+    # SQL expression of the entry_id built by utils.build_entry_ids, from a stored row
+    return (f"btrim(sch_number::text)::bigint * {ENTRY_ID_DATE_FACTOR} "
+            f"+ to_char({_conversion('received')}, 'YYYYMMDD')::bigint")
+
+def _rekey_table(cursor, table, primary_key):
+    # Swap the text entry_id of a table referencing ceqa_data for the new key, through entry_id_map.
+    # A new column avoids transient duplicates between old and new keys; rows of filings no longer
+    # in ceqa_data are dropped
+    cursor.execute("SELECT to_regclass(%s)", (f"public.{table}",))
+    if cursor.fetchone()[0] is None:
+        return
+    cursor.execute(f"ALTER TABLE public.{table} ADD COLUMN new_entry_id BIGINT")
+    cursor.execute(f"UPDATE public.{table} t SET new_entry_id = m.new_id FROM entry_id_map m "
+                   f"WHERE m.old_id = t.entry_id::text")
+    cursor.execute(f"DELETE FROM public.{table} WHERE new_entry_id IS NULL")
+    if cursor.rowcount:
+        logging.info(f"Dropped {cursor.rowcount} rows of {table} without a filing in {table_name}")
+    cursor.execute(f"ALTER TABLE public.{table} DROP COLUMN entry_id")
+    cursor.execute(f"ALTER TABLE public.{table} RENAME COLUMN new_entry_id TO entry_id")
+    cursor.execute(f"ALTER TABLE public.{table} ALTER COLUMN entry_id SET NOT NULL, ADD PRIMARY KEY ({primary_key})")
+
+def _compact_entry_ids(cursor):
+    # Replace the concatenated text keys, where month 1 + day 11 and month 11 + day 1 collide,
+    # with the BIGINT key, in ceqa_data and in the parcel and row hash tables
+    cursor.execute(
+        "SELECT upper(data_type) FROM information_schema.columns "
+        "WHERE table_schema = 'public' AND table_name = %s AND column_name = 'entry_id'",
+        (table_name,),
+    )
+    row = cursor.fetchone()
+    if row is None or row[0] == 'BIGINT':
+        return
+
+    cursor.execute(
+        f"SELECT count(*) FROM public.{table_name} "
+        f"WHERE CASE WHEN btrim(sch_number::text) ~ '^\\d{{1,{len(str(MAX_SCH_NUMBER))}}}$' "
+        f"THEN btrim(sch_number::text)::numeric >= {MAX_SCH_NUMBER} ELSE true END "
+        f"OR ({_conversion('received')}) IS NULL"
+    )
+    invalid = cursor.fetchone()[0]
+    if invalid:
+        raise ValueError(f"{invalid} rows of {table_name} have no numeric SCH number or received date "
+                         f"to build an entry_id from.")
+
+    cursor.execute(f"CREATE TEMP TABLE entry_id_map ON COMMIT DROP AS "
+                   f"SELECT entry_id::text AS old_id, {_entry_id_key()} AS new_id FROM public.{table_name}")
+    _rekey_table(cursor, PARCEL_TABLE, "entry_id, parcel")
+    _rekey_table(cursor, ROW_HASH_TABLE, "entry_id")
+    cursor.execute(f"ALTER TABLE public.{table_name} ALTER COLUMN entry_id TYPE BIGINT USING {_entry_id_key()}")
+    logging.info(f"Converted the entry_id of {table_name} to BIGINT keys")
+
+def create_indexes(cursor):
+    """Create the INDEXES on ceqa_data if they do not exist (on every partition when it is partitioned)."""
+    for name, columns in INDEXES.items():
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON public.{table_name} {columns}")
+    cursor.execute(f"ANALYZE public.{table_name}")
+
+# Ordered migrations: (version, description, function applying it to a cursor)
+MIGRATIONS = [
+    (1, f"Create {table_name} with typed columns", _create_table),
+    (2, f"Convert the columns of an existing {table_name} to their declared types", _convert_columns),
+    (3, "Create the indexes used by the frontend queries", create_indexes),
+    (5, "Replace the text entry_id with the BIGINT key of SCH number and received date", _compact_entry_ids),
+]
+
+def ensure_migrations_table(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS public.{MIGRATIONS_TABLE} (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+    """)
+
+def applied_versions(connection):
+    """
+    Return the versions of the migrations already applied.
+
+    Args:
+        connection: A psycopg2 connection.
+
+    Returns:
+        set: The applied versions.
+    """
+    with connection.cursor() as cursor:
+        ensure_migrations_table(cursor)
+        cursor.execute(f"SELECT version FROM public.{MIGRATIONS_TABLE}")
+        versions = {row[0] for row in cursor.fetchall()}
+    connection.commit()
+    return versions
+
+def migrate(connection, migrations=MIGRATIONS):
+    """
+    Apply the pending migrations in order, each in its own transaction.
+
+    A transaction-level advisory lock serializes concurrent runs, so two workers starting
+    together never apply the same migration twice.
+
+    Args:
+        connection: A psycopg2 connection.
+        migrations (list): (version, description, function) tuples (default is MIGRATIONS).
+
+    Returns:
+        list: The versions applied by this call.
+    """
+    applied = []
+    for version, description, apply in migrations:
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (MIGRATIONS_TABLE,))
+                ensure_migrations_table(cursor)
+                cursor.execute(f"SELECT 1 FROM public.{MIGRATIONS_TABLE} WHERE version = %s", (version,))
+                if cursor.fetchone():
+                    connection.commit()
+                    continue
+                logging.info(f"Applying migration {version}: {description}")
+                apply(cursor)
+                cursor.execute(
+                    f"INSERT INTO public.{MIGRATIONS_TABLE} (version, description) VALUES (%s, %s)",
+                    (version, description),
+                )
+                connection.commit()
+            except Exception as e:
+                connection.rollback()
+                logging.error(f"Migration {version} failed: {e}")
+                raise
+        applied.append(version)
+    return applied
+
+def _parse_dates(values):
+    # CEQAnet dates are 'M/D/YYYY'; values already parsed or in ISO format are kept as they are
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    text = values.astype('string').str.strip()
+    parsed = pd.to_datetime(text, format='%m/%d/%Y', errors='coerce')
+    retry = parsed.isna() & text.notna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(text[retry], format='ISO8601', errors='coerce')
+    return parsed
+
+def to_db_types(df, columns=INSERT_COLUMNS):
+    """
+    Convert the final rows to the types declared in COLUMN_SPECS, one vectorized pass per column.
+    Missing values, blanks, the 'Unknown' placeholder and unparsable values all become None,
+    so they are stored as real NULLs.
+
+    Args:
+        df (pd.DataFrame): The reordered rows, one column per database column, in the given order.
+        columns (list): The database column of each DataFrame column (default is INSERT_COLUMNS).
+
+    Returns:
+        pd.DataFrame: The same columns as object columns holding datetime.date, float, bool, str or None.
+    """
+    converted = []
+    for position, column in enumerate(columns):
+        values = df.iloc[:, position]
+        sql_type = COLUMN_SPECS[column][0]
+        if sql_type == 'DATE':
+            parsed = _parse_dates(values)
+            result = parsed.dt.date.astype(object)
+        elif sql_type == 'BIGINT':
+            result = pd.to_numeric(values, errors='coerce').astype('Int64').astype(object)
+        else:
+            text = values.astype('string')
+            text = text.mask(text.str.strip().isin(['Unknown', '']))
+            if sql_type == 'NUMERIC':
+                number = text.str.replace(',', '', regex=False).str.extract(_NUMBER, expand=False)
+                result = pd.to_numeric(number, errors='coerce').astype(object)
+            elif sql_type == 'BOOLEAN':
+                result = text.str.strip().str.lower().map(BOOLEAN_VALUES).astype(object)
+            else:
+                result = text.astype(object)
+        array = result.to_numpy(dtype=object, copy=True)
+        array[pd.isna(array)] = None
+        converted.append(array)
+
+    # Object columns throughout, so None is not turned back into NaN
+    typed = pd.DataFrame(dict(enumerate(converted)), index=df.index, dtype=object)
+    typed.columns = df.columns
+    return typed
+
+if __name__ == "__main__":
+    # Usage: python schema.py [--status]
+    from utils import db_connection
+    from metrics import configure_logging
+    configure_logging()
+    connection = db_connection()
+    try:
+        if '--status' in sys.argv[1:]:
+            done = applied_versions(connection)
+            for version, description, _ in MIGRATIONS:
+                print(f"{version:>4}  {'applied' if version in done else 'pending':<8} {description}")
+        else:
+            print(f"Applied migrations: {migrate(connection) or 'none'}")
+    finally:
+        connection.close()
@@ -0,0 +1,190 @@
+import io
+import os
+import logging
+import threading
+from datetime import datetime
+import pandas as pd
+from const import KEEPS, CATEGORY_COLUMNS, CSV_ENCODING, SNAPSHOT_DIR, SNAPSHOT_COMPRESSION
+from archive import agency_slug
+from reader import NULL_VALUES
+
+try:
+    import pyarrow
+    from pyarrow import csv as pyarrow_csv
+    from pyarrow import parquet as pyarrow_parquet
+except ImportError:  # pyarrow is optional, snapshots are only available with it
+    pyarrow = None
+
+# Parquet metadata keys describing a snapshot
+AGENCY_KEY = b'ceqa.agency'
+FETCHED_AT_KEY = b'ceqa.fetched_at'
+SHA256_KEY = b'ceqa.sha256'
+
+# Fetch time in snapshot file names
+_TIME_FORMAT = '%Y%m%dT%H%M%S'
+
+def read_raw_export(source):
+    """
+    Parse every column of a CEQAnet export as text, with nothing inferred, into an Arrow table.
+
+    Args:
+        source (str, bytes or file-like): The path to the CSV file, or its content.
+
+    Returns:
+        pyarrow.Table: One string column per column of the export.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    # The header is read first, so every column can be declared a string
+    columns = list(pd.read_csv(source, encoding=CSV_ENCODING, nrows=0).columns)
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return pyarrow_csv.read_csv(
+        source,
+        read_options=pyarrow_csv.ReadOptions(encoding=CSV_ENCODING),
+        parse_options=pyarrow_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pyarrow_csv.ConvertOptions(
+            column_types={column: pyarrow.string() for column in columns},
+            null_values=NULL_VALUES,
+            strings_can_be_null=True,
+        ),
+    )
+
+class Snapshot:
+    """
+    A raw export stored by a SnapshotStore: its agency, fetch time, content hash and Parquet file.
+    """
+
+    def __init__(self, agency, fetched_at, path, sha256=None):
+        self.agency = agency
+        self.fetched_at = fetched_at
+        self.path = path
+        self.sha256 = sha256
+
+    def read(self, columns=KEEPS):
+        """
+        Read the snapshot as reader.read_export reads an export: only the given columns,
+        CATEGORY_COLUMNS as categoricals and the others as strings.
+
+        Args:
+            columns (list): The columns to read, in order (default is KEEPS).
+
+        Returns:
+            pd.DataFrame: The export.
+        """
+        table = pyarrow_parquet.read_table(self.path, columns=list(columns))
+        for position, column in enumerate(table.column_names):
+            if column in CATEGORY_COLUMNS:
+                table = table.set_column(position, column, table.column(column).dictionary_encode())
+        return table.to_pandas()
+
+    def __repr__(self):
+        return f"Snapshot({self.agency!r}, {self.fetched_at.isoformat(timespec='seconds')})"
+
+class SnapshotStore:
+    """
+    Local store of raw agency exports as Parquet files, one per download, so the transforms
+    can be re-run over past exports without fetching them again:
+
+        {root}/{agency-slug}/{YYYYMMDDTHHMMSS}.parquet
+
+    Every column of the export is kept as text. The agency name, fetch time and content hash
+    are stored in the Parquet metadata.
+    """
+
+    def __init__(self, root=None, compression=SNAPSHOT_COMPRESSION):
+        """
+        Args:
+            root (str): Directory holding the snapshots. Defaults to SNAPSHOT_DIR.
+            compression (str): Parquet compression codec, e.g. 'zstd' or 'snappy'.
+        """
+        if pyarrow is None:
+            raise ValueError("Snapshots require the 'pyarrow' package.")
+        self.root = root or os.getenv('SNAPSHOT_DIR', SNAPSHOT_DIR)
+        self.compression = compression
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, agency, fetched_at):
+        """Path of the snapshot of an agency fetched at a given time."""
+        return os.path.join(self.root, agency_slug(agency), f"{fetched_at.strftime(_TIME_FORMAT)}.parquet")
+
+    def save(self, agency, source, fetched_at=None, sha256=None):
+        """
+        Store a raw export.
+
+        Args:
+            agency (str): The agency the export belongs to.
+            source (str, bytes or file-like): The path to the CSV file, or its content.
+            fetched_at (datetime): When the export was downloaded (default is now).
+            sha256 (str): Hash of the export if known, e.g. from the fetcher.
+
+        Returns:
+            Snapshot: The stored snapshot.
+        """
+        fetched_at = fetched_at or datetime.now()
+        table = read_raw_export(source)
+        metadata = dict(table.schema.metadata or {})
+        metadata.update({
+            AGENCY_KEY: agency.encode('utf-8'),
+            FETCHED_AT_KEY: fetched_at.isoformat().encode('utf-8'),
+            SHA256_KEY: (sha256 or '').encode('utf-8'),
+        })
+        table = table.replace_schema_metadata(metadata)
+
+        # Written next to the target and renamed, so a replay never reads a partial snapshot
+        path = self.path(agency, fetched_at)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        pyarrow_parquet.write_table(table, tmp_path, compression=self.compression)
+        os.replace(tmp_path, path)
+        logging.info(f"Saved snapshot of {agency} with {table.num_rows} rows to {path}")
+        return Snapshot(agency, fetched_at, path, sha256)
+
+    def list(self, agencies=None, since=None, until=None):
+        """
+        List the stored snapshots, oldest first.
+
+        Args:
+            agencies (list): Only the snapshots of these agencies (default is every agency).
+            since (datetime): Only the snapshots fetched at or after this time.
+            until (datetime): Only the snapshots fetched at or before this time.
+
+        Returns:
+            list: Snapshot objects.
+        """
+        slugs = {agency_slug(agency) for agency in agencies} if agencies else None
+        snapshots = []
+        for slug in sorted(os.listdir(self.root)):
+            directory = os.path.join(self.root, slug)
+            if not os.path.isdir(directory) or (slugs is not None and slug not in slugs):
+                continue
+            for file_name in sorted(os.listdir(directory)):
+                if not file_name.endswith('.parquet'):
+                    continue
+                path = os.path.join(directory, file_name)
+                # Only the footer is read
+                metadata = pyarrow_parquet.read_schema(path).metadata or {}
+                agency = metadata.get(AGENCY_KEY, slug.encode('utf-8')).decode('utf-8')
+                if agencies and agency not in agencies:
+                    continue
+                if FETCHED_AT_KEY in metadata:
+                    fetched_at = datetime.fromisoformat(metadata[FETCHED_AT_KEY].decode('utf-8'))
+                else:
+                    fetched_at = datetime.strptime(file_name[:-len('.parquet')], _TIME_FORMAT)
+                if (since and fetched_at < since) or (until and fetched_at > until):
+                    continue
+                sha256 = metadata.get(SHA256_KEY, b'').decode('utf-8') or None
+                snapshots.append(Snapshot(agency, fetched_at, path, sha256))
+        return sorted(snapshots, key=lambda snapshot: snapshot.fetched_at)
+
+    def latest(self, agencies=None, since=None, until=None):
+        """
+        Return the most recent snapshot of every agency, see list.
+
+        Returns:
+            list: One Snapshot per agency, oldest first.
+        """
+        latest = {}
+        for snapshot in self.list(agencies, since, until):
+            latest[snapshot.agency] = snapshot
+        return sorted(latest.values(), key=lambda snapshot: snapshot.fetched_at)
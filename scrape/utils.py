@@ -1,22 +1,37 @@
+import io
 import os
+import hashlib
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 import numpy as np
 import logging
-from azure.storage.blob import BlobServiceClient
-from azure.storage.blob import BlobClient
 from dotenv import load_dotenv
 import psycopg2
 from datetime import datetime
 from psycopg2 import sql
-from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
-from azure.storage.blob import BlobServiceClient
+from blob_store import get_blob_store
+from parcels import default_expander
+from const import HTTP_TIMEOUT, HTTP_POOL_SIZE, DOWNLOAD_CHUNK_SIZE, ENTRY_ID_DATE_FACTOR, MAX_SCH_NUMBER, COLUMN_SPECS
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+def db_connection_params():
+    """
+    Read the PostgreSQL connection settings from the environment.
+
+    Returns:
+        dict: Keyword arguments for psycopg2.connect.
+    """
+    return {
+        'host': os.getenv('DB_HOST'),
+        'dbname': os.getenv('DB_NAME'),
+        'user': os.getenv('DB_USER'),
+        'password': os.getenv('DB_PASSWORD'),
+        'port': os.getenv('DB_PORT'),
+    }
 
 def db_connection():
     """
@@ -26,26 +41,113 @@ def db_connection():
         connection: A psycopg2 connection object.
     """
     try:
-        db_host = os.getenv('DB_HOST')
-        db_name = os.getenv('DB_NAME')
-        db_user = os.getenv('DB_USER')
-        db_password = os.getenv('DB_PASSWORD')
-        db_port = os.getenv('DB_PORT')
-
-        logging.debug(f"Connecting to database {db_name} on host {db_host}")
-        connection = psycopg2.connect(
-            host=db_host,
-            dbname=db_name,
-            user=db_user,
-            password=db_password,
-            port=db_port
-        )
+        params = db_connection_params()
+        logging.debug(f"Connecting to database {params['dbname']} on host {params['host']}")
+        connection = psycopg2.connect(**params)
         logging.info("Database connection established successfully")
         return connection
     except Exception as e:
         logging.error(f"Error connecting to database: {e}")
         raise
 
+# Shared HTTP session so every download reuses pooled keep-alive connections
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """
+    Return the process-wide requests session used for CEQAnet downloads.
+    
+    Returns:
+        requests.Session: A session with a pooled, keep-alive connection adapter.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+            logging.debug(f"Created HTTP session with pool size {HTTP_POOL_SIZE}")
+        return _http_session
+
+def build_download_url(city_name, base_url):
+    """
+    Build the CEQAnet CSV export URL for a city.
+    
+    Args:
+        city_name (str): The name of the city for which to download the data.
+        base_url (str): The base URL for CEQA data.
+    
+    Returns:
+        str: The download URL.
+    """
+    city_query = city_name.replace(" ", "%20").replace(",", "%2C")
+    return f"{base_url}{city_query}&OutputFormat=CSV"
+
+def stream_to_file(response, file_name, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Write a streamed HTTP response body to disk in chunks.
+    
+    Args:
+        response (requests.Response): A response opened with stream=True.
+        file_name (str): The local path to write to.
+        chunk_size (int): Number of bytes read per chunk.
+    
+    Returns:
+        str: The SHA-256 hex digest of the body.
+    """
+    digest = hashlib.sha256()
+    with open(file_name, 'wb') as file:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if chunk:
+                file.write(chunk)
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def stream_to_bytes(response, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Read a streamed HTTP response body into memory in chunks.
+    
+    Args:
+        response (requests.Response): A response opened with stream=True.
+        chunk_size (int): Number of bytes read per chunk.
+    
+    Returns:
+        tuple: The body as bytes and its SHA-256 hex digest.
+    """
+    digest = hashlib.sha256()
+    buffer = io.BytesIO()
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        if chunk:
+            buffer.write(chunk)
+            digest.update(chunk)
+    return buffer.getvalue(), digest.hexdigest()
+
+def download_csv_bytes(city_name, base_url):
+    """
+    Download the CSV export for a specified city into memory, without a local file.
+    
+    Args:
+        city_name (str): The name of the city for which to download the data.
+        base_url (str): The base URL for CEQA data.
+    
+    Returns:
+        bytes: The content of the CSV export.
+    """
+    try:
+        download_url = build_download_url(city_name, base_url)
+        logging.debug(f"Downloading CSV from URL: {download_url}")
+        with get_http_session().get(download_url, stream=True, timeout=HTTP_TIMEOUT) as response:
+            response.raise_for_status()
+            data, _ = stream_to_bytes(response)
+        logging.info(f"CSV for {city_name} downloaded into memory ({len(data)} bytes)")
+        return data
+    except Exception as e:
+        logging.error(f"Error downloading CSV for {city_name}: {e}")
+        raise
+
 def download_csv(city_name, base_url):
     """
     Download a CSV file for a specified city.
@@ -58,17 +160,16 @@ def download_csv(city_name, base_url):
         str: The local path to the downloaded CSV file.
     """
     try:
-        city_query = city_name.replace(" ", "%20").replace(",", "%2C")
-        download_url = f"{base_url}{city_query}&OutputFormat=CSV"
+        download_url = build_download_url(city_name, base_url)
         logging.debug(f"Downloading CSV from URL: {download_url}")
-        response = requests.get(download_url)
         
         # Filename for the city CSV
         file_name = f"{city_name}_ceqa.csv"
         
         # Saving the file locally temporarily before uploading to Azure
-        with open(file_name, 'wb') as file:
-            file.write(response.content)
+        with get_http_session().get(download_url, stream=True, timeout=HTTP_TIMEOUT) as response:
+            response.raise_for_status()
+            stream_to_file(response, file_name)
         logging.info(f"CSV downloaded and saved locally as {file_name}")
         
         return file_name
@@ -84,15 +185,9 @@ def upload_to_blob(file_name):
         file_name (str): The name of the file to upload.
     """
     try:
-        connection_string = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
-        container_name = os.getenv('AZURE_CONTAINER_NAME')
-
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=file_name)
-
-        logging.debug(f"Uploading {file_name} to Azure Blob Storage in container {container_name}")
-        with open(file_name, "rb") as data:
-            blob_client.upload_blob(data, overwrite=True)
+        store = get_blob_store()
+        logging.debug(f"Uploading {file_name} to blob storage in container {store.container_name}")
+        store.upload_file(file_name, file_name)
         logging.info(f"Uploaded {file_name} to Azure Blob Storage.")
     
     except Exception as e:
@@ -107,17 +202,10 @@ def download_from_blob(file_name):
         file_name (str): The name of the file in Azure Blob Storage.
     """
     try:
-        connection_string = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
-        container_name = os.getenv('AZURE_CONTAINER_NAME')
-
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=file_name)
-
         logging.debug(f"Downloading {file_name} from Azure Blob Storage")
         download_path = f"downloaded_{file_name}"
 
-        with open(download_path, "wb") as download_file:
-            download_file.write(blob_client.download_blob().readall())
+        get_blob_store().download_file(file_name, download_path)
 
         logging.info(f"Downloaded {file_name} from Azure Blob Storage to {download_path}")
         return download_path
@@ -133,14 +221,9 @@ def delete_from_blob(file_name):
         file_name (str): The name of the file to delete.
     """
     try:
-        connection_string = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
-        container_name = os.getenv('AZURE_CONTAINER_NAME')
-
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=file_name)
-
-        logging.debug(f"Deleting {file_name} from Azure Blob Storage in container {container_name}")
-        blob_client.delete_blob()
+        store = get_blob_store()
+        logging.debug(f"Deleting {file_name} from blob storage in container {store.container_name}")
+        store.delete(file_name)
         logging.info(f"Deleted {file_name} from Azure Blob Storage.")
     
     except Exception as e:
@@ -164,16 +247,16 @@ def cleanup_local_file(file_name):
         logging.error(f"Error removing local file {file_name}: {e}")
         raise
 
-def split_received_date(df, column):
+def parse_received_date(df, column):
     """
-    Process a DataFrame to split the 'received' date column into 'received_month', 
-    'received_day', and 'received_year' columns.
+    Parse the 'received' date column of a DataFrame in place.
 
     Args:
         df (pd.DataFrame): Input DataFrame containing the 'received' date column.
+        column (str): Name of the 'received' column.
     
     Returns:
-        pd.DataFrame: DataFrame with 'received_month', 'received_day', and 'received_year' columns.
+        pd.DataFrame: The DataFrame with the column parsed to datetime.
     """
     
     # Check if the 'received' column exists in the DataFrame
@@ -186,14 +269,6 @@ def split_received_date(df, column):
     # Check for any rows that couldn't be converted to datetime (NaT)
     if df[column].isna().any():
         raise ValueError("Some dates in the 'received' column could not be parsed.")
-    
-    # Create new columns for month, day, and year by extracting from the datetime column
-    df[f'{column}_month'] = df[column].dt.month
-    df[f'{column}_day'] = df[column].dt.day
-    df[f'{column}_year'] = df[column].dt.year
-
-    # Optionally, drop the original 'received' column if no longer needed
-    # df.drop('received', axis=1, inplace=True)
 
     return df
 
@@ -221,98 +296,8 @@ def validate_parcel(parcel):
 # Function to expand parcel numbers by handling complex cases like 'and', 'thru', semicolons, slashes, and other edge cases
 def expand_parcel_numbers(parcel):
     """Expand parcel numbers by handling complex cases like 'and', 'thru', semicolons, slashes, and new edge cases."""
-    if pd.isna(parcel) or not isinstance(parcel, str) or not parcel.strip():
-        return ["Unknown"]
-
-    # Replace 'and' with a comma and normalize 'thru'
-    parcel = parcel.replace(' and ', ', ').replace('thru', ' thru ').replace(' to ', ' to ').replace('&', ', ')
-
-    # Handle multiple semicolons or commas
-    parcel = re.sub(r'[;,]+', ',', parcel)  # Replace multiple semicolons or commas with a single comma
-
-    # Split by semicolons first to handle different parcel number groups
-    groups = [group.strip() for group in parcel.split(';')]
-
-    expanded_parcels = []
-
-    for group in groups:
-        # Split by commas for multiple parcels in the same group
-        parts = [p.strip() for p in group.split(',')]
-
-        base_parcel = None
-
-        for part in parts:
-            # Check if the part contains slashes (e.g., '3204008045/047') and handle accordingly
-            if '/' in part:
-                split_parts = part.split('/')
-                base_parcel = split_parts[0]
-                if len(split_parts) > 1:
-                    for suffix in split_parts[1:]:
-                        if suffix.isdigit():
-                            base_prefix = base_parcel[:-len(suffix)]  # Adjust the prefix based on suffix length
-                            expanded_parcels.append(validate_parcel(clean_parcel(base_prefix + suffix.zfill(3))))
-                        else:
-                            expanded_parcels.append("Unknown")
-                    else:
-                        expanded_parcels.append(validate_parcel(clean_parcel(base_parcel)))
-
-            # Handle ranges with 'to' (e.g., '3123-014-900 to 916')
-            elif ' to ' in part:
-                try:
-                    start, end = part.split(' to ')
-                    start = start.strip()
-                    end = end.strip()
-
-                    if base_parcel is None:
-                        base_parcel = start  # Base is the starting parcel number
-
-                    base_prefix = '-'.join(base_parcel.split('-')[:-1]) + '-'
-
-                    start_number = int(start.split('-')[-1])
-                    end_number = int(end)
-
-                    # Expand the range and append the parcels
-                    for i in range(start_number, end_number + 1):
-                        expanded_parcels.append(validate_parcel(clean_parcel(base_prefix + f"{i:03d}")))
-                except Exception:
-                    expanded_parcels.append("Unknown")  # Handle invalid range format
-
-            # Handle ranges with 'thru' (e.g., '3203-018-064 thru -071')
-            elif 'thru' in part:
-                try:
-                    start, end = part.split('thru')
-                    start = start.strip()
-                    end = end.strip().strip('-')
-
-                    if base_parcel is None:
-                        base_parcel = start  # Base is the starting parcel number
-
-                    base_prefix = '-'.join(base_parcel.split('-')[:-1]) + '-'
-
-                    start_number = int(start.split('-')[-1])
-                    end_number = int(end.split('-')[-1])
-
-                    # Expand the range and append the parcels
-                    for i in range(start_number, end_number + 1):
-                        expanded_parcels.append(validate_parcel(clean_parcel(base_prefix + f"{i:03d}")))
-                except Exception:
-                    expanded_parcels.append("Unknown")  # Handle invalid range format
-
-            # Handle full parcel numbers (e.g., '3219-018-01')
-            elif part.count('-') == 2:
-                base_parcel = part
-                expanded_parcels.append(validate_parcel(clean_parcel(base_parcel)))
-
-            # Handle comma-separated extensions (e.g., '02' from '3219-018-01')
-            elif base_parcel:
-                base_prefix = '-'.join(base_parcel.split('-')[:-1]) + '-'
-                full_parcel = validate_parcel(clean_parcel(base_prefix + part.strip('-')))
-                expanded_parcels.append(full_parcel)
-
-            else:
-                expanded_parcels.append("Unknown")  # Handle cases where no base parcel is found
-
-    return expanded_parcels
+    # The expansion rules live in the memoized engine in parcels.py
+    return list(default_expander.expand(parcel))
 
 # Function to process the DataFrame and expand the parcel numbers
 def process_parcel_data(df):
@@ -340,8 +325,16 @@ def process_parcel_data(df):
 
     return df
 
+# Declared width of location_parcel_number, which the joined parcels of a filing are cut to;
+# every parcel is kept in the parcel table
+PARCEL_WIDTH = COLUMN_SPECS['location_parcel_number'][1]
+
 # Function to combine parcel columns into a single 'Location Parcel Number' column
-def combine_parcels(df, max_length=50):
+def combine_parcels(df, max_length=PARCEL_WIDTH):
+    """
+    Combine the Parcel_N columns made by process_parcel_data into 'Location Parcel Number'.
+    The pipeline uses run_parcel_expansion, which avoids building the wide frame.
+    """
     parcel_columns = [col for col in df.columns if col.startswith('Parcel_')]
     df['Location Parcel Number'] = df[parcel_columns].apply(
         lambda row: ', '.join(row[row != 'Unknown'].astype(str)), axis=1)
@@ -360,8 +353,42 @@ def combine_parcels(df, max_length=50):
     
     return df
 
+# Function to join the flat list of expanded parcels back into one string per row
+def join_expanded_parcels(n_rows, row_idx, parcels, max_length=PARCEL_WIDTH):
+    """
+    Join expanded parcels into one comma-separated string per row, skipping 'Unknown' parcels.
+
+    Works on the flat output of ParcelExpander.expand_batch, so memory stays linear in the
+    total number of parcels instead of rows times the largest parcel count.
+
+    Args:
+        n_rows (int): Number of rows in the source DataFrame.
+        row_idx (np.ndarray): Row position of each parcel, in ascending order.
+        parcels (np.ndarray): The parcels.
+        max_length (int): Length at which each joined string is truncated (default is PARCEL_WIDTH).
+
+    Returns:
+        np.ndarray: One string per row, 'Unknown' for rows without a valid parcel.
+    """
+    known = parcels != 'Unknown'
+    row_idx = row_idx[known]
+    parcels = parcels[known]
+
+    combined = np.full(n_rows, 'Unknown', dtype=object)
+    if len(row_idx) == 0:
+        return combined
+
+    # Rows are contiguous in the flat arrays, so each row is a slice between two boundaries
+    boundaries = np.flatnonzero(np.diff(row_idx)) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(row_idx)]))
+    combined[row_idx[starts]] = [
+        ', '.join(parcels[start:end])[:max_length] for start, end in zip(starts, ends)
+    ]
+    return combined
+
 # Function to execute the full process on a given DataFrame
-def run_parcel_expansion(data):
+def run_parcel_expansion(data, max_length=PARCEL_WIDTH):
     """Main function to run the parcel expansion process."""
     # Ensure data contains 'SCH Number' and 'Location Parcel Number'
     if data.empty:
@@ -370,36 +397,80 @@ def run_parcel_expansion(data):
     if not set(['SCH Number', 'Location Parcel Number']).issubset(data.columns):
         raise ValueError("Data must contain 'SCH Number' and 'Location Parcel Number' columns")
 
-    # Process the DataFrame to expand parcel numbers
-    df_cleaned = process_parcel_data(data)
+    # Expand the parcel numbers into a flat (row, parcel) list
+    row_idx, parcels = default_expander.expand_batch(data['Location Parcel Number'])
+
+    # Join the expanded parcels back into a single column, moved to the end as before
+    combined = join_expanded_parcels(len(data), row_idx, parcels, max_length)
+    data = data.drop(columns=['Location Parcel Number'])
+    data['Location Parcel Number'] = combined
 
-    # Combine the expanded parcels back into a single column
-    df_cleaned = combine_parcels(df_cleaned)
+    return data
 
-    return df_cleaned
+def _parse_sch_numbers(sch_numbers):
+    """Return the SCH numbers as numbers, NaN where not numeric, and which of them can key an entry_id."""
+    sch = pd.to_numeric(sch_numbers, errors='coerce')
+    valid = ((sch >= 0) & (sch < MAX_SCH_NUMBER) & (sch % 1 == 0)).to_numpy(dtype=bool)
+    return sch, valid
 
-def generate_entry_id_and_date_gathered(df, sch_column='SCH Number', month_column='Received_month', day_column='Received_day', year_column='Received_year'):
+def drop_unkeyed_filings(df, sch_column='SCH Number', examples=5):
     """
-    Generate a unique 'entry_id' by concatenating the SCH Number, Received_month, Received_day, and Received_year,
-    and add a 'date_gathered' column with the current date (month, day, and year).
+    Drop the filings whose SCH number is blank or not a whole number below MAX_SCH_NUMBER, which
+    build_entry_ids cannot turn into a key, and log how many there were.
 
     Args:
-        df (pd.DataFrame): DataFrame containing the relevant columns for SCH Number and Received date parts.
+        df (pd.DataFrame): Filings with their SCH number.
         sch_column (str): Column name for SCH Number. Default is 'SCH Number'.
-        month_column (str): Column name for the received month. Default is 'Received_month'.
-        day_column (str): Column name for the received day. Default is 'Received_day'.
-        year_column (str): Column name for the received year. Default is 'Received_year'.
+        examples (int): Number of the dropped SCH numbers given in the log.
+
+    Returns:
+        tuple: (the remaining filings, number of filings dropped).
+    """
+    _, valid = _parse_sch_numbers(df[sch_column])
+    dropped = int(len(df) - valid.sum())
+    if dropped:
+        sample = df[sch_column][~valid].head(examples).tolist()
+        logging.warning(f"Dropped {dropped} filings without a numeric SCH number, e.g. {sample}")
+        df = df.loc[valid]
+    return df, dropped
+
+def build_entry_ids(sch_numbers, received):
+    """
+    Build the int64 key of each filing, SCH number * ENTRY_ID_DATE_FACTOR + YYYYMMDD of its
+    'received' date, with integer arithmetic only. The date always takes eight digits, so every
+    (SCH number, date) pair has its own key. Filings without a numeric SCH number must have been
+    dropped first, see drop_unkeyed_filings.
+
+    Args:
+        sch_numbers (pd.Series): SCH numbers, as text or numbers.
+        received (pd.Series): Parsed 'received' dates.
+
+    Returns:
+        np.ndarray: One int64 key per filing.
+    """
+    sch, valid = _parse_sch_numbers(sch_numbers)
+    if not valid.all():
+        raise ValueError("Some SCH numbers are not numeric and cannot be turned into an entry_id.")
+    sch = sch.to_numpy(dtype=np.int64)
+    dates = received.dt
+    day_number = (dates.year.to_numpy(dtype=np.int64) * 10000 + dates.month.to_numpy(dtype=np.int64) * 100
+                  + dates.day.to_numpy(dtype=np.int64))
+    return sch * ENTRY_ID_DATE_FACTOR + day_number
+
+def generate_entry_id_and_date_gathered(df, sch_column='SCH Number', date_column='Received'):
+    """
+    Generate the 'entry_id' key of each filing from its SCH number and parsed 'received' date
+    (see build_entry_ids), and add a 'date_gathered' column with the current date.
+
+    Args:
+        df (pd.DataFrame): DataFrame containing the SCH Number and the parsed 'received' date.
+        sch_column (str): Column name for SCH Number. Default is 'SCH Number'.
+        date_column (str): Column name for the parsed received date. Default is 'Received'.
     
     Returns:
         pd.DataFrame: The input DataFrame with new 'entry_id' and 'date_gathered' columns.
     """
-    # Generate 'entry_id' by concatenating the relevant columns
-    df.loc[:, 'entry_id'] = (
-        df[sch_column].astype(str) + 
-        df[month_column].astype(str) + 
-        df[day_column].astype(str) + 
-        df[year_column].astype(str)
-    )
+    df.loc[:, 'entry_id'] = build_entry_ids(df[sch_column], df[date_column])
     
     # Get the current date and format it as month, day, and year
     current_date = datetime.now()
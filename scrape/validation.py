@@ -0,0 +1,96 @@
+import numpy as np
+from const import COLUMN_SPECS, INSERT_COLUMNS, WIDTH_POLICY
+
+WIDTH_POLICIES = ('truncate', 'reject')
+
+def width_limits(columns=INSERT_COLUMNS):
+    """
+    Return the declared width of every column that has one, i.e. the VARCHAR columns of COLUMN_SPECS.
+
+    Args:
+        columns (list): The database column of each DataFrame column (default is INSERT_COLUMNS).
+
+    Returns:
+        dict: Position of the column in `columns` to (column, width).
+    """
+    return {position: (column, COLUMN_SPECS[column][1]) for position, column in enumerate(columns)
+            if COLUMN_SPECS[column][0] == 'VARCHAR' and COLUMN_SPECS[column][1]}
+
+class WidthReport:
+    """
+    Values over the declared width of their column, found in one set of rows by validate_widths:
+    per column, how many there were and the longest one, and the filings holding them.
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.columns = {}  # column -> (values over the width, longest length, width)
+        self.rows = 0  # Filings with at least one value over its width
+        self.examples = []  # entry_id of the first few of them
+        self.rejected = []  # entry_id of the filings left out, with the 'reject' policy
+
+    @property
+    def truncated(self):
+        return self.rows if self.policy == 'truncate' else 0
+
+    def __bool__(self):
+        return bool(self.rows)
+
+    def summary(self):
+        """One line listing every column over its width, e.g. for the logs."""
+        columns = ', '.join(f"{column} {count} > {width} (max {longest})"
+                            for column, (count, longest, width) in self.columns.items())
+        action = 'truncated' if self.policy == 'truncate' else 'rejected'
+        return f"{self.rows} filings {action}: {columns}; e.g. entry_id {', '.join(map(str, self.examples))}"
+
+    def as_dict(self):
+        return {
+            'policy': self.policy,
+            'rows': self.rows,
+            'columns': {column: {'count': count, 'max_length': longest, 'width': width}
+                        for column, (count, longest, width) in self.columns.items()},
+            'examples': self.examples,
+        }
+
+def validate_widths(df, policy=WIDTH_POLICY, columns=INSERT_COLUMNS, examples=5):
+    """
+    Check the text of every column with a declared width against it, in one vectorized pass, and
+    truncate the values over it or drop the filings holding them, before any row reaches the database.
+
+    Only the VARCHAR columns of COLUMN_SPECS are measured, with .str.len(), which for the string and
+    categorical columns of read_export does not copy the values.
+
+    Args:
+        df (pd.DataFrame): The reordered rows, one column per database column, in the given order,
+            the entry_id first.
+        policy (str): 'truncate' cuts the values to their width, as the conversion of migration 2 does;
+            'reject' drops every filing with a value over its width (default is WIDTH_POLICY).
+        columns (list): The database column of each DataFrame column (default is INSERT_COLUMNS).
+        examples (int): Number of entry_ids of offending filings kept in the report.
+
+    Returns:
+        tuple: The rows, truncated or filtered, and a WidthReport.
+    """
+    if policy not in WIDTH_POLICIES:
+        raise ValueError(f"Unknown width policy '{policy}', expected one of {', '.join(WIDTH_POLICIES)}.")
+    report = WidthReport(policy)
+    offending = np.zeros(len(df), dtype=bool)
+    for position, (column, width) in width_limits(columns).items():
+        values = df.iloc[:, position]
+        lengths = values.str.len().to_numpy(dtype=float, na_value=0)
+        over = lengths > width
+        if not over.any():
+            continue
+        report.columns[column] = (int(over.sum()), int(lengths.max()), width)
+        offending |= over
+        if policy == 'truncate':
+            df.isetitem(position, values.str.slice(0, width))
+
+    if not report.columns:
+        return df, report
+    report.rows = int(offending.sum())
+    report.examples = df.iloc[np.flatnonzero(offending)[:examples], 0].tolist()
+    if policy == 'reject':
+        report.rejected = df.iloc[np.flatnonzero(offending), 0].tolist()
+        df = df[~offending]
+    return df, report
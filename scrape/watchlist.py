@@ -0,0 +1,173 @@
+import os
+import sys
+import bisect
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from utils import parse_received_date, generate_entry_id_and_date_gathered, drop_unkeyed_filings
+from parcels import ParcelRange, default_expander, UNKNOWN
+from parcel_index import normalize_parcel
+from reader import read_export, fill_missing
+
+# Columns of the match report
+MATCH_COLUMNS = ['apn', 'entry_id', 'sch_number', 'document_type', 'lead_agency_title', 'received']
+
+# Column names recognised as the APN column of a watchlist CSV
+APN_COLUMNS = ('apn', 'parcel', 'parcel_number', 'location_parcel_number')
+
+def load_watchlist(path):
+    """
+    Read a watchlist of APNs from a text file (one per line) or a CSV file with an APN column.
+
+    Args:
+        path (str): Path to the watchlist file.
+
+    Returns:
+        list: The APNs as digits only, e.g. '3204-008-045' becomes '3204008045'.
+    """
+    if path.lower().endswith('.csv'):
+        df = pd.read_csv(path, dtype=str)
+        columns = {column.strip().lower().replace(' ', '_'): column for column in df.columns}
+        apn_column = next((columns[name] for name in APN_COLUMNS if name in columns), df.columns[0])
+        values = df[apn_column].dropna().tolist()
+    else:
+        with open(path, 'r', encoding='utf-8') as file:
+            values = [line for line in file if line.strip()]
+
+    apns = [normalize_parcel(value) for value in values]
+    logging.info(f"Loaded {len(apns)} APNs from watchlist {path}")
+    return apns
+
+class WatchlistMatcher:
+    """
+    Match a watchlist of APNs against the parcels of CEQA filings in one pass.
+
+    Single parcels are matched with a hash lookup. 'to' / 'thru' ranges are never expanded:
+    the sorted watchlist is searched for APNs starting with the range prefix, and only those
+    are checked against the range bounds. Ranges wider than the max_range of the expander
+    match nothing, as they are left out of the parcel table.
+    """
+
+    def __init__(self, apns, expander=default_expander):
+        """
+        Args:
+            apns (iterable): Watchlist APNs, digits only (see load_watchlist).
+            expander (ParcelExpander): The parsing engine (default is the shared one).
+        """
+        self.apns = {apn for apn in apns if 9 <= len(apn) <= 10}
+        self.sorted_apns = sorted(self.apns)
+        self.expander = expander
+        self._lock = threading.Lock()
+        logging.debug(f"Watchlist matcher built with {len(self.apns)} valid APNs")
+
+    @classmethod
+    def from_file(cls, path):
+        """Build a matcher from a watchlist file."""
+        return cls(load_watchlist(path))
+
+    def _range_matches(self, parcel_range):
+        # A range too wide to be expanded is not in the parcel table either, and matches nothing
+        if self.expander.is_wide(parcel_range):
+            return []
+        # Only watchlist APNs sharing the prefix can be generated by the range
+        start = bisect.bisect_left(self.sorted_apns, parcel_range.prefix)
+        matches = []
+        for apn in self.sorted_apns[start:]:
+            if not apn.startswith(parcel_range.prefix):
+                break
+            if apn in parcel_range:
+                matches.append(apn)
+        return matches
+
+    def match_value(self, raw_parcel):
+        """
+        Return the watchlist APNs described by one raw 'Location Parcel Number' value.
+
+        Args:
+            raw_parcel: The raw value.
+
+        Returns:
+            list: Matching APNs, without duplicates, in the order they appear.
+        """
+        matches = []
+        for segment in self.expander.segments(raw_parcel):
+            if isinstance(segment, ParcelRange):
+                matches.extend(self._range_matches(segment))
+            elif segment != UNKNOWN and segment in self.apns:
+                matches.append(segment)
+        return list(dict.fromkeys(matches))
+
+    def match_frame(self, df, parcel_column='Location Parcel Number'):
+        """
+        Match every filing of a DataFrame. Each distinct raw value is parsed only once.
+
+        Args:
+            df (pd.DataFrame): Filings with 'entry_id', 'SCH Number', 'Document Type',
+                'Lead Agency Title', 'Received' and the raw parcel column.
+            parcel_column (str): Column holding the raw parcel strings.
+
+        Returns:
+            pd.DataFrame: One row per (APN, filing) match, with the MATCH_COLUMNS columns.
+        """
+        codes, uniques = pd.factorize(df[parcel_column].astype(object), use_na_sentinel=True)
+        matches_by_code = {}
+        for code, value in enumerate(uniques):
+            apns = self.match_value(value)
+            if apns:
+                matches_by_code[code] = apns
+
+        # Only the rows whose raw value matched are looked at again
+        positions = np.flatnonzero(np.isin(codes, list(matches_by_code)))
+        columns = ['entry_id', 'SCH Number', 'Document Type', 'Lead Agency Title', 'Received']
+        records = []
+        for position, row in zip(positions, df[columns].iloc[positions].itertuples(index=False, name=None)):
+            for apn in matches_by_code[codes[position]]:
+                records.append((apn,) + row)
+
+        matches = pd.DataFrame(records, columns=MATCH_COLUMNS).drop_duplicates(subset=['apn', 'entry_id'])
+        logging.info(f"Watchlist matched {matches['apn'].nunique()} APNs in {matches['entry_id'].nunique()} filings")
+        return matches
+
+    def append_report(self, matches, path):
+        """
+        Append matches to a CSV report, writing the header when the file is new.
+
+        Args:
+            matches (pd.DataFrame): Output of match_frame.
+            path (str): Path of the CSV report.
+        """
+        if matches.empty:
+            return
+        with self._lock:
+            matches.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+        logging.info(f"Appended {len(matches)} watchlist matches to {path}")
+
+def match_csv_files(watchlist_path, csv_paths):
+    """
+    Match a watchlist against CEQAnet CSV exports on demand.
+
+    Args:
+        watchlist_path (str): Path to the watchlist file.
+        csv_paths (list): Paths to CEQAnet CSV exports.
+
+    Returns:
+        pd.DataFrame: All matches, see WatchlistMatcher.match_frame.
+    """
+    matcher = WatchlistMatcher.from_file(watchlist_path)
+    frames = []
+    for csv_path in csv_paths:
+        df = fill_missing(read_export(csv_path), 'Unknown')
+        df, _ = drop_unkeyed_filings(parse_received_date(df, 'Received'))
+        df = generate_entry_id_and_date_gathered(df)
+        frames.append(matcher.match_frame(df))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=MATCH_COLUMNS)
+
+if __name__ == "__main__":
+    # Usage: python watchlist.py WATCHLIST EXPORT.csv [EXPORT.csv ...]
+    if len(sys.argv) < 3:
+        print("Usage: python watchlist.py WATCHLIST EXPORT.csv [EXPORT.csv ...]")
+        sys.exit(1)
+    from metrics import configure_logging
+    configure_logging()
+    match_csv_files(sys.argv[1], sys.argv[2:]).to_csv(sys.stdout, index=False)
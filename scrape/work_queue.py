@@ -0,0 +1,440 @@
+import os
+import sys
+import uuid
+import socket
+import logging
+import argparse
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from psycopg2.extras import execute_values
+from const import (WORK_QUEUE_TABLE, WORK_QUEUE_LEASE_SECONDS, WORK_QUEUE_HEARTBEAT_SECONDS, WORK_QUEUE_CLAIM_SIZE,
+                   LEDGER_RETRY_BASE_SECONDS, LEDGER_RETRY_MAX_SECONDS, LEDGER_MAX_ATTEMPTS)
+
+PROGRESS_VIEW = f"{WORK_QUEUE_TABLE}_progress"
+
+# One row per agency of a batch. A claimed agency belongs to `worker` until `lease_until`; every
+# time is taken from the database clock, so the clocks of the workers never matter
+CREATE_WORK_QUEUE = f"""
+CREATE TABLE IF NOT EXISTS public.{WORK_QUEUE_TABLE} (
+    batch_id TEXT NOT NULL,
+    agency TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    stage TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    run_id TEXT,
+    lease_until TIMESTAMPTZ,
+    heartbeat_at TIMESTAMPTZ,
+    available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    enqueued_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    claimed_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    last_error TEXT,
+    PRIMARY KEY (batch_id, agency)
+);
+CREATE INDEX IF NOT EXISTS {WORK_QUEUE_TABLE}_claimable_idx
+    ON public.{WORK_QUEUE_TABLE} (batch_id, available_at) WHERE status IN ('queued', 'claimed');
+CREATE OR REPLACE VIEW public.{PROGRESS_VIEW} AS
+SELECT batch_id,
+       min(enqueued_at) AS enqueued_at,
+       count(*) AS agencies,
+       count(*) FILTER (WHERE status = 'queued') AS queued,
+       count(*) FILTER (WHERE status = 'claimed' AND lease_until >= now()) AS running,
+       count(*) FILTER (WHERE status = 'claimed' AND lease_until < now()) AS expired,
+       count(*) FILTER (WHERE status = 'done') AS done,
+       count(*) FILTER (WHERE status = 'failed') AS failed,
+       count(DISTINCT worker) FILTER (WHERE status = 'claimed' AND lease_until >= now()) AS workers,
+       min(available_at) FILTER (WHERE status = 'queued') AS next_available_at,
+       max(finished_at) AS last_finished_at
+FROM public.{WORK_QUEUE_TABLE}
+GROUP BY batch_id;
+"""
+
+# Agencies of an expired lease that used up their attempts are not claimed again
+EXPIRE_QUERY = f"""
+UPDATE public.{WORK_QUEUE_TABLE}
+SET status = 'failed', worker = NULL, lease_until = NULL, finished_at = now(),
+    last_error = coalesce(last_error || '; ', '') || 'lease of ' || worker || ' expired'
+WHERE batch_id = %(batch_id)s AND status = 'claimed' AND lease_until < now() AND attempts >= %(max_attempts)s
+"""
+
+# Queued agencies due now and the agencies of expired leases, claimed without waiting on those
+# other workers are claiming at the same time
+CLAIM_QUERY = f"""
+WITH next AS (
+    SELECT agency FROM public.{WORK_QUEUE_TABLE}
+    WHERE batch_id = %(batch_id)s
+      AND ((status = 'queued' AND available_at <= now()) OR (status = 'claimed' AND lease_until < now()))
+    ORDER BY available_at, agency
+    LIMIT %(limit)s
+    FOR UPDATE SKIP LOCKED
+)
+UPDATE public.{WORK_QUEUE_TABLE} q
+SET status = 'claimed', worker = %(worker)s, attempts = q.attempts + 1, claimed_at = now(),
+    heartbeat_at = now(), lease_until = now() + %(lease)s * interval '1 second', stage = NULL
+FROM next
+WHERE q.batch_id = %(batch_id)s AND q.agency = next.agency
+RETURNING q.agency
+"""
+
+HEARTBEAT_QUERY = f"""
+UPDATE public.{WORK_QUEUE_TABLE}
+SET heartbeat_at = now(), lease_until = now() + %(lease)s * interval '1 second'
+WHERE batch_id = %(batch_id)s AND worker = %(worker)s AND status = 'claimed'
+RETURNING agency
+"""
+
+# Only the worker holding the lease may finish an agency
+DONE_QUERY = f"""
+UPDATE public.{WORK_QUEUE_TABLE}
+SET status = 'done', lease_until = NULL, finished_at = now(), last_error = NULL
+WHERE batch_id = %(batch_id)s AND agency = %(agency)s AND worker = %(worker)s AND status = 'claimed'
+"""
+
+# A failed agency goes back to the queue after a backoff doubling with each attempt, or fails for good
+FAIL_QUERY = f"""
+UPDATE public.{WORK_QUEUE_TABLE}
+SET status = CASE WHEN attempts >= %(max_attempts)s THEN 'failed' ELSE 'queued' END,
+    available_at = now() + least(%(retry_base)s * power(2, attempts - 1), %(retry_max)s) * interval '1 second',
+    finished_at = CASE WHEN attempts >= %(max_attempts)s THEN now() END,
+    worker = NULL, lease_until = NULL, stage = %(stage)s, last_error = %(error)s
+WHERE batch_id = %(batch_id)s AND agency = %(agency)s AND worker = %(worker)s AND status = 'claimed'
+RETURNING status, available_at
+"""
+
+PROGRESS_COLUMNS = ('batch_id', 'enqueued_at', 'agencies', 'queued', 'running', 'expired', 'done', 'failed',
+                    'workers', 'next_available_at', 'last_finished_at')
+
+def ensure_work_queue(cursor):
+    """
+    Create the work queue table and its progress view if they do not exist.
+
+    Args:
+        cursor: A psycopg2 cursor.
+    """
+    # Workers starting together would otherwise race on CREATE OR REPLACE VIEW
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (WORK_QUEUE_TABLE,))
+    cursor.execute(CREATE_WORK_QUEUE)
+    logging.debug(f"Ensured table {WORK_QUEUE_TABLE} and view {PROGRESS_VIEW} exist")
+
+def default_worker_id():
+    """Name of this worker: host name and process id."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class AgencyQueue:
+    """
+    A queue of agencies shared by workers on several machines, in a table of the database.
+
+    Workers claim a few agencies at a time with FOR UPDATE SKIP LOCKED, so no two of them get the
+    same agency and none waits on another. A claim is a lease, renewed by a heartbeat thread while
+    the worker runs; when a worker dies, its lease expires and its agencies are claimed again by
+    another one. Only the worker holding the lease can mark an agency done or failed, and a failed
+    agency is queued again after a backoff, up to max_attempts claims.
+
+    The queue has the begin / stage / done / fail methods of a JobLedger, so it takes the place of
+    the ledger of CEQADataProcessor.run_worker, which runs the claimed agencies through run_for_cities.
+    The progress of every batch, across all workers, is in the agency_queue_progress view.
+    """
+
+    def __init__(self, db_pool, batch_id=None, worker=None, lease_seconds=WORK_QUEUE_LEASE_SECONDS,
+                 heartbeat_seconds=WORK_QUEUE_HEARTBEAT_SECONDS, retry_base=LEDGER_RETRY_BASE_SECONDS,
+                 retry_max=LEDGER_RETRY_MAX_SECONDS, max_attempts=LEDGER_MAX_ATTEMPTS):
+        """
+        Args:
+            db_pool (DBPool): Pool of connections to the database holding the queue.
+            batch_id (str): The batch to work on (default is the batch enqueued last).
+            worker (str): Name of this worker in the queue (default is host name and process id).
+            lease_seconds (float): Duration of a claim without heartbeat.
+            heartbeat_seconds (float): Interval between two renewals of the leases of this worker.
+            retry_base (float): Seconds before a failed agency can be claimed again, doubled after each attempt.
+            retry_max (float): Longest wait before a retry, in seconds.
+            max_attempts (int): Claims after which a failing agency is left failed.
+        """
+        if heartbeat_seconds >= lease_seconds:
+            raise ValueError("The heartbeat interval must be shorter than the lease.")
+        self.db_pool = db_pool
+        self.batch_id = batch_id
+        self.worker = worker or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.max_attempts = max_attempts
+        self.run_id = None
+        self._claimed = set()
+        self._lock = threading.Lock()
+        self._run(ensure_work_queue)
+
+    def _run(self, work, connection=None):
+        """Call work(cursor) in one transaction, on the given connection or a pooled one, and return its result."""
+        if connection is None:
+            with self.db_pool.connection() as connection:
+                return self._run(work, connection)
+        cursor = connection.cursor()
+        try:
+            result = work(cursor)
+            connection.commit()
+            return result
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def _execute(self, query, connection=None, **params):
+        def work(cursor):
+            cursor.execute(query, {'batch_id': self.batch_id, 'worker': self.worker, **params})
+            return cursor.fetchall() if cursor.description else cursor.rowcount
+        return self._run(work, connection)
+
+    def latest_batch(self):
+        """Return the batch enqueued last, or None when the queue is empty."""
+        def work(cursor):
+            cursor.execute(f"SELECT batch_id FROM public.{WORK_QUEUE_TABLE} "
+                           f"GROUP BY batch_id ORDER BY min(enqueued_at) DESC LIMIT 1")
+            row = cursor.fetchone()
+            return row[0] if row else None
+        return self._run(work)
+
+    def _resolve_batch(self):
+        if self.batch_id is None:
+            self.batch_id = self.latest_batch()
+            if self.batch_id is None:
+                raise ValueError(f"No batch in {WORK_QUEUE_TABLE}; enqueue agencies first.")
+            logging.info(f"Working on batch {self.batch_id} as {self.worker}")
+        return self.batch_id
+
+    def enqueue(self, cities, batch_id=None):
+        """
+        Queue every agency of a new batch, or add agencies to an existing one.
+
+        Args:
+            cities (list): The agencies.
+            batch_id (str): The batch (default is a new one, named after the current time).
+
+        Returns:
+            str: The batch the agencies were queued in.
+        """
+        self.batch_id = batch_id or f"{datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        rows = [(self.batch_id, city) for city in dict.fromkeys(cities)]
+        count = self._run(lambda cursor: len(execute_values(
+            cursor, f"INSERT INTO public.{WORK_QUEUE_TABLE} (batch_id, agency) VALUES %s "
+                    f"ON CONFLICT (batch_id, agency) DO NOTHING RETURNING agency", rows, fetch=True)))
+        logging.info(f"Queued {count} agencies in batch {self.batch_id}")
+        return self.batch_id
+
+    def claim(self, limit=WORK_QUEUE_CLAIM_SIZE):
+        """
+        Claim up to `limit` agencies for this worker.
+
+        Returns:
+            list: The claimed agencies, empty when none is available now.
+        """
+        self._resolve_batch()
+        def work(cursor):
+            cursor.execute(EXPIRE_QUERY, {'batch_id': self.batch_id, 'max_attempts': self.max_attempts})
+            if cursor.rowcount:
+                logging.warning(f"{cursor.rowcount} agencies failed for good after their last lease expired")
+            cursor.execute(CLAIM_QUERY, {'batch_id': self.batch_id, 'worker': self.worker, 'limit': limit,
+                                         'lease': self.lease_seconds})
+            return [row[0] for row in cursor.fetchall()]
+        cities = self._run(work)
+        with self._lock:
+            self._claimed.update(cities)
+        if cities:
+            logging.info(f"{self.worker} claimed {len(cities)} agencies: {cities}")
+        return cities
+
+    def heartbeat(self, connection=None):
+        """
+        Renew the leases of this worker.
+
+        Args:
+            connection: Connection to renew them on (default is one borrowed from the pool).
+
+        Returns:
+            int: The number of agencies still held.
+        """
+        held = {row[0] for row in self._execute(HEARTBEAT_QUERY, connection, lease=self.lease_seconds)}
+        with self._lock:
+            lost = self._claimed - held
+            self._claimed &= held
+        if lost:
+            logging.warning(f"{self.worker} lost the lease of {sorted(lost)} to another worker")
+        return len(held)
+
+    @contextmanager
+    def heartbeats(self):
+        """
+        Renew the leases of this worker in a background thread for the duration of a with block.
+        The thread has a connection of its own: one borrowed from the pool could wait behind
+        the loads holding every pooled connection until the leases expire.
+        """
+        stop = threading.Event()
+
+        def beat():
+            connection = None
+            while not stop.wait(self.heartbeat_seconds):
+                try:
+                    if connection is None:
+                        connection = self.db_pool.dedicated_connection()
+                    self.heartbeat(connection)
+                except Exception as e:
+                    logging.error(f"Heartbeat of {self.worker} failed: {e}")
+                    # Reconnect on the next beat, the connection may be the cause
+                    if connection is not None:
+                        connection.close()
+                        connection = None
+            if connection is not None:
+                connection.close()
+
+        thread = threading.Thread(target=beat, name=f"heartbeat-{self.worker}", daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+    def pending(self):
+        """
+        Return the agencies of the batch that may still need a worker: how many are queued,
+        held under a live lease, or held under an expired one, and when the next queued one is due.
+        """
+        progress = self.progress(self._resolve_batch())
+        return {key: progress[key] for key in ('queued', 'running', 'expired', 'next_available_at')} \
+            if progress else {'queued': 0, 'running': 0, 'expired': 0, 'next_available_at': None}
+
+    def progress(self, batch_id=None):
+        """
+        Return the progress of a batch across all workers, from the agency_queue_progress view.
+
+        Args:
+            batch_id (str): The batch (default is the current one, or the batch enqueued last).
+
+        Returns:
+            dict: The PROGRESS_COLUMNS of the batch, or None when it does not exist.
+        """
+        batch_id = batch_id or self.batch_id or self.latest_batch()
+        def work(cursor):
+            cursor.execute(f"SELECT {', '.join(PROGRESS_COLUMNS)} FROM public.{PROGRESS_VIEW} WHERE batch_id = %s",
+                           (batch_id,))
+            row = cursor.fetchone()
+            return dict(zip(PROGRESS_COLUMNS, row)) if row else None
+        return self._run(work)
+
+    # Methods of the JobLedger interface, called by CEQADataProcessor for the claimed agencies
+
+    def begin(self, cities, run_id=None):
+        """Start a run over claimed agencies: they are processed as they are."""
+        self.run_id = run_id
+        if cities:
+            self._execute(f"UPDATE public.{WORK_QUEUE_TABLE} SET run_id = %(run_id)s "
+                          f"WHERE batch_id = %(batch_id)s AND worker = %(worker)s AND agency = ANY(%(agencies)s)",
+                          run_id=run_id, agencies=list(cities))
+        return cities
+
+    def stage(self, agency, stage):
+        """Record the stage an agency entered, and renew its lease."""
+        try:
+            self._execute(f"UPDATE public.{WORK_QUEUE_TABLE} "
+                          f"SET stage = %(stage)s, heartbeat_at = now(), lease_until = now() + %(lease)s * interval '1 second' "
+                          f"WHERE batch_id = %(batch_id)s AND agency = %(agency)s AND worker = %(worker)s "
+                          f"AND status = 'claimed'", agency=agency, stage=stage, lease=self.lease_seconds)
+        except Exception as e:
+            logging.error(f"Could not record the stage of {agency} in {WORK_QUEUE_TABLE}: {e}")
+
+    def done(self, agency):
+        """Mark an agency done, if this worker still holds its lease."""
+        try:
+            updated = self._execute(DONE_QUERY, agency=agency)
+        except Exception as e:
+            logging.error(f"Could not mark {agency} done in {WORK_QUEUE_TABLE}: {e}")
+            return
+        with self._lock:
+            self._claimed.discard(agency)
+        if not updated:
+            logging.warning(f"{agency} was loaded by {self.worker} after its lease went to another worker")
+
+    def fail(self, agency, stage, error):
+        """Queue a failed agency again after its backoff, or leave it failed after max_attempts claims."""
+        try:
+            rows = self._execute(FAIL_QUERY, agency=agency, stage=stage, error=str(error)[:1000],
+                                 max_attempts=self.max_attempts, retry_base=self.retry_base, retry_max=self.retry_max)
+        except Exception as e:
+            logging.error(f"Could not record the failure of {agency} in {WORK_QUEUE_TABLE}: {e}")
+            return
+        with self._lock:
+            self._claimed.discard(agency)
+        if not rows:
+            logging.warning(f"{agency} failed in {self.worker} after its lease went to another worker")
+        elif rows[0][0] == 'failed':
+            logging.warning(f"Giving up on {agency} after {self.max_attempts} attempts in batch {self.batch_id}")
+        else:
+            logging.info(f"{agency} queued again, available after {rows[0][1]:%Y-%m-%d %H:%M:%S}")
+
+    def summary(self):
+        """Counts of the batch across all workers, for the run report."""
+        progress = self.progress() or {}
+        return {key: progress[key] for key in ('agencies', 'queued', 'running', 'expired', 'done', 'failed', 'workers')
+                if key in progress}
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Spread agencies over workers on several machines.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    enqueue = commands.add_parser('enqueue', help="Queue a new batch of agencies.")
+    enqueue.add_argument('agencies', nargs='*', help="Agencies to queue.")
+    enqueue.add_argument('--file', help="File with one agency per line.")
+    enqueue.add_argument('--batch', help="Add to this batch instead of starting a new one.")
+    work = commands.add_parser('work', help="Process agencies of a batch until none is left to claim.")
+    work.add_argument('--batch', help="Batch to work on (default is the batch enqueued last).")
+    work.add_argument('--worker', help="Name of this worker (default is host name and process id).")
+    work.add_argument('--claim', type=int, default=WORK_QUEUE_CLAIM_SIZE,
+                      help=f"Agencies claimed at a time (default is {WORK_QUEUE_CLAIM_SIZE}).")
+    work.add_argument('--pipelined', action='store_true', help="Run the stages of the claimed agencies concurrently.")
+    work.add_argument('--wait-for-retries', action='store_true',
+                      help="Keep running until failed agencies due for a retry have been retried.")
+    progress = commands.add_parser('progress', help="Show the progress of a batch across all workers.")
+    progress.add_argument('--batch', help="Batch to show (default is the batch enqueued last).")
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    # Usage: python work_queue.py enqueue [AGENCY ...] [--file FILE]
+    #        python work_queue.py work [--claim N] [--pipelined]    (on every worker machine)
+    #        python work_queue.py progress
+    args = parse_args(sys.argv[1:])
+    from db_pool import get_db_pool
+    from metrics import configure_logging
+    configure_logging()
+    db_pool = get_db_pool()
+    try:
+        work_queue = AgencyQueue(db_pool, getattr(args, 'batch', None), getattr(args, 'worker', None))
+        if args.command == 'enqueue':
+            cities = list(args.agencies)
+            if args.file:
+                with open(args.file, encoding='utf-8') as file:
+                    cities.extend(line.strip() for line in file if line.strip())
+            if not cities:
+                sys.exit("No agencies to queue")
+            print(f"Batch {work_queue.enqueue(cities, args.batch)}")
+        elif args.command == 'work':
+            from data_processor import CEQADataProcessor
+            from fetcher import CEQAFetcher
+            from schema import migrate
+            from metrics import metrics_from_env
+            with db_pool.connection() as connection:
+                migrate(connection)
+            processor = CEQADataProcessor(table_name="ceqa_data", fetcher=CEQAFetcher(), db_pool=db_pool, typed=True,
+                                          metrics=metrics_from_env())
+            done = processor.run_worker(work_queue, claim_size=args.claim, wait_for_retries=args.wait_for_retries,
+                                        pipelined=args.pipelined)
+            print(f"{work_queue.worker} processed {len(done)} agencies: {work_queue.summary()}")
+        else:
+            progress = work_queue.progress(args.batch)
+            if progress is None:
+                sys.exit("No batch to show")
+            for column in PROGRESS_COLUMNS:
+                print(f"{column:>18}  {progress[column]}")
+    finally:
+        db_pool.closeall()
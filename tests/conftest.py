@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The scrape modules import each other by module name, as when run from scrape/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scrape'))
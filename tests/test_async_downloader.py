@@ -0,0 +1,166 @@
+import time
+import asyncio
+import threading
+import pytest
+from aiohttp import web
+import async_downloader
+from async_downloader import AsyncCEQADownloader, ByteBudget, TokenBucket, backoff_delay, stream_csvs
+
+CHUNK = 1024
+BODY = 8 * CHUNK
+
+async def stream_body(budget, chunks, peaks):
+    # Reserves like an in-memory transfer: the read buffer first, then every chunk read, all held to the end
+    await budget.acquire(1)
+    reserved = 1
+    try:
+        for _ in range(chunks):
+            await asyncio.sleep(0)
+            await budget.acquire(1, held=reserved)
+            reserved += 1
+            peaks.append(budget._in_flight)
+    finally:
+        await budget.release(reserved)
+
+@pytest.mark.parametrize('max_bytes, bodies', [
+    (3, [6, 6, 6, 6]),
+    (4, [1, 10, 2, 7, 3]),
+    (1, [5, 5]),
+])
+def test_byte_budget_never_deadlocks(max_bytes, bodies):
+    async def main():
+        budget = ByteBudget(max_bytes)
+        peaks = []
+        await asyncio.wait_for(asyncio.gather(*(stream_body(budget, chunks, peaks) for chunks in bodies)), 5)
+        return budget, peaks
+
+    budget, peaks = asyncio.run(main())
+    assert budget._in_flight == 0
+    # Over the cap by at most the transfer that went ahead alone, read buffer included
+    assert max(peaks) <= max_bytes + max(bodies) + 1
+
+def test_byte_budget_reports_the_wait():
+    async def main():
+        budget = ByteBudget(1)
+        await budget.acquire(1)
+        waiting = asyncio.ensure_future(budget.acquire(1))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        await budget.release(1)
+        return await waiting
+
+    assert asyncio.run(main()) >= 0.04
+
+def test_token_bucket_paces_requests():
+    async def main():
+        bucket = TokenBucket(rate=50, capacity=2)
+        start = time.monotonic()
+        for _ in range(2):
+            await bucket.acquire()
+        burst = time.monotonic() - start
+        for _ in range(5):
+            await bucket.acquire()
+        return burst, time.monotonic() - start
+
+    burst, total = asyncio.run(main())
+    assert burst < 0.02
+    # 5 more tokens at 50 per second
+    assert total >= 0.09
+
+def test_backoff_is_jittered_and_capped():
+    for attempt in range(1, 5):
+        delay = backoff_delay(attempt, base=1, cap=100)
+        assert 2 ** (attempt - 1) / 2 <= delay <= 2 ** (attempt - 1)
+    assert backoff_delay(20, base=1, cap=30) <= 30
+
+def test_backoff_honours_retry_after_up_to_the_cap():
+    assert backoff_delay(1, retry_after='7', base=1, cap=30) == 7
+    assert backoff_delay(1, retry_after='3600', base=1, cap=30) == 30
+    # An HTTP date is not a number of seconds and falls back to the backoff
+    assert backoff_delay(1, retry_after='Wed, 21 Oct 2015 07:28:00 GMT', base=1, cap=30) <= 1
+
+def test_at_least_one_attempt():
+    with pytest.raises(ValueError):
+        AsyncCEQADownloader(max_retries=0)
+
+@pytest.fixture
+def export_server():
+    # Serves an 8-chunk export per city, in small writes so the client reads it chunk by chunk
+    async def export(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        city = request.query['city'].encode()
+        for _ in range(BODY // CHUNK):
+            await response.write((city * CHUNK)[:CHUNK])
+            await asyncio.sleep(0.001)
+        return response
+
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_get('/csv', export)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{port}/csv?city="
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+@pytest.fixture
+def budget_peaks(monkeypatch):
+    peaks = []
+
+    class RecordingBudget(ByteBudget):
+        async def acquire(self, n, held=0):
+            waited = await super().acquire(n, held)
+            peaks.append(self._in_flight)
+            return waited
+
+    monkeypatch.setattr(async_downloader, 'DOWNLOAD_CHUNK_SIZE', CHUNK)
+    monkeypatch.setattr(async_downloader, 'ByteBudget', RecordingBudget)
+    return peaks
+
+def test_stream_keeps_untaken_bodies_in_the_budget(export_server, budget_peaks, monkeypatch):
+    completed = []
+    fetch = AsyncCEQADownloader._fetch
+
+    async def counting_fetch(self, *args):
+        result = await fetch(self, *args)
+        completed.append(result)
+        return result
+
+    monkeypatch.setattr(AsyncCEQADownloader, '_fetch', counting_fetch)
+    cities = [f"c{i}" for i in range(8)]
+    taken = {}
+    waiting = []
+    for city, body in stream_csvs(cities, export_server, in_memory=True, max_in_flight_bytes=2 * BODY,
+                                  rate=1000, burst=100):
+        taken[city] = body
+        time.sleep(0.05)  # A slow consumer: the bodies it has not taken hold back the other downloads
+        waiting.append(len(completed) - len(taken))
+    assert set(taken) == set(cities)
+    assert all(body == (city.encode() * CHUNK)[:CHUNK] * (BODY // CHUNK) for city, body in taken.items())
+    assert max(waiting) <= 2
+    assert max(budget_peaks) <= 3 * BODY + CHUNK
+
+def test_stream_writes_files(export_server, budget_peaks, tmp_path):
+    results = dict(stream_csvs(['a', 'b'], export_server, output_dir=str(tmp_path), rate=1000, burst=100))
+    assert sorted(results) == ['a', 'b']
+    assert open(results['a'], 'rb').read() == b'a' * BODY
+
+def test_stream_reports_failures(budget_peaks):
+    results = dict(stream_csvs(['a'], 'http://127.0.0.1:9/csv?city=', max_retries=1, in_memory=True))
+    assert isinstance(results['a'], Exception)
+
+def test_closing_the_stream_cancels_the_downloads(export_server, budget_peaks):
+    stream = stream_csvs([f"c{i}" for i in range(20)], export_server, in_memory=True,
+                         max_in_flight_bytes=BODY, rate=1000, burst=100)
+    next(stream)
+    start = time.monotonic()
+    stream.close()
+    assert time.monotonic() - start < 2
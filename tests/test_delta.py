@@ -0,0 +1,47 @@
+import os
+import sys
+import subprocess
+import numpy as np
+import pandas as pd
+from delta import hash_rows
+
+ROWS = {
+    'entry_id': [202401010120240111, 202401010220241101],
+    'lead_agency_title': ['Los Angeles', 'Pasadena'],
+    'received': pd.to_datetime(['2024-01-11', '2024-11-01']),
+    'date_gathered': pd.to_datetime(['2024-12-01', '2024-12-01']),
+}
+
+def test_same_rows_same_hashes():
+    first = hash_rows(pd.DataFrame(ROWS))
+    assert first.dtype == np.int64
+    assert np.array_equal(first, hash_rows(pd.DataFrame(ROWS)))
+    assert first[0] != first[1]
+
+def test_changed_value_changes_hash():
+    df = pd.DataFrame(ROWS)
+    before = hash_rows(df)
+    df.loc[1, 'lead_agency_title'] = 'Glendale'
+    after = hash_rows(df)
+    assert after[0] == before[0]
+    assert after[1] != before[1]
+
+def test_date_gathered_and_index_are_ignored():
+    df = pd.DataFrame(ROWS)
+    before = hash_rows(df)
+    df['date_gathered'] = pd.Timestamp('2025-01-01')
+    assert np.array_equal(hash_rows(df.set_axis([10, 20])), before)
+
+def test_hashes_do_not_depend_on_the_process():
+    # Python's string hashing is salted per process; the row hashes must not be
+    script = ("import pandas as pd\n"
+              "from delta import hash_rows\n"
+              "print(hash_rows(pd.DataFrame({'title': ['Los Angeles', 'Pasadena'], 'n': [1, 2]})).tolist())\n")
+    scrape = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scrape')
+    outputs = set()
+    for seed in ('1', '2'):
+        result = subprocess.run([sys.executable, '-c', script], cwd=scrape, capture_output=True, text=True,
+                                check=True, env={**os.environ, 'PYTHONHASHSEED': seed})
+        outputs.add(result.stdout)
+    expected = hash_rows(pd.DataFrame({'title': ['Los Angeles', 'Pasadena'], 'n': [1, 2]})).tolist()
+    assert outputs == {f"{expected}\n"}
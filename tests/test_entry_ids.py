@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+from const import ENTRY_ID_DATE_FACTOR, MAX_SCH_NUMBER
+from utils import build_entry_ids, drop_unkeyed_filings
+
+def test_month_and_day_do_not_collide():
+    # With unpadded month and day, 2024-1-11 and 2024-11-1 would give the same key
+    received = pd.Series(pd.to_datetime(['2024-01-11', '2024-11-01']))
+    keys = build_entry_ids(pd.Series(['2024010101', '2024010101']), received)
+    assert keys.tolist() == [2024010101 * ENTRY_ID_DATE_FACTOR + 20240111,
+                             2024010101 * ENTRY_ID_DATE_FACTOR + 20241101]
+
+def test_largest_sch_number_fits_in_int64():
+    received = pd.Series(pd.to_datetime(['2262-04-11']))
+    keys = build_entry_ids(pd.Series([str(MAX_SCH_NUMBER - 1)]), received)
+    assert keys.dtype == np.int64
+    assert keys[0] == (MAX_SCH_NUMBER - 1) * ENTRY_ID_DATE_FACTOR + 22620411
+    assert keys[0] > 0
+
+@pytest.mark.parametrize('sch', ['abc', '', None, '12.5', '-1', str(MAX_SCH_NUMBER)])
+def test_unkeyable_sch_number_raises(sch):
+    received = pd.Series(pd.to_datetime(['2024-01-11', '2024-01-11']))
+    with pytest.raises(ValueError):
+        build_entry_ids(pd.Series(['2024010101', sch]), received)
+
+def test_drop_unkeyed_filings():
+    df = pd.DataFrame({'SCH Number': ['2024010101', 'n/a', None, '2024010102', str(MAX_SCH_NUMBER)],
+                       'Received': pd.to_datetime(['2024-01-11'] * 5)})
+    kept, dropped = drop_unkeyed_filings(df)
+    assert dropped == 3
+    assert kept['SCH Number'].tolist() == ['2024010101', '2024010102']
+    assert len(build_entry_ids(kept['SCH Number'], kept['Received'])) == 2
+
+def test_drop_unkeyed_filings_keeps_a_clean_frame():
+    df = pd.DataFrame({'SCH Number': [2024010101, 2024010102]})
+    kept, dropped = drop_unkeyed_filings(df)
+    assert dropped == 0
+    assert kept is df
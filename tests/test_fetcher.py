@@ -0,0 +1,132 @@
+import os
+import json
+import hashlib
+import pytest
+import fetcher
+from fetcher import CEQAFetcher
+
+BODY = b"SCH Number,Lead Agency Title\n2024010101,Los Angeles\n"
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=BODY, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+class FakeSession:
+    """Answers every request with the next queued response and records the request headers."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append((url, dict(headers or {})))
+        return self.responses.pop(0)
+
+@pytest.fixture
+def session(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    fake = FakeSession()
+    monkeypatch.setattr(fetcher, 'get_http_session', lambda: fake)
+    return fake
+
+@pytest.fixture
+def state_path(tmp_path):
+    return str(tmp_path / 'fetch_state.json')
+
+def processed(state_path, session, etag='"v1"', last_modified='Wed, 01 May 2024 10:00:00 GMT', body=BODY):
+    # A fetcher whose state holds one export of Los Angeles, processed successfully
+    session.responses.append(FakeResponse(headers={'ETag': etag, 'Last-Modified': last_modified}, body=body))
+    first = CEQAFetcher(base_url='http://ceqa.test/?city=', state_path=state_path)
+    result = first.fetch('Los Angeles')
+    first.mark_processed(result)
+    os.remove(result.file_name)
+
+def test_first_fetch_downloads_without_validators(session, state_path):
+    session.responses.append(FakeResponse(headers={'ETag': '"v1"'}))
+    result = CEQAFetcher(state_path=state_path).fetch('Los Angeles')
+    assert session.requests[0][1] == {}
+    assert open(result.file_name, 'rb').read() == BODY
+    assert result.sha256 == hashlib.sha256(BODY).hexdigest()
+    assert result.etag == '"v1"'
+
+def test_not_modified_is_skipped(session, state_path):
+    processed(state_path, session)
+    session.responses.append(FakeResponse(status_code=304, body=b''))
+    assert CEQAFetcher(state_path=state_path).fetch('Los Angeles') is None
+    assert session.requests[-1][1] == {'If-None-Match': '"v1"', 'If-Modified-Since': 'Wed, 01 May 2024 10:00:00 GMT'}
+    assert not os.path.exists('Los Angeles_ceqa.csv')
+
+@pytest.mark.parametrize('in_memory', [False, True])
+def test_same_content_hash_is_skipped(session, state_path, in_memory):
+    processed(state_path, session)
+    # The server ignores the validators, e.g. a new ETag for the same body
+    session.responses.append(FakeResponse(headers={'ETag': '"v2"'}))
+    assert CEQAFetcher(state_path=state_path).fetch('Los Angeles', in_memory=in_memory) is None
+    assert not os.path.exists('Los Angeles_ceqa.csv')
+
+def test_changed_content_is_downloaded(session, state_path):
+    processed(state_path, session)
+    session.responses.append(FakeResponse(headers={'ETag': '"v2"'}, body=BODY + b"2024010102,Pasadena\n"))
+    result = CEQAFetcher(state_path=state_path).fetch('Los Angeles', in_memory=True)
+    assert result.data == BODY + b"2024010102,Pasadena\n"
+    assert result.file_name is None
+
+def test_state_is_only_saved_by_mark_processed(session, state_path):
+    session.responses.append(FakeResponse(headers={'ETag': '"v1"'}))
+    fetch = CEQAFetcher(state_path=state_path)
+    result = fetch.fetch('Los Angeles')
+    assert not os.path.exists(state_path)
+
+    # Not processed: the next run asks for the export again without validators
+    session.responses.append(FakeResponse(headers={'ETag': '"v1"'}))
+    assert CEQAFetcher(state_path=state_path).fetch('Los Angeles') is not None
+    assert session.requests[-1][1] == {}
+
+    fetch.mark_processed(result)
+    state = json.load(open(state_path))
+    assert state['Los Angeles']['etag'] == '"v1"'
+    assert state['Los Angeles']['sha256'] == hashlib.sha256(BODY).hexdigest()
+
+def test_failed_download_leaves_no_file(session, state_path):
+    session.responses.append(FakeResponse(status_code=500))
+    with pytest.raises(RuntimeError):
+        CEQAFetcher(state_path=state_path).fetch('Los Angeles')
+    assert not os.path.exists('Los Angeles_ceqa.csv')
+
+def test_failed_processing_keeps_the_state(session, state_path, tmp_path, monkeypatch):
+    from blob_store import LocalBlobStore
+    from data_processor import CEQADataProcessor
+
+    processed(state_path, session)
+    before = open(state_path).read()
+    session.responses.append(FakeResponse(headers={'ETag': '"v2"'}, body=BODY + b"2024010102,Pasadena\n"))
+    processor = CEQADataProcessor('ceqa_data', fetcher=CEQAFetcher(state_path=state_path),
+                                  blob_store=LocalBlobStore(str(tmp_path / 'blobs')), index_parcels=False)
+
+    reached = []
+
+    def fail(job):
+        reached.append(job.fetch_result.etag)
+        raise RuntimeError("transform failed")
+
+    monkeypatch.setattr(processor, '_transform_stage', fail)
+    assert processor.run_for_cities(['Los Angeles']) == []
+    assert reached == ['"v2"']
+    assert open(state_path).read() == before
+    assert not os.path.exists('Los Angeles_ceqa.csv')
@@ -0,0 +1,97 @@
+import pytest
+from ledger import ABANDONED, DONE, FAILED, PENDING, RUNNING, JobLedger
+
+CITIES = ['Los Angeles', 'Pasadena', 'Glendale']
+
+@pytest.fixture
+def ledger_path(tmp_path):
+    return str(tmp_path / 'ledger.sqlite')
+
+def open_ledger(path, **kwargs):
+    return JobLedger('sqlite', path, **kwargs)
+
+def test_resume_skips_finished_agencies(ledger_path):
+    ledger = open_ledger(ledger_path)
+    assert ledger.begin(CITIES, run_id='first') == CITIES
+    ledger.stage('Los Angeles', 'load')
+    ledger.done('Los Angeles')
+    ledger.stage('Pasadena', 'download')
+    batch_id = ledger.batch_id
+    ledger.close()
+
+    # A crash left Pasadena running: the next run picks it up with Glendale
+    ledger = open_ledger(ledger_path)
+    assert ledger.begin(CITIES, run_id='second') == ['Pasadena', 'Glendale']
+    assert ledger.batch_id == batch_id
+    assert ledger.summary() == {DONE: 1, RUNNING: 1, PENDING: 1}
+    ledger.close()
+
+def test_other_agencies_start_a_new_batch(ledger_path):
+    ledger = open_ledger(ledger_path)
+    ledger.begin(CITIES)
+    batch_id = ledger.batch_id
+    assert ledger.begin(CITIES[:2]) == CITIES[:2]
+    assert ledger.batch_id != batch_id
+    ledger.close()
+
+def test_failed_agency_waits_for_its_backoff(ledger_path):
+    ledger = open_ledger(ledger_path, retry_base=3600)
+    ledger.begin(CITIES)
+    ledger.done('Los Angeles')
+    ledger.fail('Pasadena', 'download', RuntimeError('503'))
+    job = ledger.jobs()['Pasadena']
+    assert (job['status'], job['stage'], job['attempts'], job['last_error']) == (FAILED, 'download', 1, '503')
+    assert job['next_attempt_at'] is not None
+    ledger.close()
+
+    ledger = open_ledger(ledger_path, retry_base=3600)
+    assert ledger.begin(CITIES) == ['Glendale']
+    ledger.close()
+
+def test_failed_agency_is_retried_after_its_backoff(ledger_path):
+    ledger = open_ledger(ledger_path, retry_base=0)
+    ledger.begin(CITIES)
+    ledger.done('Los Angeles')
+    ledger.fail('Pasadena', 'download', 'timeout')
+    ledger.close()
+
+    ledger = open_ledger(ledger_path, retry_base=0)
+    assert ledger.begin(CITIES) == ['Pasadena', 'Glendale']
+    ledger.done('Pasadena')
+    job = ledger.jobs()['Pasadena']
+    assert (job['status'], job['attempts'], job['next_attempt_at'], job['last_error']) == (DONE, 1, None, None)
+    ledger.close()
+
+def test_agency_is_abandoned_after_max_attempts(ledger_path):
+    ledger = open_ledger(ledger_path, retry_base=0, max_attempts=2)
+    ledger.begin(CITIES)
+    ledger.fail('Pasadena', 'transform', 'bad file')
+    assert ledger.jobs()['Pasadena']['status'] == FAILED
+    ledger.fail('Pasadena', 'transform', 'bad file')
+    job = ledger.jobs()['Pasadena']
+    assert (job['status'], job['attempts'], job['next_attempt_at']) == (ABANDONED, 2, None)
+    assert ledger.begin(CITIES) == ['Los Angeles', 'Glendale']
+    ledger.close()
+
+def test_retry_delay_doubles_up_to_the_maximum(ledger_path):
+    ledger = open_ledger(ledger_path, retry_base=300, retry_max=1000)
+    assert [ledger.retry_delay(attempts) for attempts in (1, 2, 3, 4)] == [300, 600, 1000, 1000]
+    ledger.close()
+
+def test_abandon_gives_up_the_unfinished_agencies(ledger_path):
+    ledger = open_ledger(ledger_path)
+    ledger.begin(CITIES)
+    ledger.done('Los Angeles')
+    batch_id = ledger.batch_id
+    ledger.close()
+
+    ledger = open_ledger(ledger_path)
+    assert ledger.abandon() == 2
+    assert ledger.summary(batch_id) == {DONE: 1, ABANDONED: 2}
+    assert ledger.begin(CITIES) == CITIES
+    assert ledger.batch_id != batch_id
+    ledger.close()
+
+def test_unknown_backend_is_rejected(ledger_path):
+    with pytest.raises(ValueError):
+        JobLedger('redis', ledger_path)
@@ -0,0 +1,134 @@
+import os
+import csv
+import io
+from datetime import date
+import pytest
+import loader
+from const import INSERT_COLUMNS
+from loader import COPY_NULL, CopyStream, bulk_upsert, copy_upsert
+
+def filing(entry_id, **values):
+    # A full row in the order of INSERT_COLUMNS, every other column NULL
+    row = dict.fromkeys(INSERT_COLUMNS)
+    row.update(entry_id=entry_id, sch_number='2024010101', received=date(2024, 1, 11), **values)
+    return tuple(row[column] for column in INSERT_COLUMNS)
+
+ROWS = [
+    filing(1, document_title='Plain', location_total_acres=1.5, nod_approved_by_lead_agency=True),
+    filing(2, document_title='', document_description=None),
+    filing(3, document_title='He said "no", twice', cities='Los Angeles, Pasadena'),
+    filing(4, document_title='Line one\nLine two\r\nLine three', counties='Café – county'),
+]
+
+def parse(text):
+    return list(csv.reader(io.StringIO(text)))
+
+def test_rows_have_one_field_per_insert_column():
+    records = parse(CopyStream(ROWS).read())
+    assert len(records) == len(ROWS)
+    assert all(len(record) == len(INSERT_COLUMNS) for record in records)
+
+def test_null_and_empty_string_stay_apart():
+    text = CopyStream(ROWS).read()
+    title = INSERT_COLUMNS.index('document_title')
+    description = INSERT_COLUMNS.index('document_description')
+    records = parse(text)
+    assert records[1][title] == ''
+    assert records[1][description] == COPY_NULL
+    # COPY only reads the NULL marker as NULL when it is not quoted, and an unquoted empty field as ''
+    assert f',{COPY_NULL},' in text.splitlines()[1]
+
+def test_quotes_and_newlines_round_trip():
+    records = parse(CopyStream(ROWS).read())
+    title = INSERT_COLUMNS.index('document_title')
+    assert records[2][title] == 'He said "no", twice'
+    assert records[2][INSERT_COLUMNS.index('cities')] == 'Los Angeles, Pasadena'
+    assert records[3][title] == 'Line one\nLine two\r\nLine three'
+    assert records[3][INSERT_COLUMNS.index('counties')] == 'Café – county'
+
+def test_values_are_written_as_postgres_reads_them():
+    record = parse(CopyStream(ROWS[:1]).read())[0]
+    assert record[INSERT_COLUMNS.index('entry_id')] == '1'
+    assert record[INSERT_COLUMNS.index('received')] == '2024-01-11'
+    assert record[INSERT_COLUMNS.index('location_total_acres')] == '1.5'
+    assert record[INSERT_COLUMNS.index('nod_approved_by_lead_agency')] == 'True'
+
+@pytest.mark.parametrize('size', [1, 7, 100, 4096])
+def test_small_reads_give_the_same_text(size):
+    whole = CopyStream(ROWS).read()
+    stream = CopyStream(ROWS)
+    parts = []
+    while True:
+        part = stream.read(size)
+        if not part:
+            break
+        assert len(part) <= size
+        parts.append(part)
+    assert ''.join(parts) == whole
+
+def test_rows_are_produced_on_demand():
+    produced = []
+
+    def rows():
+        for row in ROWS:
+            produced.append(row)
+            yield row
+
+    stream = CopyStream(rows())
+    stream.read(10)
+    assert len(produced) == 1
+
+class FailingCopyCursor:
+    """Records the statements run, and fails the COPY as a missing TEMP privilege would."""
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, query, params=None):
+        self.statements.append(' '.join(query.split()))
+
+    def copy_expert(self, query, stream):
+        raise RuntimeError("permission denied to create temporary tables")
+
+def test_bulk_upsert_falls_back_to_insert(monkeypatch):
+    inserted = []
+    monkeypatch.setattr(loader, 'insert_upsert', lambda cursor, rows, **kwargs: inserted.extend(rows) or len(rows))
+    cursor = FailingCopyCursor()
+    assert bulk_upsert(cursor, ROWS) == len(ROWS)
+    assert inserted == ROWS
+    assert cursor.statements[0] == 'SAVEPOINT bulk_copy'
+    assert cursor.statements[-1] == 'ROLLBACK TO SAVEPOINT bulk_copy'
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        bulk_upsert(FailingCopyCursor(), ROWS, method='merge')
+
+@pytest.fixture
+def db_cursor():
+    if not os.getenv('DB_HOST'):
+        pytest.skip("No database: set DB_HOST and the other DB_* variables")
+    from utils import db_connection
+    connection = db_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT to_regclass('public.ceqa_data')")
+        if cursor.fetchone()[0] is None:
+            pytest.skip("The database has no ceqa_data table")
+        yield cursor
+    finally:
+        # Nothing the tests load is kept
+        connection.rollback()
+        connection.close()
+
+def test_copy_upsert_loads_what_the_rows_hold(db_cursor):
+    rows = [(-i,) + row[1:] for i, row in enumerate(ROWS, 1)]
+    assert copy_upsert(db_cursor, rows) == len(rows)
+    db_cursor.execute("SELECT entry_id, document_title, document_description, location_total_acres, "
+                      "nod_approved_by_lead_agency, received FROM public.ceqa_data WHERE entry_id < 0 "
+                      "ORDER BY entry_id DESC")
+    loaded = db_cursor.fetchall()
+    assert [row[1] for row in loaded] == ['Plain', '', 'He said "no", twice', 'Line one\nLine two\r\nLine three']
+    assert loaded[1][2] is None
+    assert float(loaded[0][3]) == 1.5
+    assert loaded[0][4] is True
+    assert loaded[0][5] == date(2024, 1, 11)
@@ -0,0 +1,147 @@
+import re
+import random
+import numpy as np
+import pandas as pd
+import pytest
+from parcels import ParcelExpander, ParcelRange, UNKNOWN, expand_parcel_string, parse_parcel_segments
+from utils import clean_parcel, validate_parcel
+
+@pytest.mark.parametrize('raw, expected', [
+    ('3123-014-900 to 903', ('3123014900', '3123014901', '3123014902', '3123014903')),
+    ('3203-018-064 thru -066', ('3203018064', '3203018065', '3203018066')),
+    ('3204008045/047', ('3204008047', '3204008045')),
+    ('3219-018-01, 02', ('321901801', '321901802')),
+    ('3219-018-010 and 3219-018-011 & 3219-018-012', ('3219018010', '3219018011', '3219018012')),
+    ('3219-018-010;; 3219-018-011', ('3219018010', '3219018011')),
+    ('abc', (UNKNOWN,)),
+    ('  ', (UNKNOWN,)),
+    (None, (UNKNOWN,)),
+    (float('nan'), (UNKNOWN,)),
+])
+def test_expand_parcel_string(raw, expected):
+    assert expand_parcel_string(raw) == expected
+
+def test_ranges_stay_unexpanded_in_segments():
+    segments = parse_parcel_segments('3123-014-900 to 916, 3123-014-950')
+    assert isinstance(segments[0], ParcelRange)
+    assert len(segments[0]) == 17
+    assert '3123014905' in segments[0]
+    assert '3123014917' not in segments[0]
+    assert segments[1] == '3123014950'
+
+def test_wide_range_is_not_expanded():
+    assert expand_parcel_string('3123-014-001 to 999999') == (UNKNOWN,)
+    assert expand_parcel_string('3123-014-001 to 005', max_range=3) == (UNKNOWN,)
+    assert len(expand_parcel_string('3123-014-001 to 005', max_range=5)) == 5
+
+def test_expand_batch_matches_single_expansion():
+    values = pd.Series(['3123-014-900 to 902', None, '3219-018-01, 02', '3123-014-900 to 902', 'abc'])
+    row_idx, parcels = ParcelExpander().expand_batch(values)
+    expected = [(i, parcel) for i, value in enumerate(values) for parcel in expand_parcel_string(value)]
+    assert list(zip(row_idx.tolist(), parcels.tolist())) == expected
+    assert row_idx.dtype == np.int64
+
+def test_count_wide_ranges():
+    expander = ParcelExpander(max_range=10)
+    values = ['3123-014-001 to 020', '3123-014-001 to 005', '3123-014-001 to 020', '3203-018-001 thru -100', None]
+    assert expander.count_wide_ranges(values) == 3
+    assert expander.expand('3123-014-001 to 020') == (UNKNOWN,)
+
+def test_long_expansions_are_not_memoized():
+    expander = ParcelExpander(max_range=100, max_cached=4)
+    assert expander.expand('3123-014-001 to 010') == expand_parcel_string('3123-014-001 to 010')
+    assert expander.expand('3123-014-001 to 003') == expand_parcel_string('3123-014-001 to 003')
+    # A wide range counts as the single 'Unknown' it expands to
+    assert expander.expand('3123-014-001 to 999') == (UNKNOWN,)
+    assert expander.cache_info().currsize == 2
+
+def legacy_expand_parcel_numbers(parcel):
+    # expand_parcel_numbers as it was before parcels.py, kept as the reference the engine must match
+    if pd.isna(parcel) or not isinstance(parcel, str) or not parcel.strip():
+        return ["Unknown"]
+    parcel = parcel.replace(' and ', ', ').replace('thru', ' thru ').replace(' to ', ' to ').replace('&', ', ')
+    parcel = re.sub(r'[;,]+', ',', parcel)
+    groups = [group.strip() for group in parcel.split(';')]
+    expanded_parcels = []
+    for group in groups:
+        parts = [p.strip() for p in group.split(',')]
+        base_parcel = None
+        for part in parts:
+            if '/' in part:
+                split_parts = part.split('/')
+                base_parcel = split_parts[0]
+                if len(split_parts) > 1:
+                    for suffix in split_parts[1:]:
+                        if suffix.isdigit():
+                            base_prefix = base_parcel[:-len(suffix)]
+                            expanded_parcels.append(validate_parcel(clean_parcel(base_prefix + suffix.zfill(3))))
+                        else:
+                            expanded_parcels.append("Unknown")
+                    else:
+                        expanded_parcels.append(validate_parcel(clean_parcel(base_parcel)))
+            elif ' to ' in part:
+                try:
+                    start, end = part.split(' to ')
+                    start = start.strip()
+                    end = end.strip()
+                    if base_parcel is None:
+                        base_parcel = start
+                    base_prefix = '-'.join(base_parcel.split('-')[:-1]) + '-'
+                    start_number = int(start.split('-')[-1])
+                    end_number = int(end)
+                    for i in range(start_number, end_number + 1):
+                        expanded_parcels.append(validate_parcel(clean_parcel(base_prefix + f"{i:03d}")))
+                except Exception:
+                    expanded_parcels.append("Unknown")
+            elif 'thru' in part:
+                try:
+                    start, end = part.split('thru')
+                    start = start.strip()
+                    end = end.strip().strip('-')
+                    if base_parcel is None:
+                        base_parcel = start
+                    base_prefix = '-'.join(base_parcel.split('-')[:-1]) + '-'
+                    start_number = int(start.split('-')[-1])
+                    end_number = int(end.split('-')[-1])
+                    for i in range(start_number, end_number + 1):
+                        expanded_parcels.append(validate_parcel(clean_parcel(base_prefix + f"{i:03d}")))
+                except Exception:
+                    expanded_parcels.append("Unknown")
+            elif part.count('-') == 2:
+                base_parcel = part
+                expanded_parcels.append(validate_parcel(clean_parcel(base_parcel)))
+            elif base_parcel:
+                base_prefix = '-'.join(base_parcel.split('-')[:-1]) + '-'
+                expanded_parcels.append(validate_parcel(clean_parcel(base_prefix + part.strip('-'))))
+            else:
+                expanded_parcels.append("Unknown")
+    return expanded_parcels
+
+MESSY_PARCELS = [
+    '3123-014-900 to 916', '3203-018-064 thru -071', '3203-018-064thru071', '3204008045/047',
+    '3204008045/47/048', '3204008045/x', '3219-018-01, 02', '3219-018-010 and 3219-018-011 & 3219-018-012',
+    '3219-018-010;; 3219-018-011,,012', '3219-018-010 to 005', '3219-018-010 to x', '3219-018-010 to 011 to 012',
+    '3219-018-010 thru -012 thru -013', '02, 03', '3219-018', '3219-018-01-02', '3219-018-01 , -02', '3219 018 010',
+    '3219-018-010 to 3219-018-012', '3123-14-9 to 11', '123-456-789 to 791', '31230149000 to 02',
+    '3219-018-010\n', ' 3219-018-010 ', '3219-018-٠١٠', 'APN 3219-018-010', 'N/A', 'Unknown', '-', ',', '&', 'and',
+    '3219-018-010 & ', '3219-018-010/', '/047', '3219-018-010 to -12', '3219-018-0 to 1000', '', '   ', None,
+    float('nan'), 3219018010,
+]
+
+def messy_samples(count=400, seed=7):
+    # Random mixes of the separators and forms the export uses, valid or not
+    rng = random.Random(seed)
+    pieces = ['3219-018-010', '3219-018-01', '3204008045', '02', '-03', '047', '900', '916', '-071', 'x', '',
+              '3123-014-900', '123-456-789', '3219-018']
+    separators = [', ', ',', '; ', ' and ', ' & ', ' to ', ' thru ', 'thru', '/', ' ', ';;', ' to -']
+    samples = []
+    for _ in range(count):
+        value = rng.choice(pieces)
+        for _ in range(rng.randint(0, 4)):
+            value += rng.choice(separators) + rng.choice(pieces)
+        samples.append(value)
+    return samples
+
+@pytest.mark.parametrize('raw', MESSY_PARCELS + messy_samples())
+def test_engine_matches_the_legacy_expansion(raw):
+    assert list(expand_parcel_string(raw, max_range=10 ** 9)) == legacy_expand_parcel_numbers(raw)
@@ -0,0 +1,65 @@
+import threading
+import pytest
+from pipeline import Stage, StagePipeline
+
+def run_with_timeout(pipeline, items, timeout=5):
+    # Runs the pipeline in a thread so that a hang fails the test instead of blocking it
+    outcome = {}
+
+    def run():
+        try:
+            outcome['results'] = pipeline.run(items)
+        except BaseException as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "the pipeline did not finish"
+    return outcome
+
+def test_items_flow_through_every_stage():
+    stages = [Stage("double", lambda x: x * 2, workers=3), Stage("inc", lambda x: x + 1, workers=2)]
+    outcome = run_with_timeout(StagePipeline(stages, queue_size=2), range(50))
+    assert sorted(outcome['results']) == [x * 2 + 1 for x in range(50)]
+
+def test_failed_and_dropped_items_leave_the_others_flowing():
+    errors = []
+
+    def check(x):
+        if x == 3:
+            raise ValueError("bad item")
+        return None if x == 5 else x
+
+    pipeline = StagePipeline([Stage("check", check), Stage("keep", lambda x: x)],
+                             on_error=lambda item, stage, e: errors.append((item, stage, str(e))))
+    outcome = run_with_timeout(pipeline, range(8))
+    assert sorted(outcome['results']) == [0, 1, 2, 4, 6, 7]
+    assert errors == [(3, "check", "bad item")]
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_stage_raising_system_exit_stops_the_run(workers):
+    def stage(x):
+        if x == 2:
+            raise SystemExit(1)
+        return x
+
+    stages = [Stage("first", lambda x: x, workers=2), Stage("exit", stage, workers=workers), Stage("last", lambda x: x)]
+    outcome = run_with_timeout(StagePipeline(stages, queue_size=1), range(100))
+    assert isinstance(outcome['error'], SystemExit)
+
+def test_items_raising_stop_the_run_after_the_items_fed():
+    processed = []
+
+    def items():
+        yield from range(5)
+        raise RuntimeError("source failed")
+
+    stages = [Stage("record", lambda x: processed.append(x) or x, workers=2)]
+    outcome = run_with_timeout(StagePipeline(stages), items())
+    assert isinstance(outcome['error'], RuntimeError)
+    assert sorted(processed) == [0, 1, 2, 3, 4]
+
+def test_stage_needs_a_worker():
+    with pytest.raises(ValueError):
+        Stage("none", lambda x: x, workers=0)
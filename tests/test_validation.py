@@ -0,0 +1,59 @@
+import pandas as pd
+import pytest
+from validation import validate_widths, width_limits
+
+COLUMNS = ['entry_id', 'sch_number', 'document_type', 'document_title', 'received', 'location_total_acres']
+
+def filings():
+    return pd.DataFrame({
+        'entry_id': [1, 2, 3, 4],
+        'sch_number': ['2024010101', '2024010102' * 2, None, '2024010104'],
+        'document_type': ['NOD', 'NOE', 'NOTICE OF DETERMINATION', 'NOD'],
+        'document_title': ['x' * 5000, 'Title', None, 'Title'],
+        'received': pd.to_datetime(['2024-01-11'] * 4),
+        'location_total_acres': [1.5, None, 123456789.0, 2.0],
+    })
+
+def test_only_varchar_columns_are_measured():
+    assert width_limits(COLUMNS) == {1: ('sch_number', 16), 2: ('document_type', 8)}
+
+def test_truncate():
+    df, report = validate_widths(filings(), 'truncate', COLUMNS)
+    assert len(df) == 4
+    assert df['sch_number'].iloc[[0, 1, 3]].tolist() == ['2024010101', ('2024010102' * 2)[:16], '2024010104']
+    assert pd.isna(df['sch_number'].iloc[2])
+    assert df['document_type'].tolist() == ['NOD', 'NOE', 'NOTICE O', 'NOD']
+    # TEXT, DATE and NUMERIC columns are left as they are
+    assert df['document_title'].iloc[0] == 'x' * 5000
+    assert report.rows == report.truncated == 2
+    assert report.rejected == []
+    assert report.examples == [2, 3]
+
+def test_reject():
+    df, report = validate_widths(filings(), 'reject', COLUMNS)
+    assert df['entry_id'].tolist() == [1, 4]
+    assert df['document_type'].tolist() == ['NOD', 'NOD']
+    assert report.rows == 2
+    assert report.truncated == 0
+    assert report.rejected == [2, 3]
+
+def test_summary_counts():
+    df = filings()
+    df.loc[3, 'document_type'] = 'NOTICE OF EXEMPTION'
+    _, report = validate_widths(df, 'truncate', COLUMNS)
+    assert report.columns == {'sch_number': (1, 20, 16), 'document_type': (2, 23, 8)}
+    assert report.rows == 3
+    assert report.summary() == ("3 filings truncated: sch_number 1 > 16 (max 20), document_type 2 > 8 (max 23); "
+                                "e.g. entry_id 2, 3, 4")
+    assert report.as_dict()['columns']['document_type'] == {'count': 2, 'max_length': 23, 'width': 8}
+
+def test_clean_rows_give_an_empty_report():
+    df = filings().iloc[[0, 3]]
+    checked, report = validate_widths(df, 'reject', COLUMNS)
+    assert checked is df
+    assert not report
+    assert report.columns == {}
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        validate_widths(filings(), 'ignore', COLUMNS)
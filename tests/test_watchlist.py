@@ -0,0 +1,67 @@
+import random
+import pandas as pd
+import pytest
+from parcels import ParcelExpander
+from parcel_index import build_parcel_rows
+from watchlist import WatchlistMatcher
+
+RAW_PARCELS = [
+    '3123-014-900 to 916',
+    '3203-018-064 thru -071',
+    '3204008045/047',
+    '3219-018-01, 02; 03',
+    '3219-018-010 and 3219-018-011 & 3219-018-012',
+    '3123-014-001 to 090',  # Wider than the max_range of the expander below
+    '3123-014-950 to 955, 3123-014-001 to 300',
+    '5555-001-001',
+    'Unknown',
+    None,
+    '',
+    '3123-014-900 to 916',
+]
+
+def filings(raw_parcels):
+    return pd.DataFrame({
+        'entry_id': range(1, len(raw_parcels) + 1),
+        'SCH Number': [f"20240101{i:02d}" for i in range(len(raw_parcels))],
+        'Document Type': 'NOD',
+        'Lead Agency Title': 'Los Angeles',
+        'Received': pd.Timestamp('2024-01-11'),
+        'Location Parcel Number': raw_parcels,
+    })
+
+def assert_agrees(raw_parcels, apns, expander):
+    df = filings(raw_parcels)
+    matches = WatchlistMatcher(apns, expander=expander).match_frame(df)
+    indexed = {(parcel, entry_id) for entry_id, parcel in build_parcel_rows(df['entry_id'], df['Location Parcel Number'],
+                                                                           expander=expander) if parcel in apns}
+    assert set(zip(matches['apn'], matches['entry_id'])) == indexed
+    return indexed
+
+def test_matches_agree_with_the_parcel_table():
+    expander = ParcelExpander(max_range=50)
+    apns = {'3123014905', '3203018070', '3204008047', '321901802', '3219018011', '5555001001',
+            '3123014060',  # Only inside the wide range, so in neither
+            '3123014952', '3123014200', '9999999999'}
+    indexed = assert_agrees(RAW_PARCELS, apns, expander)
+    assert ('3123014905', 1) in indexed and ('3123014905', 12) in indexed
+    assert not any(parcel in ('3123014060', '3123014200') for parcel, _ in indexed)
+    assert ('3123014952', 7) in indexed
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_watchlists_agree(seed):
+    rng = random.Random(seed)
+    expander = ParcelExpander(max_range=rng.choice([5, 20, 100]))
+    raw = []
+    for _ in range(60):
+        prefix = f"{rng.randint(3100, 3105)}-0{rng.randint(10, 12)}-"
+        start = rng.randint(0, 980)
+        raw.append(rng.choice([
+            f"{prefix}{start:03d} to {start + rng.randint(0, 30)}",
+            f"{prefix}{start:03d} thru -{start + rng.randint(0, 30):03d}",
+            f"{prefix}{start:03d}, {rng.randint(0, 999):03d}",
+            f"{prefix}{start:03d}",
+        ]))
+    # APNs anywhere near the filings' parcels, inside and outside their ranges
+    apns = {f"{rng.randint(3100, 3105)}0{rng.randint(10, 12)}{rng.randint(0, 999):03d}" for _ in range(3000)}
+    assert_agrees(raw, apns, expander)